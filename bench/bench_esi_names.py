@@ -0,0 +1,87 @@
+'''
+    Benchmark name resolution for a large fight against a local ESI stub, no network required.
+
+    Compares one GET request per id (the esipy multi_request path, which does not deduplicate ids) against
+    deduplicated POST /universe/names/ requests of up to 1000 ids.
+
+    Run from the repository root:
+        python -m bench.bench_esi_names --pilots 300 --latency 0.05
+'''
+
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import requests
+
+from tools.esi_bulk_names import EsiBulkNames
+from tools.stub_servers import StubEsiServer
+
+
+# Build victim + attacker id lists the way lookup_esi_names.get_*_ids() does, duplicates included
+def make_fight(pilots, seed=1):
+    rng = random.Random(seed)
+    alliances = [99000000 + x for x in range(max(1, pilots // 40))]
+    corporations = [98000000 + x for x in range(max(1, pilots // 8))]
+    corp_alliance = {x: rng.choice(alliances + [0]) for x in corporations}
+
+    character_ids, corporation_ids, alliance_ids = [], [], []
+    for _ in range(pilots):
+        corporation_id = rng.choice(corporations)
+        character_ids.append(rng.randint(2112000000, 2112000000 + pilots * 2))
+        corporation_ids.append(corporation_id)
+        alliance_ids.append(corp_alliance[corporation_id])
+    return character_ids, corporation_ids, alliance_ids
+
+# One GET per id on a pool of 10 threads, the default esipy multi_request behaviour
+def per_id_lookup(base_url, character_ids, corporation_ids, alliance_ids):
+    session = requests.Session()
+    jobs = [('characters', x) for x in character_ids if x] + [('corporations', x) for x in corporation_ids if x] \
+        + [('alliances', x) for x in alliance_ids if x]
+
+    def fetch(job):
+        return job, session.get(f'{base_url}/{job[0]}/{job[1]}/').json()['name']
+
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        results = list(pool.map(fetch, jobs))
+    return len(jobs), results
+
+@click.command()
+@click.option('--pilots', default=300, help='Pilots on the killmail')
+@click.option('--latency', default=0.05, help='Stub ESI latency per request, in seconds')
+def main(pilots, latency):
+    stub = StubEsiServer(latency=latency).start()
+    character_ids, corporation_ids, alliance_ids = make_fight(pilots)
+    unique = len(set(character_ids)) + len(set(corporation_ids)) + len(set(alliance_ids) - {0})
+    print(f'{pilots} pilots, {unique} unique ids, stub latency {latency * 1000:.0f} ms\n')
+
+    start = time.perf_counter()
+    requests_made, _ = per_id_lookup(stub.url, character_ids, corporation_ids, alliance_ids)
+    per_id_seconds = time.perf_counter() - start
+    print(f'per id GET  : {requests_made:5} requests {per_id_seconds:8.3f} s')
+
+    client = EsiBulkNames(base_url=stub.url)
+    start = time.perf_counter()
+    names = client.bulk_lookup_names(character_ids, corporation_ids, alliance_ids)
+    bulk_seconds = time.perf_counter() - start
+    print(f'bulk POST   : {client.request_count:5} requests {bulk_seconds:8.3f} s')
+    print(f'\nspeedup {per_id_seconds / bulk_seconds:.1f}x')
+
+    resolved = sum(len(x) - 1 for x in names.values())
+    if resolved != unique:
+        print(f'   xxx bulk lookup resolved {resolved} of {unique} ids')
+
+    # A single unresolvable id should only cost its own name
+    bad_stub = StubEsiServer(invalid_ids=[character_ids[0]]).start()
+    bad_client = EsiBulkNames(base_url=bad_stub.url)
+    names = bad_client.bulk_lookup_names(character_ids, corporation_ids, alliance_ids)
+    print(f'with 1 invalid id: {sum(len(x) - 1 for x in names.values())} of {unique} resolved '
+          f'in {bad_client.request_count} requests')
+
+    bad_stub.stop()
+    stub.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+'''
+    Benchmark compressed killmail storage.
+
+    Trains each codec on the first half of the killmails and measures the compression ratio and encode/decode speed
+    on the second half, then writes all killmails into a fresh RedisqCache per codec and compares database size and
+    read throughput.
+
+    Killmails come from an ESI region file saved by `redisq_listener.py --loaddata` when one is given, otherwise
+    synthetic killmails drawn from a limited set of ships and items are used.
+
+    Run from the repository root:
+        python -m bench.bench_killmail_codec --killmails 5000
+        python -m bench.bench_killmail_codec --region-file cache/esi_regions/10000015.jsonl
+'''
+
+import json
+import os
+import random
+import tempfile
+import time
+
+import click
+
+from tools.killmail_codec import KillmailCodec, zstandard
+from tools.redisq_cache import RedisqCache, KillmailWriter
+from tools.replay_cache import ReplayCache
+
+
+def make_killmails(count, seed=1):
+    rng = random.Random(seed)
+    ship_types = [rng.randint(500, 50000) for _ in range(150)]
+    item_types = [rng.randint(500, 50000) for _ in range(600)]
+    pilots = [(rng.randint(90000000, 2120000000), rng.randint(98000000, 98999999), rng.randint(99000000, 99999999))
+              for _ in range(3000)]
+    killmails = []
+    for i in range(count):
+        attackers = []
+        for _ in range(rng.randint(1, 40)):
+            character_id, corporation_id, alliance_id = rng.choice(pilots)
+            attackers.append({
+                'alliance_id': alliance_id,
+                'character_id': character_id,
+                'corporation_id': corporation_id,
+                'damage_done': rng.randint(0, 20000),
+                'final_blow': False,
+                'security_status': round(rng.uniform(-10, 5), 1),
+                'ship_type_id': rng.choice(ship_types),
+                'weapon_type_id': rng.choice(item_types),
+            })
+        attackers[0]['final_blow'] = True
+        items = [{
+            'flag': rng.choice((5, 11, 12, 13, 19, 20, 27, 28, 29, 92, 93)),
+            'item_type_id': rng.choice(item_types),
+            'quantity_destroyed' if rng.random() < 0.5 else 'quantity_dropped': rng.randint(1, 5),
+            'singleton': 0,
+        } for _ in range(rng.randint(0, 30))]
+        character_id, corporation_id, alliance_id = rng.choice(pilots)
+        killmail = {
+            'attackers': attackers,
+            'killmail_id': 80000000 + i,
+            'killmail_time': f'2019-11-{rng.randint(1, 30):02}T{rng.randint(0, 23):02}:{rng.randint(0, 59):02}:00Z',
+            'solar_system_id': rng.randint(30000001, 30005000),
+            'victim': {'alliance_id': alliance_id, 'character_id': character_id, 'corporation_id': corporation_id,
+                       'damage_taken': rng.randint(1000, 100000), 'items': items,
+                       'position': {'x': rng.uniform(-1e12, 1e12), 'y': rng.uniform(-1e11, 1e11),
+                                    'z': rng.uniform(-1e12, 1e12)},
+                       'ship_type_id': rng.choice(ship_types)},
+            'zkb': {'hash': '%040x' % rng.getrandbits(160), 'totalValue': round(rng.uniform(1e6, 1e10), 2)},
+        }
+        killmails.append((killmail['killmail_id'], json.dumps(killmail), killmail))
+    return killmails
+
+def load_killmails(path):
+    if path.endswith('.jsonl'):
+        with ReplayCache(path) as cache:
+            return [(x['killmail_id'], json.dumps(x), x) for x in cache.killmails()]
+    with open(path, 'r') as fp:
+        return [(x['killmail_id'], json.dumps(x), x) for x in json.loads(fp.read())]
+
+
+# ################################
+# Codecs
+
+def codec_runs(train, test):
+    runs = [('zlib, no dictionary', KillmailCodec({1: (KillmailCodec.CODEC_ZLIB, b'')}, 1)),
+            ('zlib, dictionary', KillmailCodec({1: (KillmailCodec.CODEC_ZLIB,
+                                                    KillmailCodec.train(KillmailCodec.CODEC_ZLIB, train))}, 1))]
+    if zstandard is not None:
+        runs.append(('zstd, dictionary', KillmailCodec({1: (KillmailCodec.CODEC_ZSTD,
+                                                            KillmailCodec.train(KillmailCodec.CODEC_ZSTD, train))}, 1)))
+    else:
+        print('zstandard is not installed, skipping zstd\n')
+
+    raw_bytes = sum(len(x.encode('utf-8')) for x in test)
+    print(f'{"codec":22} {"ratio":>7} {"bytes/km":>9} {"encode/s":>10} {"decode/s":>10}')
+    print(f'{"none":22} {1.0:7.2f} {raw_bytes // len(test):9}')
+    for name, codec in runs:
+        start = time.perf_counter()
+        blobs = [codec.encode(x) for x in test]
+        encode_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        decoded = [codec.decode(x) for x in blobs]
+        decode_seconds = time.perf_counter() - start
+        assert decoded == test
+        stored = sum(len(x) for x in blobs)
+        print(f'{name:22} {raw_bytes / stored:7.2f} {stored // len(test):9} {len(test) / encode_seconds:10.0f} '
+              f'{len(test) / decode_seconds:10.0f}')
+
+
+# ################################
+# Archive
+
+def archive_run(directory, compression, killmails):
+    path = os.path.join(directory, f'{compression}.sqlite')
+    cache = RedisqCache(path, compression=compression)
+    start = time.perf_counter()
+    writer = KillmailWriter(cache, batch_size=100, flush_interval=0.5)
+    for killmail_id, killmail, killmail_dict in killmails:
+        writer.put(killmail_id, killmail, killmail_dict)
+    writer.close()
+    write_seconds = time.perf_counter() - start
+
+    # Killmails written before the dictionary was trained are still text, as an upgraded archive would be
+    compressed = cache.compress_killmails() if compression != 'none' else 0
+    cache.vacuum()
+
+    ids = [x[0] for x in killmails]
+    start = time.perf_counter()
+    found = cache.lookup_killmails(ids)
+    read_seconds = time.perf_counter() - start
+    assert len(found) == len(ids)
+
+    print(f'{compression:10} {os.path.getsize(path) // 1024:9} KB {len(ids) / write_seconds:10.0f} '
+          f'{len(ids) / read_seconds:10.0f} {compressed:12}')
+
+@click.command()
+@click.option('--killmails', 'count', default=5000, help='Synthetic killmails to generate')
+@click.option('--region-file', default=None, help='ESI killmails saved by redisq_listener.py --loaddata')
+def main(count, region_file):
+    killmails = load_killmails(region_file) if region_file else make_killmails(count)
+    strings = [x[1] for x in killmails]
+    middle = len(strings) // 2
+    print(f'{len(strings)} killmails, average {sum(len(x) for x in strings) // len(strings)} bytes\n')
+    codec_runs(strings[:middle], strings[middle:])
+
+    print(f'\n{"archive":10} {"file size":>12} {"write/s":>10} {"read/s":>10} {"migrated":>12}')
+    modes = ['none', 'zlib'] + (['zstd'] if zstandard is not None else [])
+    with tempfile.TemporaryDirectory() as directory:
+        for compression in modes:
+            archive_run(directory, compression, killmails)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+'''
+    Benchmark saving killmails to the RedisqCache sqlite database.
+
+    Compares the original per killmail commit (new connection, rollback journal, synchronous=FULL) against
+    insert_killmail with WAL and synchronous=NORMAL, and against the KillmailWriter group commit thread.
+    Each run uses a fresh database in a temporary directory.
+
+    Run from the repository root:
+        python -m bench.bench_killmail_writer --killmails 2000
+'''
+
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import click
+
+from tools.redisq_cache import RedisqCache, KillmailWriter
+
+
+def make_killmails(count, seed=1):
+    rng = random.Random(seed)
+    killmails = []
+    for i in range(count):
+        attackers = [{
+            'character_id': rng.randint(90000000, 2120000000),
+            'corporation_id': rng.randint(98000000, 98999999),
+            'alliance_id': rng.randint(99000000, 99999999),
+            'damage_done': rng.randint(0, 20000),
+            'final_blow': False,
+            'security_status': round(rng.uniform(-10, 5), 1),
+            'ship_type_id': rng.randint(500, 50000),
+            'weapon_type_id': rng.randint(500, 50000),
+        } for _ in range(rng.randint(1, 40))]
+        killmail = {
+            'killmail_id': 80000000 + i,
+            'killmail_time': '2019-11-15T12:34:56Z',
+            'solar_system_id': rng.randint(30000001, 30005000),
+            'attackers': attackers,
+            'victim': {'character_id': rng.randint(90000000, 2120000000), 'ship_type_id': rng.randint(500, 50000),
+                       'damage_taken': rng.randint(1000, 100000), 'items': []},
+            'hash': '%040x' % rng.getrandbits(160),
+        }
+        killmails.append((killmail['killmail_id'], json.dumps(killmail)))
+    return killmails
+
+# The insert_killmail code path as it was before group commits
+def original_per_row(path, killmails):
+    RedisqCache(path)
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA journal_mode=DELETE')
+    db.close()
+    for killmail_id, killmail in killmails:
+        db = sqlite3.connect(path)
+        db.execute('INSERT INTO Killmails (id, killmail) VALUES (?, ?);', (killmail_id, killmail))
+        db.commit()
+        db.close()
+
+def wal_per_row(path, killmails):
+    cache = RedisqCache(path)
+    for killmail_id, killmail in killmails:
+        cache.insert_killmail(killmail_id, killmail)
+
+def group_commit(path, killmails):
+    writer = KillmailWriter(RedisqCache(path), batch_size=100, flush_interval=0.5)
+    for killmail_id, killmail in killmails:
+        writer.put(killmail_id, killmail)
+    writer.close()
+
+def count_rows(path):
+    db = sqlite3.connect(path)
+    try:
+        return db.execute('SELECT COUNT(*) FROM killmails').fetchone()[0]
+    finally:
+        db.close()
+
+@click.command()
+@click.option('--killmails', 'count', default=2000, help='Killmails to write in each run')
+def main(count):
+    killmails = make_killmails(count)
+    print(f'{count} killmails, average {sum(len(x[1]) for x in killmails) // count} bytes\n')
+
+    for name, run in [('per row, original', original_per_row), ('per row, WAL', wal_per_row),
+                      ('group commit', group_commit)]:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'zkb_cache.sqlite')
+            start = time.perf_counter()
+            run(path, killmails)
+            seconds = time.perf_counter() - start
+            rows = count_rows(path)
+        print(f'{name:20}: {count / seconds:10.0f} killmails/s  {seconds:7.3f} s  ({rows} rows)')
+
+    # Duplicates are ignored instead of raising
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'zkb_cache.sqlite')
+        group_commit(path, killmails[:100] + killmails[:100])
+        print(f'\n200 inserts of 100 unique killmails stored {count_rows(path)} rows')
+
+
+if __name__ == '__main__':
+    main()
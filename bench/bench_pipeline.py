@@ -0,0 +1,272 @@
+'''
+    End-to-end benchmark of redisq_listener -> ZMQ -> hook_bot, with local stand-ins for RedisQ, ESI and Discord.
+
+    Killmails are fed into a StubRedisqServer at increasing rates. The listener fetches them, archives them to a fresh
+    database, resolves names against a StubEsiServer answering after --latency seconds, and broadcasts them. The
+    hook_bot receive loop matches them against a rule every killmail passes and posts to a StubDiscordServer. For
+    every rate the benchmark reports:
+        - the killmails per second delivered to Discord
+        - latency percentiles from RedisQ serving a killmail to the broadcast, and to Discord receiving it
+        - the stages whose input backed up, and the bottleneck, the last of them in pipeline order
+    Results are saved as json with --output, so runs of different versions can be compared.
+
+    Needs the static data dump, hook_bot looks up solar system and ship names. Killmails come from an ESI region file
+    saved by `redisq_listener.py --loaddata` when one is given, otherwise synthetic killmails are used. The console
+    output of the listener and hook_bot is discarded while a rate runs.
+
+    Run from the repository root:
+        python -m bench.bench_pipeline --rates 10,50,100,200 --duration 10 --latency 0.05 --output pipeline.json
+'''
+
+import contextlib
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import click
+
+import hook_bot
+from redisq_listener import ZKBRedisQ
+from bench.bench_killmail_codec import make_killmails
+from tools.discord_delivery import DiscordDelivery, webhook_name
+from tools.esi_bulk_names import EsiBulkNames
+from tools.lookup_eve_static_dump import LookupEveStaticDump
+from tools.name_resolver import NameResolver
+from tools.replay_cache import ReplayCache
+from tools.rule_engine import Rule, RuleEngine
+from tools.solarsystem_table import SolarSystemTable
+from tools.stub_servers import StubRedisqServer, StubEsiServer, StubDiscordServer
+from tools.zkb_subscriber import ZKBSubscriber
+
+
+# Pipeline stages in order. A stage is backed up when its input holds half its capacity on average, for unbounded
+# inputs one second of killmails at the offered rate.
+STAGES = ('redisq fetch', 'persist', 'archive writer', 'enrich', 'publish', 'hook_bot', 'discord')
+
+
+def free_port():
+    with contextlib.closing(socket.socket()) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def load_static():
+    lookup = LookupEveStaticDump()
+    return lookup, SolarSystemTable.load_or_build(lookup)
+
+# count killmails with unique ids, from the region file repeated as often as needed, or synthetic
+def load_killmails(count, region_file=None):
+    if region_file is not None and region_file.endswith('.jsonl'):
+        with ReplayCache(region_file) as cache:
+            source = list(cache.killmails())
+    elif region_file is not None:
+        with open(region_file, 'r') as fp:
+            source = json.load(fp)
+    else:
+        source = [x[2] for x in make_killmails(min(count, 2000))]
+    killmails = []
+    for i in range(count):
+        killmail = dict(source[i % len(source)])
+        killmail['killmail_id'] = 1 + i
+        killmails.append(killmail)
+    return killmails
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    result = {f'p{x}': round(values[min(len(values) - 1, int(len(values) * x / 100))] * 1000, 2) for x in (50, 90, 99)}
+    result['max'] = round(values[-1] * 1000, 2)
+    return result
+
+
+class PipelineBench(object):
+    '''
+        Runs the listener and the hook_bot receive loop against the stub servers, in this process
+    '''
+    def __init__(self, directory, latency, enrich_workers, queue_size, discord_rate_limit):
+        self.redisq = StubRedisqServer(wait=0.5).start()
+        self.esi = StubEsiServer(latency=latency).start()
+        self.discord = StubDiscordServer(rate_limit=discord_rate_limit, rate_window=1.0).start()
+        self.webhook_url = self.discord.webhook_url(1)
+        self.publish_address = publish_address = f'tcp://127.0.0.1:{free_port()}'
+        self.control_address = control_address = f'tcp://127.0.0.1:{free_port()}'
+
+        self.listener = ZKBRedisQ(session_id='bench', enrich_workers=enrich_workers, queue_size=queue_size,
+                                  wire_format='multipart', redisq_url=self.redisq.listen_url,
+                                  publish_bind=publish_address, control_bind=control_address,
+                                  archive_path=os.path.join(directory, 'bench.sqlite'))
+        fetch_names = EsiBulkNames(base_url=self.esi.url).bulk_lookup_names
+        self.listener.name_resolver = NameResolver(self.listener.cache_killmails, fetch_names=fetch_names)
+
+        self.published = {}
+        hook_bot.position_path = os.path.join(directory, 'hook_bot_position.json')
+        self.delivery = DiscordDelivery()
+        self.hook_ready = threading.Event()
+
+    def start(self):
+        self.listener.start()
+        # A subscriber of its own notes when each killmail was broadcast
+        self.monitor = ZKBSubscriber(address=self.publish_address, control_address=self.control_address)
+        self.hook_subscriber = ZKBSubscriber(address=self.publish_address, control_address=self.control_address)
+        threading.Thread(target=self.monitor_loop, daemon=True).start()
+        threading.Thread(target=self.hook_loop, daemon=True).start()
+        self.hook_ready.wait()
+        # ZMQ subscriptions take a moment to reach the publisher
+        time.sleep(0.5)
+
+    # The static data lookups can only be used from the thread that opened them, the same as in hook_bot
+    def hook_loop(self):
+        lookup, solarsystems = load_static()
+        rules = RuleEngine([Rule('bench', webhook=self.webhook_url)], solarsystems.get_region_id)
+        self.hook_ready.set()
+        hook_bot.receive_loop(self.hook_subscriber, rules, solarsystems, lookup, self.delivery)
+
+    def monitor_loop(self):
+        while True:
+            message = self.monitor.recv()
+            self.published[message.data['killmail']['killmail_id']] = time.perf_counter()
+
+    # { killmail id: time Discord received it }, the first word of each message line is the killmail id
+    def delivered(self):
+        delivered = {}
+        webhook_id = int(webhook_name(self.webhook_url))
+        for content, post_time in zip(self.discord.messages.get(webhook_id, []),
+                                      self.discord.post_times.get(webhook_id, [])):
+            for line in content.split('\n'):
+                killmail_id = line.split(' ', 1)[0]
+                if killmail_id.isdigit():
+                    delivered[int(killmail_id)] = post_time
+        return delivered
+
+    # Input depth of every stage, as a share of its capacity
+    def sample(self, rate):
+        stats = self.listener.get_stage_stats()
+        queues, capacity = stats['queues'], stats['capacity']
+        webhook = self.delivery.get_stats().get(webhook_name(self.webhook_url), {'queued': 0, 'waiting': 0})
+        second = max(1.0, rate)
+        return {
+            'redisq fetch': self.redisq.backlog() / second,
+            'persist': queues['persist'] / capacity['persist'],
+            'archive writer': queues['writer'] / capacity['writer'],
+            'enrich': queues['enrich'] / capacity['enrich'],
+            'publish': (queues['publish'] + stats['reorder']) / capacity['publish'],
+            'hook_bot': max(0, len(self.published) - webhook['queued']) / second,
+            'discord': webhook['waiting'] / second,
+        }
+
+    '''
+        Feed killmails at rate per second for duration seconds, then wait up to drain seconds for them to reach
+        Discord. Returns the results of this rate.
+    '''
+    def run_rate(self, killmails, rate, duration, drain):
+        count = max(1, int(rate * duration))
+        batch, killmails = killmails[:count], killmails[count:]
+        samples = []
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            next_sample = start
+            for i, killmail in enumerate(batch):
+                due = start + i / rate
+                while time.perf_counter() < due:
+                    if time.perf_counter() >= next_sample:
+                        samples.append(self.sample(rate))
+                        next_sample += 0.1
+                    time.sleep(min(0.01, max(0.0, due - time.perf_counter())))
+                self.redisq.feed(killmail)
+
+            ids = [x['killmail_id'] for x in batch]
+            deadline = time.perf_counter() + drain
+            while time.perf_counter() < deadline:
+                samples.append(self.sample(rate))
+                delivered = self.delivered()
+                if all(x in delivered for x in ids):
+                    break
+                time.sleep(0.1)
+
+        served = self.redisq.served
+        delivered = self.delivered()
+        done = [x for x in ids if x in delivered]
+        finished = max((delivered[x] for x in done), default=start)
+        fill = {stage: sum(x[stage] for x in samples) / len(samples) for stage in STAGES} if samples else {}
+        backed_up = [x for x in STAGES if fill.get(x, 0) >= 0.5]
+        return killmails, {
+            'offered': rate,
+            'killmails': count,
+            'delivered': len(done),
+            'throughput': round(len(done) / max(finished - start, 1e-9), 2),
+            'publish_latency_ms': percentiles([self.published[x] - served[x] for x in ids
+                                               if x in self.published and x in served]),
+            'delivery_latency_ms': percentiles([delivered[x] - served[x] for x in done if x in served]),
+            'stage_fill': {x: round(y, 3) for x, y in fill.items()},
+            'backed_up': backed_up,
+            'bottleneck': backed_up[-1] if backed_up else None,
+            # Totals since the benchmark started, not per rate
+            'http': self.listener.http.get_stats(),
+        }
+
+    def close(self):
+        self.listener.stop_event.set()
+        self.delivery.close(timeout=1.0)
+
+
+@click.command()
+@click.option('--rates', default='10,50,100,200', help='Killmails per second fed into RedisQ, comma separated')
+@click.option('--duration', default=10.0, help='Seconds each rate is fed')
+@click.option('--drain', default=30.0, help='Seconds to wait for the killmails of a rate to reach Discord')
+@click.option('--latency', default=0.05, help='Stub ESI latency per request, in seconds')
+@click.option('--enrich-workers', default=4, help='Listener threads resolving names')
+@click.option('--queue-size', default=100, help='Listener queue size between stages')
+@click.option('--discord-rate-limit', default=1000, help='Posts per second the stub Discord webhook accepts')
+@click.option('--region-file', default=None, help='ESI killmails saved by --loaddata, synthetic when not given')
+@click.option('--output', default=None, help='Save the results to this json file')
+def main(rates, duration, drain, latency, enrich_workers, queue_size, discord_rate_limit, region_file, output):
+    rates = [float(x) for x in rates.split(',')]
+    killmails = load_killmails(sum(max(1, int(x * duration)) for x in rates), region_file)
+
+    with tempfile.TemporaryDirectory() as directory:
+        bench = PipelineBench(directory, latency, enrich_workers, queue_size, discord_rate_limit)
+        bench.start()
+        print(f'{len(killmails)} killmails, stub ESI latency {latency * 1000:.0f} ms, '
+              f'{enrich_workers} enrich workers\n')
+        print(f'{"offered":>8} {"km/s":>8} {"delivered":>10} {"publish p50/p99 ms":>20} {"delivery p50/p99 ms":>20}  '
+              f'bottleneck')
+
+        results = []
+        for rate in rates:
+            killmails, result = bench.run_rate(killmails, rate, duration, drain)
+            results.append(result)
+            latencies = []
+            for key in ('publish_latency_ms', 'delivery_latency_ms'):
+                value = result[key]
+                latencies.append(f'{value["p50"]:.1f} / {value["p99"]:.1f}' if value else '-')
+            print(f'{rate:8.0f} {result["throughput"]:8.1f} {result["delivered"]:5}/{result["killmails"]:<4} '
+                  f'{latencies[0]:>20} {latencies[1]:>20}  {result["bottleneck"] or "-"}')
+        bench.close()
+
+    saturated = next((x for x in results if x['throughput'] < 0.9 * x['offered']), None)
+    if saturated is not None:
+        print(f'\nSaturated at {saturated["offered"]:.0f} killmails/s, '
+              f'bottleneck {saturated["bottleneck"] or "unknown"}')
+
+    if output is not None:
+        with open(output, 'w') as fp:
+            json.dump({
+                'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'settings': {'duration': duration, 'latency': latency, 'enrich_workers': enrich_workers,
+                             'queue_size': queue_size, 'discord_rate_limit': discord_rate_limit,
+                             'region_file': region_file},
+                'results': results,
+            }, fp, indent=2)
+        print(f'Saved results to {output}')
+
+    # Stage threads are blocked in ZMQ and HTTP calls, exit without waiting for them
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
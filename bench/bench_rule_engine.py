@@ -0,0 +1,86 @@
+'''
+    Benchmark matching killmails against channel rules.
+
+    Builds a mix of region, solar system, ship type, alliance and attacker count rules, then compares the killmails
+    per second matched through the RuleEngine indexes with checking every rule in turn. Both must find the same
+    matches.
+
+    Run from the repository root:
+        python -m bench.bench_rule_engine --rules 500 --killmails 5000
+'''
+
+import random
+import time
+
+import click
+
+from bench.bench_killmail_codec import make_killmails
+from tools.redisq_cache import to_timestamp
+from tools.rule_engine import Rule, RuleEngine
+
+
+# Synthetic regions of 75 solar systems, matching the solar system ids of make_killmails()
+def region_lookup(solar_system_id):
+    return 10000001 + (solar_system_id - 30000001) // 75
+
+def make_rules(count, killmails, seed=1):
+    rng = random.Random(seed)
+    ship_types = sorted({x['victim']['ship_type_id'] for x in killmails})
+    alliances = sorted({a['alliance_id'] for x in killmails for a in x['attackers']})
+    rules = []
+    for i in range(count):
+        kind = i % 5
+        rule = Rule(f'rule {i}', webhook=f'webhook {i % 50}', max_age=None)
+        if kind == 0:
+            rule.regions = set(rng.sample(range(10000001, 10000068), rng.randint(1, 4)))
+        elif kind == 1:
+            rule.systems = set(rng.sample(range(30000001, 30005001), rng.randint(1, 30)))
+        elif kind == 2:
+            rule.ship_types = set(rng.sample(ship_types, rng.randint(1, 10)))
+            rule.regions = set(rng.sample(range(10000001, 10000068), 10))
+        elif kind == 3:
+            rule.alliances = set(rng.sample(alliances, rng.randint(1, 3)))
+        else:
+            rule.regions = {rng.randint(10000001, 10000067)}
+            rule.min_attackers = rng.randint(5, 30)
+        rules.append(rule)
+    return rules
+
+def run_linear(rules, killmails, now):
+    matches = 0
+    start = time.perf_counter()
+    for killmail in killmails:
+        region_id = region_lookup(killmail['solar_system_id'])
+        entities = [killmail['victim']] + killmail['attackers']
+        alliances = {x['alliance_id'] for x in entities if x.get('alliance_id')}
+        age = now - to_timestamp(killmail['killmail_time'])
+        matches += sum(1 for x in rules if x.matches(killmail, region_id, alliances, age))
+    return matches, time.perf_counter() - start
+
+def run_indexed(engine, killmails, now):
+    matches = 0
+    start = time.perf_counter()
+    for killmail in killmails:
+        matches += len(engine.match(killmail, now))
+    return matches, time.perf_counter() - start
+
+@click.command()
+@click.option('--rules', 'rule_count', default=500, help='Channel rules')
+@click.option('--killmails', 'count', default=5000, help='Killmails to match')
+def main(rule_count, count):
+    killmails = [x[2] for x in make_killmails(count)]
+    rules = make_rules(rule_count, killmails)
+    engine = RuleEngine(rules, region_lookup)
+    now = max(to_timestamp(x['killmail_time']) for x in killmails)
+    indexed = sum(len(x) for x in [engine.by_system, engine.by_ship_type, engine.by_alliance, engine.by_region])
+    print(f'{rule_count} rules, {indexed} index keys, {len(engine.unindexed)} unindexed, {count} killmails\n')
+
+    print(f'{"matching":10} {"matches":>8} {"km/s":>10}')
+    for name, run in [('linear', lambda: run_linear(rules, killmails, now)),
+                      ('indexed', lambda: run_indexed(engine, killmails, now))]:
+        matches, seconds = run()
+        print(f'{name:10} {matches:8} {count / seconds:10.0f}')
+
+
+if __name__ == '__main__':
+    main()
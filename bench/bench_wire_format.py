@@ -0,0 +1,78 @@
+'''
+    Benchmark the killmail broadcast wire formats.
+
+    Compares, per killmail, the bytes sent and the time a subscriber spends decoding for:
+        legacy              - '<topic> <json>' with every name, and string keys turned back into integers
+        multipart           - [topic, header, msgpack body] with every name
+        multipart, deltas   - names already published are left out, the subscriber fills them from its NameTable
+    Killmails reuse attackers from a limited pool, as pilots do in a real fight.
+
+    Run from the repository root:
+        python -m bench.bench_wire_format --killmails 5000
+'''
+
+import time
+
+import click
+
+from bench.bench_killmail_codec import make_killmails
+from tools import zkb_wire
+from tools.zkb_names import NameTable
+
+
+def make_names(killmail):
+    entities = [killmail['victim']] + killmail['attackers']
+    return {
+        'character_ids': {0: '', **{x['character_id']: f'Character {x["character_id"]}' for x in entities}},
+        'corporation_ids': {0: '', **{x['corporation_id']: f'Corporation {x["corporation_id"]}' for x in entities}},
+        'alliance_ids': {0: '', **{x['alliance_id']: f'Alliance {x["alliance_id"]}' for x in entities}},
+    }
+
+def run_legacy(messages):
+    encoded = [zkb_wire.encode_legacy('zkb.r1.s1.t1.', data) for data in messages]
+    start = time.perf_counter()
+    for message in encoded:
+        zkb_wire.decode_legacy(message)
+    return sum(len(x.encode('utf-8')) for x in encoded), time.perf_counter() - start
+
+def run_multipart(messages):
+    encoded = [zkb_wire.encode_multipart('zkm.r1.s1.t1.', data) for data in messages]
+    start = time.perf_counter()
+    for frames in encoded:
+        zkb_wire.decode_multipart(frames)
+    return sum(sum(len(x) for x in frames) for frames in encoded), time.perf_counter() - start
+
+def run_deltas(messages):
+    published = NameTable()
+    encoded = []
+    for data in messages:
+        new_names = published.update(data['names'])
+        if any(new_names.values()):
+            encoded.append(zkb_wire.encode_names(new_names))
+        encoded.append(zkb_wire.encode_multipart('zkm.r1.s1.t1.', {'killmail': data['killmail'], 'names': new_names},
+                                                 flags=zkb_wire.FLAG_NAMES_DELTA))
+
+    names = NameTable()
+    start = time.perf_counter()
+    for frames in encoded:
+        topic, header, data = zkb_wire.decode_multipart(frames)
+        names.update(data['names'])
+        if header.flags & zkb_wire.FLAG_NAMES_DELTA:
+            data['names'] = names.names_for_killmail(data['killmail'])
+    return sum(sum(len(x) for x in frames) for frames in encoded), time.perf_counter() - start
+
+@click.command()
+@click.option('--killmails', 'count', default=5000, help='Killmails to broadcast')
+def main(count):
+    messages = [{'killmail': killmail, 'names': make_names(killmail)} for _, _, killmail in make_killmails(count)]
+    print(f'{count} killmails, average {sum(len(x["killmail"]["attackers"]) for x in messages) / count:.1f} attackers'
+          f', msgpack {"installed" if zkb_wire.msgpack is not None else "not installed, json bodies"}\n')
+
+    print(f'{"format":20} {"bytes/km":>9} {"decode/s":>10}')
+    for name, run in [('legacy', run_legacy), ('multipart', run_multipart), ('multipart, deltas', run_deltas)]:
+        total_bytes, seconds = run(messages)
+        print(f'{name:20} {total_bytes // count:9} {count / seconds:10.0f}')
+
+
+if __name__ == '__main__':
+    main()
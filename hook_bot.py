@@ -1,42 +1,54 @@
 '''
     Create a Discord Hook Bot
     Subscribe to ZMQ server
-    Parse killmails and broadcast to Discord channel
+    Parse killmails and broadcast to the Discord channels whose rules they match
+
+    Channels and their rules are read from data/hook_rules.json, see tools/rule_engine.py and
+    data/hook_rules.example.json. Without that file, killmails in WATCH_REGIONS from the last 45 minutes are posted
+    to the webhook configured below.
 '''
 
-from discord import Webhook, RequestsWebhookAdapter
-import zmq
-import json
-from tools.lookup_eve_static_dump import LookupEveStaticDump, LookupEveStaticDumpException
+import os
+import time
+
+import click
+from tools import metrics
+from tools.discord_delivery import DiscordDelivery
+from tools.redisq_cache import to_timestamp
+from tools.lookup_eve_static_dump import LookupEveStaticDump
+from tools.solarsystem_table import SolarSystemTable
+from tools.rule_engine import Rule, RuleEngine, RuleEngineException
+from tools.zkb_subscriber import ZKBSubscriber
+from tools.zkb_wire import ZKBWireException
 
 from dateutil.parser import parse as dateutil_parser
-from datetime import datetime, timedelta
-import pytz
 
-from data.eve_type_ids import WATCH_REGIONS, HOME_SYSTEM_ID
+from data.eve_type_ids import WATCH_REGIONS
 
 
 # Discord Secrets
 # Generate an ID / Token here: http://discordapp.com/developers/applications/me
-# Place your values in these two variables
+# Place your values in these two variables, they are used when there is no rules file
 
 discord_webhook_id = 123456789  # <-- change to your id
 discord_webhook_token = '---> put your token here <---'
 
+# 'multipart', or 'legacy' while the listener is older than the multipart wire format
+wire_format = 'multipart'
 
-# Eve static lookup
-lookup = LookupEveStaticDump()
+# Position of the last killmail handled, to catch up on killmails broadcast while the bot was not running
+position_path = 'cache/hook_bot_position.json'
 
-# Start the webhook bot
-webhook = Webhook.partial(discord_webhook_id, discord_webhook_token, adapter=RequestsWebhookAdapter())
-webhook.send('Now Online')
-print('Hookbot online')
+# Channels and the killmails posted to them
+rules_path = 'data/hook_rules.json'
 
-# Start the message queue and subscribe to the 'zkb' topic
-context = zmq.Context()
-socket = context.socket(zmq.SUB)
-socket.connect("tcp://127.0.0.1:7272")
-socket.setsockopt_string(zmq.SUBSCRIBE, 'zkb')
+# Latency of each step of the receive loop and lag of killmails from killmail_time, see tools/metrics.py
+STAGE_SECONDS = {x: metrics.histogram('hook_stage_seconds', 'Seconds spent in each hook_bot step', stage=x)
+                 for x in ('match', 'format', 'queue')}
+LAG_SECONDS = metrics.histogram('hook_lag_seconds', 'Seconds from killmail_time', metrics.LAG_BUCKETS,
+                                point='received')
+KILLMAILS = {x: metrics.counter('hook_killmails_total', 'Killmails received and matched', result=x)
+             for x in ('received', 'matched', 'invalid')}
 
 '''
     Extract specified id from a killmail entity
@@ -85,58 +97,21 @@ def get_alliance_name(entity, names):
         return ''
 
 '''
-    The json module loads integer dictionary keys as strings.
-    { 10000: 'foo' } becomes { '10000': 'foo' }
-    Convert the string keys in a dictionary to integer keys.
+    Build the Discord message for a killmail
 '''
-def dict_string_keys_to_int(d):
-    return {int(k):v for k,v in d.items()}
-
-
-########################
-# Main loop
-
-while True:
-    # Receive json_killmails from the message queue, discard the topic
-    raw_message = socket.recv_string()
-    topic, data = raw_message.split(' ', 1)
-
-
-    # Convert the json, if invalid discard this killmail
-    try:
-        message_dict = json.loads(data)
-
-    except json.decoder.JSONDecodeError as e:
-        print(f'JSON error for killmail - [{e}]')
-        continue
-
-    # Extract the data we received from the server
-    killmail = message_dict['killmail']
-
-    region_id = lookup.get_solarsystem_region(killmail['solar_system_id'])
-    if region_id not in WATCH_REGIONS:
-        continue
-
-
+def format_killmail(killmail, names, solarsystem, lookup):
     # Time
-    killmail_time = dateutil_parser(killmail['killmail_time'])
-    oldest_date = datetime.now() - timedelta(minutes=45)
-    oldest_date = pytz.utc.localize(oldest_date)
-    if killmail_time < oldest_date:
-        print(f'Too old {killmail_time} < {oldest_date}')
-        continue
-    time_string = f'{killmail_time.year}-{killmail_time.month:02}-{killmail_time.day:02} {killmail_time.hour:02}:{killmail_time.minute:02}'
-
-    names = message_dict['names']
-    names['character_ids'] = dict_string_keys_to_int(names['character_ids'])
-    names['corporation_ids'] = dict_string_keys_to_int(names['corporation_ids'])
-    names['alliance_ids'] = dict_string_keys_to_int(names['alliance_ids'])
+    try:
+        killmail_time = dateutil_parser(killmail['killmail_time'])
+        time_string = f'{killmail_time.year}-{killmail_time.month:02}-{killmail_time.day:02} ' \
+                      f'{killmail_time.hour:02}:{killmail_time.minute:02}'
+    except (KeyError, TypeError, ValueError, OverflowError):
+        time_string = '????-??-?? ??:??'
 
     # Eve static data dump lookups
     killmail_id = killmail['killmail_id']
-    solar_system_id = killmail['solar_system_id']
-    solar_system_name = lookup.get_solarsystem_name(solar_system_id)
-    region_name = lookup.get_region_name(region_id)
+    solar_system_name = solarsystem.name
+    region_name = solarsystem.region_name
     ship_name = lookup.get_type_name(killmail['victim']['ship_type_id'])
 
 
@@ -197,18 +172,122 @@ while True:
             faction_str += ' | '
         faction_str += corporation_str
 
-    try:
-        route = lookup.find_route(HOME_SYSTEM_ID, solar_system_id)
-        jumps_from_home = len(route)
-    except LookupEveStaticDumpException as e:
-        print(f'error finding route between {HOME_SYSTEM_ID} and {solar_system_id} - [{e}]')
-        jumps_from_home = -1
+    # -1 when there is no stargate route from home
+    jumps_from_home = solarsystem.jumps_from_home
 
     msg = (f'{killmail_id} [{time_string} / {region_name} / {solar_system_name} / {jumps_from_home} jumps]   '
             f'[{victim_str} - {ship_name:.20}]  -  '
             f'[Attackers: {attacker_count}    '
             f'{faction_str}]')
+    return msg
+
+
+'''
+    Load the channel rules, or a single rule for WATCH_REGIONS posting to the configured webhook
+'''
+def load_rules(path, lookup, solarsystems):
+    if os.path.exists(path):
+        return RuleEngine.from_file(path, solarsystems.get_region_id, lookup.get_universe_graph())
+    print(f'No rules in {path}, posting killmails in the watched regions to the configured webhook')
+    rule = Rule('watch regions', regions=set(WATCH_REGIONS), max_age=45 * 60)
+    return RuleEngine([rule], solarsystems.get_region_id)
+
+# Webhook url of a rule, None is the webhook configured at the top of this file
+def get_webhook_url(url):
+    if url is None:
+        return f'https://discord.com/api/webhooks/{discord_webhook_id}/{discord_webhook_token}'
+    return url
+
+
+########################
+# Main loop
+
+@click.command()
+@click.option('--rules', 'path', default=rules_path, help='Channel rules, see data/hook_rules.example.json')
+@click.option('--metrics-port', default=0, help='Serve latency metrics for Prometheus on this port, 0 to disable')
+@click.option('--metrics-file', default=None, help='Write a json snapshot of the metrics to this file every minute')
+def main(path, metrics_port, metrics_file):
+    # Eve static lookup, solar system data is resolved once into an in-memory table
+    lookup = LookupEveStaticDump()
+    solarsystems = SolarSystemTable.load_or_build(lookup)
+    print(f'Loaded {len(solarsystems)} solar systems')
+
+    try:
+        rules = load_rules(path, lookup, solarsystems)
+    except RuleEngineException as e:
+        print(f'Could not load rules - [{e}]')
+        return
+    print(f'Loaded {len(rules)} rules')
+
+    # Start the webhook bot. Messages are posted by a delivery thread per channel, so a slow or rate limited channel
+    # never holds up receiving killmails.
+    delivery = DiscordDelivery()
+    for url in dict.fromkeys(get_webhook_url(x.webhook) for x in rules.rules):
+        delivery.send(url, 'Now Online')
+    print('Hookbot online')
+
+    # Start the message queue and subscribe to the regions rules can match, ZMQ drops killmails from other regions
+    subscriber = ZKBSubscriber(region_ids=rules.get_region_ids(), wire_format=wire_format,
+                               resume=ZKBSubscriber.load_position(position_path))
+    # A listener started with --enrich-policy interest only resolves names for killmails some rule can match
+    subscriber.register_interest([x.to_config() for x in rules.rules])
+
+    exposition = metrics.start_exposition(metrics_port, metrics_file)
+    try:
+        receive_loop(subscriber, rules, solarsystems, lookup, delivery)
+    except KeyboardInterrupt:
+        print('Delivering queued messages...')
+        delivery.close()
+        print(delivery.get_stats())
+        for x in exposition:
+            x.stop()
+
+
+def receive_loop(subscriber, rules, solarsystems, lookup, delivery):
+    while True:
+        # The previous killmail has been handled or skipped
+        subscriber.save_position(position_path)
+
+        # Receive killmails from the message queue, if invalid discard this killmail
+        try:
+            message_dict = subscriber.recv().data
+        except ZKBWireException as e:
+            KILLMAILS['invalid'].inc()
+            print(f'Invalid message for killmail - [{e}]')
+            continue
+
+        # Extract the data we received from the server
+        killmail = message_dict['killmail']
+        # A killmail without a readable killmail_time is still matched, only its lag is not measured
+        try:
+            killmail_timestamp = to_timestamp(killmail['killmail_time'])
+        except (KeyError, TypeError, ValueError):
+            killmail_timestamp = None
+        if killmail_timestamp is not None:
+            metrics.observe_lag(LAG_SECONDS, killmail_timestamp)
+        KILLMAILS['received'].inc()
+
+        # Only the rules indexed under this killmail's system, ship, alliances and region are checked
+        start = time.perf_counter()
+        matched = rules.match(killmail, killmail_timestamp=killmail_timestamp)
+        solarsystem = solarsystems.get(killmail['solar_system_id'])
+        matched_at = time.perf_counter()
+        STAGE_SECONDS['match'].observe(matched_at - start)
+        if not matched or solarsystem is None:
+            continue
+        KILLMAILS['matched'].inc()
+
+        # Names of ships, systems and regions come from the static data dump
+        msg = format_killmail(killmail, message_dict['names'], solarsystem, lookup)
+        formatted_at = time.perf_counter()
+        STAGE_SECONDS['format'].observe(formatted_at - matched_at)
+
+        # Post once to each channel, even when several of its rules match
+        for url in dict.fromkeys(get_webhook_url(x.webhook) for x in matched):
+            delivery.send(url, msg, since=killmail_timestamp)
+        STAGE_SECONDS['queue'].observe(time.perf_counter() - formatted_at)
+        print(msg)
 
 
-    webhook.send(msg)
-    print(msg)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
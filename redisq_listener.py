@@ -8,9 +8,26 @@ import click
 import requests
 import time
 import json
+import heapq
+import queue
+import threading
 import zmq
-from tools import lookup_esi_names
-from tools.redisq_cache import RedisqCache, RedisqCacheException
+from tools.name_resolver import NameResolver
+from tools.redisq_cache import RedisqCache, RedisqCacheException, KillmailWriter, to_timestamp
+from tools.esi_bulk_names import EsiBulkNames
+from tools.lookup_eve_static_dump import LookupEveStaticDump
+from tools.solarsystem_table import SolarSystemTable, SolarSystemTableException
+from tools.zkb_topics import KillmailTopics, WIRE_TOPIC_ROOT, parse_topic
+from tools import zkb_wire
+from tools.zkb_control import ControlServer, DEFAULT_CONTROL_BIND
+from tools.zkb_names import NameTable
+from tools.zkb_recent import RecentKillmails
+from tools.zkb_interest import InterestTable
+from tools.zkb_backfill import Backfill
+from tools.replay_cache import ReplayCache, ReplayCacheException
+from tools.http_client import HttpClient
+from tools.zkb_dedup import SeenKillmails
+from tools import metrics
 
 from esipy import EsiApp
 from esipy.cache import FileCache
@@ -20,42 +37,52 @@ from esipy import EsiClient
 from data.eve_type_ids import REGION_VENAL
 
 
+# Latency of each stage and lag of killmails from killmail_time, see tools/metrics.py. The archive commits and ESI
+# requests are timed by KillmailWriter and NameResolver under the same name.
+STAGE_SECONDS = {x: metrics.histogram('zkb_stage_seconds', 'Seconds spent in each listener stage', stage=x)
+                 for x in ('fetch', 'persist', 'enrich', 'static_lookup', 'publish')}
+LAG_SECONDS = {x: metrics.histogram('zkb_lag_seconds', 'Seconds from killmail_time', metrics.LAG_BUCKETS, point=x)
+               for x in ('fetched', 'published')}
+STAGE_KILLMAILS = {x: metrics.counter('zkb_killmails_total', 'Killmails that passed each stage', stage=x)
+                   for x in ('fetched', 'persisted', 'enriched', 'names_skipped', 'published')}
+FETCH_ERRORS = metrics.counter('zkb_fetch_errors_total', 'Failed RedisQ requests')
+DUPLICATES = metrics.counter('zkb_duplicate_killmails_total', 'Killmails already received from another queue id')
 
 # ###################################################################################################
 # Main class
 class ZKBRedisQError(Exception):
     '''Raise whenever ZKillRedisQ encounters invalid data in kms'''
 
-class ZKBRedisQ(object):
-    def __init__(self, session_id='KM52APP84'):
+class RedisqPoller(object):
+    '''
+        Polls RedisQ with a queue id of its own. Every queue id receives every killmail, see tools/zkb_dedup.py.
+        http is the HttpClient RedisQ is polled with, a new one when None.
+    '''
+    REDISQ_URL = 'https://redisq.zkillboard.com/listen.php'
+    DEFAULT_QUEUE_ID = 'KM52APP84'
+
+    def __init__(self, session_id=DEFAULT_QUEUE_ID, redisq_url=REDISQ_URL, http=None):
         self.session_id = session_id
+        self.redisq_url = redisq_url
         self.short_fail_count = 0
         self.long_fail_count = 0
         self.very_long_fail_count = 0
-        self.cache_killmails = RedisqCache()
-        self.create_zmq_server()
-
-    '''
-        Setup a ZMQ server using the Publisher / Subscriber model
-    '''
-    def create_zmq_server(self):
-        self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.PUB)
-        self.socket.bind('tcp://*:7272')
-        self.zmq_topic = 'zkb'
+        # Keeps the RedisQ connection open between long polls
+        self.http = http if http is not None else HttpClient()
 
     '''
         Fetch the next killmail from zkillboard's RedisQ server.
         The request will block up to 10 seconds and either return a killmail or 'None' if no killmail occurred in the
         last 10 seconds.
         Return is the killmail JSON, which is removed from the RedisQ 'package' container.
-        The ESI hash of the killmail will be added to each killmail using the key 'hash'. This is the only modification
-        that is made to JSON received from zkillboard RedisQ
+        The ESI hash of the killmail will be added to each killmail using the key 'hash', and zkillboard's metadata
+        (hash, totalValue, points, ...) using the key 'zkb'. These are the only modifications that are made to JSON
+        received from zkillboard RedisQ
     '''
     def get_next_redisq(self, session_id='KM52APP84'):
-        target_url = f'https://redisq.zkillboard.com/listen.php?queueID={session_id}'
+        target_url = f'{self.redisq_url}?queueID={session_id}'
         try:
-            resp = requests.get(target_url, timeout=30.0)
+            resp = self.http.get(target_url)
             if resp.status_code != 200:
                 raise ZKBRedisQError(f'Status code not 200 for {target_url}')
         except requests.exceptions.Timeout:
@@ -68,6 +95,7 @@ class ZKBRedisQ(object):
             # No killmail will return None
             try:
                 data['package']['killmail']['hash'] = data['package']['zkb']['hash']
+                data['package']['killmail']['zkb'] = data['package']['zkb']
             except (KeyError, TypeError):
                 return None
             return data['package']['killmail']
@@ -76,46 +104,325 @@ class ZKBRedisQ(object):
 
 
     '''
-        Main loop: 
-            Fetch killmails
-            Use ESI to lookup all character, corporation, and alliance IDs
-            Save the killmail to sqlite
-            Broadcast to ZMQ subscribers a dictionary containing the killmail and a dictionary of names
+        Called when fetching from RedisQ fails. Sleeps for longer and longer the more failures happen in a row.
     '''
-    def main_loop(self):
-        print('--- Redisq Listener running ---')
-        # Main loop
-        while True:
+    def handle_fetch_failure(self, e):
+        self.short_fail_count += 1  # A short term failure has occured
+        if self.short_fail_count < 3:
+            # If we haven't had too many short terms, wait a few seconds and try again
+            print(f'   xxx Short term failure {self.short_fail_count}, sleeping 5 seconds... [{e}]')
+            time.sleep(1.0 * 5.0)  # 5 seconds
+        elif self.long_fail_count < 3:
+            # If we have had too many short terms but not a lot of long terms, wait a longer amount of time
+            self.short_fail_count = 0  # Reset short term fail count
+            self.long_fail_count += 1  # We are having one more long term wait
+            print(f'   xxx Long term failure {self.long_fail_count}, sleeping 60 seconds... [{e}]')
+            time.sleep(1.0 * 60.0)  # 1 minute
+        else:
+            # We have had too many short and long term errors, wait avery long time.
+            self.short_fail_count = 0  # Reset the short
+            self.long_fail_count = 0  # Reset the long
+            self.very_long_fail_count += 1  # Increment our very long fail counter
+            print(f'   xxx Very long term failure {self.very_long_fail_count}, sleeping 5 minutes... [{e}]')
+            time.sleep(1.0 * 60.0 * 5.0)  # 5 minutes
+        print(f'   xxx ...done sleeping.')
+
+
+class ZKBRedisQ(RedisqPoller):
+    '''
+        esi_names selects how names missing from the name cache are fetched from ESI:
+            'bulk'          - one POST /universe/names/ request per 1000 unique ids
+            'individual'    - one GET request per id through esipy
+        enrich_workers is the number of threads resolving names concurrently.
+        queue_size bounds each queue between pipeline stages.
+        Killmails are committed to sqlite commit_batch at a time, or at least every commit_interval seconds.
+        compression selects how killmails are stored in the archive, see RedisqCache.
+        wire_format selects the broadcast format, see tools/zkb_wire.py:
+            'auto'          - each format is published while at least one subscriber is subscribed to it
+            'legacy'        - '<topic> <json>' single frame messages only
+            'multipart'     - [topic, header, body] messages only
+            'both'          - always publish both
+        recent_kills is the number of broadcast killmails kept in memory for subscribers catching up after a restart.
+        send_hwm is the number of messages ZMQ queues for each subscriber before it drops messages to that subscriber.
+        enrich_policy selects the killmails names are resolved for before they are broadcast:
+            'all'           - every killmail
+            'interest'      - killmails matching an interest registered by a subscriber, see tools/zkb_interest.py.
+                              Names of the others are resolved when a subscriber asks for them.
+        redisq_url, publish_bind, control_bind and archive_path point the listener at other servers, ports and
+        databases, such as the local stand-ins of bench/bench_pipeline.py.
+        ingest_bind is where ShardFetcher processes push the killmails of their own queue ids, None to only fetch with
+        session_id. dedup_size is the number of recent killmail ids remembered, see tools/zkb_dedup.py.
+    '''
+    DEFAULT_SEND_HWM = 1000
+    PUBLISH_BIND = 'tcp://*:7272'
+
+    def __init__(self, session_id=RedisqPoller.DEFAULT_QUEUE_ID, esi_names='bulk', enrich_workers=4, queue_size=100,
+                 commit_batch=100, commit_interval=0.5, compression='auto', wire_format='auto',
+                 recent_kills=RecentKillmails.DEFAULT_SIZE, send_hwm=DEFAULT_SEND_HWM, enrich_policy='all',
+                 redisq_url=RedisqPoller.REDISQ_URL, publish_bind=PUBLISH_BIND, control_bind=DEFAULT_CONTROL_BIND,
+                 archive_path=RedisqCache.DEFAULT_PATH, http=None, ingest_bind=None,
+                 dedup_size=SeenKillmails.DEFAULT_SIZE):
+        super().__init__(session_id, redisq_url, http)
+        self.solarsystems = load_solarsystems()
+        self.cache_killmails = RedisqCache(archive_path, region_lookup=get_region_lookup(self.solarsystems),
+                                           compression=compression)
+        if esi_names == 'individual':
+            from tools import lookup_esi_names
+            self.name_resolver = NameResolver(self.cache_killmails, fetch_names=lookup_esi_names.bulk_lookup_names)
+        else:
+            self.name_resolver = NameResolver(self.cache_killmails)
+        self.enrich_policy = enrich_policy
+        self.interests = InterestTable(get_region_lookup(self.solarsystems))
+        self.create_zmq_server(wire_format, recent_kills, send_hwm, publish_bind, control_bind)
+        self.create_pipeline(enrich_workers, queue_size)
+        self.create_ingest(ingest_bind, dedup_size)
+        self.killmail_writer = KillmailWriter(self.cache_killmails, commit_batch, commit_interval)
+
+    '''
+        Create the queues connecting the pipeline stages
+    '''
+    def create_pipeline(self, enrich_workers, queue_size):
+        self.enrich_workers = max(1, enrich_workers)
+        self.queue_size = queue_size
+        self.persist_queue = queue.Queue(maxsize=queue_size)
+        self.enrich_queue = queue.Queue(maxsize=queue_size)
+        self.publish_queue = queue.Queue(maxsize=queue_size)
+        self.reorder_buffer = []
+        self.stop_event = threading.Event()
+        self.stage_counts = {'fetched': 0, 'persisted': 0, 'enriched': 0, 'names_skipped': 0, 'published': 0}
+        self.stage_counts_lock = threading.Lock()
+
+    '''
+        Admission of killmails from every source. Each source polls RedisQ with a queue id of its own and receives
+        every killmail, so killmails keep arriving while any one source is up. Each killmail id is admitted once.
+    '''
+    def create_ingest(self, ingest_bind, dedup_size):
+        self.seen_killmails = SeenKillmails(dedup_size, self.cache_killmails)
+        self.sequence = 0
+        self.admit_lock = threading.Lock()
+        # { source: {'killmails', 'duplicates', 'last_seen'} }, last_seen is a monotonic time
+        self.sources = {}
+        self.ingest_socket = None
+        if ingest_bind is not None:
+            self.ingest_socket = self.context.socket(zmq.PULL)
+            self.ingest_socket.setsockopt(zmq.RCVHWM, self.queue_size * 10)
+            self.ingest_socket.bind(ingest_bind)
+
+    # A source polled RedisQ and received nothing, it is still up
+    def heartbeat(self, source):
+        with self.admit_lock:
+            self._source(source)['last_seen'] = time.monotonic()
+
+    def _source(self, source):
+        state = self.sources.get(source)
+        if state is None:
+            state = self.sources[source] = {'killmails': 0, 'duplicates': 0, 'last_seen': time.monotonic()}
+            print(f'--- Killmail source {source} connected')
+        return state
+
+    '''
+        Number a killmail and pass it on, unless another source delivered it first. Returns True when admitted.
+        Only the numbering holds admit_lock. The fetch and ingest threads can queue killmails out of order, the
+        publish stage puts them back in order.
+    '''
+    def admit(self, source, kill_id, killmail):
+        admitted = self.seen_killmails.add(kill_id)
+        with self.admit_lock:
+            state = self._source(source)
+            state['last_seen'] = time.monotonic()
+            if not admitted:
+                state['duplicates'] += 1
+            else:
+                state['killmails'] += 1
+                self.sequence += 1
+                sequence = self.sequence
+        if not admitted:
+            DUPLICATES.inc()
+            return False
+        self.count_stage('fetched')
+        observe_killmail_lag(LAG_SECONDS['fetched'], killmail)
+        # Blocks while the persist queue is full, every other admission and the stats keep going
+        self.persist_queue.put((sequence, kill_id, killmail))
+        return True
+
+    def count_stage(self, stage):
+        with self.stage_counts_lock:
+            self.stage_counts[stage] += 1
+        STAGE_KILLMAILS[stage].inc()
+
+    def get_stage_counts(self):
+        with self.stage_counts_lock:
+            return dict(self.stage_counts)
+
+    '''
+        Setup a ZMQ server using the Publisher / Subscriber model.
+        XPUB works like PUB, but also reports which prefixes subscribers are subscribed to.
+    '''
+    def create_zmq_server(self, wire_format='auto', recent_kills=RecentKillmails.DEFAULT_SIZE,
+                          send_hwm=DEFAULT_SEND_HWM, publish_bind=PUBLISH_BIND, control_bind=DEFAULT_CONTROL_BIND):
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.XPUB)
+        self.send_hwm = send_hwm
+        self.socket.setsockopt(zmq.SNDHWM, send_hwm)
+        self.socket.bind(publish_bind)
+        # Killmails are published under zkb.r<region>.s<system>.t<ship group>. so subscribers can filter by prefix,
+        # see tools/zkb_topics.py. A 'zkb' subscription receives everything.
+        self.topics = KillmailTopics(get_region_lookup(self.solarsystems), load_groups_lookup())
+        self.wire_format = wire_format
+        self.subscription_formats = zkb_wire.SubscriptionFormats()
+        # Lets subscribers tell a restarted listener from missed messages
+        self.epoch = int(time.time())
+        # Names already sent to multipart subscribers, only new ones are sent again
+        self.published_names = NameTable()
+        self.names_sequence = 0
+        self.recent_killmails = RecentKillmails(self.epoch, recent_kills)
+        # Sequence of the last killmail broadcast, overall and by region, for the region previous header field
+        self.last_sequence = 0
+        self.region_sequences = {}
+        self.replay_stats = {'requests': 0, 'memory': 0, 'archive': 0}
+        self.control_server = ControlServer({'names': self.control_names, 'since': self.control_since,
+                                             'replay': self.control_replay, 'stats': self.control_stats,
+                                             'interest': self.control_interest},
+                                            bind=control_bind, context=self.context)
+
+    '''
+        Control command 'names', see tools/zkb_control.py
+    '''
+    def control_names(self, arguments):
+        sequence = self.names_sequence
+        ids = arguments.get('ids')
+        if ids:
+            requested = [ids.get(key, []) for key in zkb_wire.NAME_KEYS]
+            names = self.published_names.lookup(*requested)
+            # Names of killmails broadcast without names are resolved now
+            missing = [[x for x in requested[i] if x not in names[key]] for i, key in enumerate(zkb_wire.NAME_KEYS)]
+            if any(missing):
+                resolved = self.name_resolver.resolve(*missing)
+                for key in zkb_wire.NAME_KEYS:
+                    names[key].update(resolved.get(key, {}))
+        else:
+            names = self.published_names.snapshot()
+        return {'epoch': self.epoch, 'sequence': sequence, 'names': names}
+
+    '''
+        Control command 'since', see tools/zkb_control.py
+    '''
+    def control_since(self, arguments):
+        limit = min(arguments.get('limit', RecentKillmails.PAGE_SIZE), RecentKillmails.PAGE_SIZE)
+        return self.recent_killmails.since(arguments.get('epoch', 0), arguments.get('sequence', 0),
+                                           arguments.get('region_ids'), limit)
+
+    '''
+        Control command 'replay', see tools/zkb_control.py
+        Killmails still in memory are answered from there, older ones and those of earlier epochs from the archive.
+    '''
+    def control_replay(self, arguments):
+        epoch = arguments.get('epoch', self.epoch)
+        after = arguments.get('after', 0)
+        until = arguments.get('until')
+        region_ids = arguments.get('region_ids')
+        limit = min(arguments.get('limit', RecentKillmails.PAGE_SIZE), RecentKillmails.PAGE_SIZE)
+        self.replay_stats['requests'] += 1
+
+        memory = None
+        if epoch == self.epoch:
+            memory = self.recent_killmails.since(epoch, after, region_ids, limit, until)
+            memory['messages'] = [[sequence, topic, self.get_replay_data(data['killmail'], data)]
+                                  for sequence, topic, data in memory['messages']]
+            if not memory['missed']:
+                self.replay_stats['memory'] += len(memory['messages'])
+                return {'epoch': epoch, 'listener_epoch': self.epoch, 'more': memory['more'],
+                        'messages': memory['messages']}
+
+        try:
+            rows = self.cache_killmails.lookup_broadcasts(epoch, after, until, region_ids, limit + 1)
+        except RedisqCacheException as e:
+            raise zkb_wire.ZKBWireException(f'could not read the archive [{e}]')
+        messages = []
+        for sequence, killmail_id, killmail_string in rows[:limit]:
+            killmail = json.loads(killmail_string)
+            data = self.get_replay_data(killmail)
+            messages.append([sequence, self.topics.topic_for_killmail(killmail, WIRE_TOPIC_ROOT), data])
+        if memory is not None and not messages:
+            # Not in the archive either, at least send what is still in memory
+            self.replay_stats['memory'] += len(memory['messages'])
+            return {'epoch': epoch, 'listener_epoch': self.epoch, 'more': memory['more'],
+                    'messages': memory['messages']}
+        self.replay_stats['archive'] += len(messages)
+        # Killmails after the archived ones may still be in memory only, the next request finds them there
+        more = len(rows) > limit or (memory is not None and messages[-1][0] < memory['last_sequence'] and
+                                     (until is None or messages[-1][0] < until))
+        return {'epoch': epoch, 'listener_epoch': self.epoch, 'more': more, 'messages': messages}
+
+    '''
+        Broadcast data of a replayed killmail with every name. data is what the killmail was broadcast with when it
+        is at hand, and is used as it is when it has every name. Otherwise names already published are used, and the
+        name resolver is only asked when some are missing, such as for killmails broadcast without names.
+    '''
+    def get_replay_data(self, killmail, data=None):
+        entities = [killmail['victim']] + killmail['attackers']
+        if data is not None and all(x.get(key[:-1], 0) in data['names'].get(key, {})
+                                    for x in entities for key in zkb_wire.NAME_KEYS):
+            return data
+        if not any(self.published_names.missing_for_killmail(killmail).values()):
+            return {'killmail': killmail, 'names': self.published_names.names_for_killmail(killmail)}
+        try:
+            return {'killmail': killmail, 'names': self.name_resolver.get_names_for_killmail(killmail)}
+        except Exception as e:
+            print(f'   xxx Could not resolve names for replay of {killmail.get("killmail_id")} [{e}]')
+            return data if data is not None else {'killmail': killmail, 'names': empty_names()}
+
+    '''
+        Control command 'interest', see tools/zkb_control.py
+    '''
+    def control_interest(self, arguments):
+        subscriber_id = arguments.get('id')
+        if not subscriber_id:
+            raise zkb_wire.ZKBWireException('interest needs a subscriber id')
+        ttl = self.interests.register(subscriber_id, arguments.get('rules'),
+                                      arguments.get('ttl', InterestTable.DEFAULT_TTL))
+        return {'epoch': self.epoch, 'ttl': ttl, 'policy': self.enrich_policy, 'subscribers': len(self.interests)}
+
+    '''
+        Control command 'stats', see tools/zkb_control.py
+    '''
+    def control_stats(self, arguments):
+        return {'epoch': self.epoch, 'sequence': self.last_sequence, 'send_hwm': self.send_hwm,
+                'replay': dict(self.replay_stats), **self.get_stage_stats()}
+
+    # ##################################
+    # Pipeline stages
+    #
+    # Each stage runs in its own thread, and stages are connected by bounded queues. A full queue blocks the stage
+    # before it, so a slow stage applies back pressure instead of growing memory. Enrichment is the only stage that
+    # waits on ESI, and it runs on several worker threads.
+    #
+    #   fetch --> persist_queue --> persist --> enrich_queue --> enrich (xN) --> publish_queue --> publish
+    #                                  |
+    #                                  +--> KillmailWriter queue --> group commits to sqlite
+    #
+    # Every killmail is numbered as it is admitted. The fetch and ingest threads, and the enrichment workers, can pass
+    # killmails on out of order, so the publish stage holds finished killmails until every earlier number has been
+    # broadcast.
+
+    '''
+        Fetch killmails from RedisQ and number them in the order they were received
+    '''
+    def fetch_stage(self):
+        while not self.stop_event.is_set():
+            # Includes the long poll, up to 10 seconds when no killmail arrives
+            start = time.perf_counter()
             try:
-                killmail = self.get_next_redisq()
+                killmail = self.get_next_redisq(self.session_id)
             except ZKBRedisQError as e:
-                self.short_fail_count += 1  # A short term failure has occured
-                if self.short_fail_count < 3:
-                    # If we haven't had too many short terms, wait a few seconds and try again
-                    print(f'   xxx Short term failure {self.short_fail_count}, sleeping 5 seconds... [{e}]')
-                    time.sleep(1.0 * 5.0)  # 5 seconds
-                    print(f'   xxx ...done sleeping.')
-                    continue
-                elif self.long_fail_count < 3:
-                    # If we have had too many short terms but not a lot of long terms, wait a longer amount of time
-                    self.short_fail_count = 0  # Reset short term fail count
-                    self.long_fail_count += 1  # We are having one more long term wait
-                    print(f'   xxx Long term failure {self.long_fail_count}, sleeping 60 seconds... [{e}]')
-                    time.sleep(1.0 * 60.0)  # 1 minute
-                    print(f'   xxx ...done sleeping.')
-                    continue
-                else:
-                    # We have had too many short and long term errors, wait avery long time.
-                    short_fail_count = 0  # Reset the short
-                    long_fail_count = 0  # Reset the long
-                    self.very_long_fail_count += 1  # Increment our very long fail counter
-                    print(f'   xxx Very long term failure {self.very_long_fail_count}, sleeping 5 minutes... [{e}]')
-                    time.sleep(1.0 * 60.0 * 5.0)  # 5 minutes
-                    print(f'   xxx ...done sleeping.')
-                    continue
+                FETCH_ERRORS.inc()
+                self.handle_fetch_failure(e)
+                continue
+            STAGE_SECONDS['fetch'].observe(time.perf_counter() - start)
 
             # No message received in 10 seconds, fetch again.
             if killmail == None:
+                self.heartbeat(self.session_id)
                 continue
 
             # json_response is successful, test for needed variables
@@ -128,55 +435,395 @@ class ZKBRedisQ(object):
                 print('Empty message...')
                 continue
 
-            # Convert the killmail to a string
-            killmail_string = json.dumps(killmail)
+            self.admit(self.session_id, kill_id, killmail)
+
+    '''
+        Receive the killmails ShardFetcher processes push, [queue id, killmail json], or [queue id, b''] when their
+        poll returned no killmail
+    '''
+    def ingest_stage(self):
+        while not self.stop_event.is_set():
+            # Polls, so the stage notices stop_event within a second
+            if not self.ingest_socket.poll(1000):
+                continue
+            try:
+                frames = self.ingest_socket.recv_multipart()
+                source = frames[0].decode('utf-8')
+                killmail = json.loads(frames[1]) if frames[1] else None
+            except (IndexError, UnicodeDecodeError, ValueError) as e:
+                print(f'   xxx Invalid message from a killmail fetcher [{e}]')
+                continue
 
-            # Cache the json in sqlite
+            if killmail is None:
+                self.heartbeat(source)
+                continue
             try:
-                self.cache_killmails.insert_killmail(kill_id, killmail_string)
-            except RedisqCacheException as e:
-                print(f'   xxx sqlite error inserting killmail [{e}] - [{killmail_string}]')
+                kill_id = killmail['killmail_id']
+            except (KeyError, TypeError):
+                print(f'   xxx Killmail from {source} has no killmail_id')
+                continue
+            self.admit(source, kill_id, killmail)
+
+    '''
+        Cache the killmail json in sqlite. The killmail writer thread commits in batches, so this only blocks when
+        the writer has fallen too far behind.
+    '''
+    def persist_stage(self):
+        while True:
+            sequence, kill_id, killmail = self.persist_queue.get()
+
+            # Convert the killmail to a string, the same string is reused by the broadcast
+            start = time.perf_counter()
+            killmail_string = json.dumps(killmail)
+            self.killmail_writer.put(kill_id, killmail_string, killmail)
+            STAGE_SECONDS['persist'].observe(time.perf_counter() - start)
+            # The killmail reached the writer, main_loop waits for this before closing it
+            self.persist_queue.task_done()
+
+            self.count_stage('persisted')
+            self.enrich_queue.put((sequence, kill_id, killmail, killmail_string))
+
+    '''
+        Resolve character, corporation, and alliance names. Runs on several threads.
+    '''
+    def enrich_stage(self):
+        while True:
+            sequence, kill_id, killmail, killmail_string = self.enrich_queue.get()
 
             # Generate the ZMQ message containing the killmail and a names dictionary
+            # A killmail must always reach the publish stage, or every killmail after it would be held back
+            start = time.perf_counter()
+            try:
+                names_skipped = self.enrich_policy == 'interest' and not self.interests.wants(killmail)
+            except Exception as e:
+                # Rules can not be checked against a malformed killmail, its names are resolved as without interests
+                print(f'   xxx Could not check the interests in {kill_id} [{e}]')
+                names_skipped = False
+            if names_skipped:
+                # No subscriber registered an interest in this killmail, its names are resolved if one asks
+                names = empty_names()
+                self.count_stage('names_skipped')
+            else:
+                try:
+                    names = self.name_resolver.get_names_for_killmail(killmail)
+                except Exception as e:
+                    print(f'   xxx Could not resolve names for {kill_id} [{e}]')
+                    names = empty_names()
             data = {
                 'killmail': killmail,
-                'names': lookup_esi_names.get_names_for_killmail(killmail)
+                'names': names
             }
+            STAGE_SECONDS['enrich'].observe(time.perf_counter() - start)
 
-            # Broadcast the kill
-            try:
-                self.socket.send_string(f'{self.zmq_topic} {json.dumps(data)}')
-            except zmq.ZMQError as e:
-                print(f'   xxx When broadcasting {kill_id} got exception [{e}]')
+            self.count_stage('enriched')
+            self.publish_queue.put((sequence, kill_id, data, killmail_string, names_skipped))
+
+    '''
+        Broadcast killmails in the order they were fetched
+    '''
+    def publish_stage(self):
+        next_sequence = 1
+        while True:
+            sequence, kill_id, data, killmail_string, names_skipped = self.publish_queue.get()
+            heapq.heappush(self.reorder_buffer, (sequence, kill_id, data, killmail_string, names_skipped))
+
+            while self.reorder_buffer and self.reorder_buffer[0][0] == next_sequence:
+                _, kill_id, data, killmail_string, names_skipped = heapq.heappop(self.reorder_buffer)
+                self.broadcast(kill_id, data, sequence=next_sequence, killmail_string=killmail_string,
+                               names_skipped=names_skipped)
+                self.count_stage('published')
+                next_sequence += 1
+
+    '''
+        Wire formats to publish the next message in. Must be called from the thread that publishes, as it reads the
+        subscription messages from the XPUB socket.
+    '''
+    def get_wire_formats(self):
+        try:
+            while self.socket.poll(0):
+                self.subscription_formats.update(self.socket.recv())
+        except zmq.ZMQError as e:
+            print(f'   xxx Could not read subscriptions [{e}]')
+
+        if self.wire_format == 'auto':
+            return self.subscription_formats.formats()
+        if self.wire_format == 'both':
+            return zkb_wire.WIRE_FORMATS
+        return (self.wire_format,)
+
+    '''
+        Send one message to all ZMQ subscribers, in every wire format that is wanted.
+        killmail_string is the json of data['killmail'] when it is already serialized.
+        names_skipped is True when names were not resolved, because no subscriber registered an interest in it.
+        record is False for test data replays, their killmails are not archived and must not count as broadcast.
+    '''
+    def broadcast(self, kill_id, data, sequence=0, killmail_string=None, names_skipped=False, record=True):
+        start = time.perf_counter()
+        topic_done = start
+        try:
+            formats = self.get_wire_formats()
+            killmail = data['killmail']
+            # The ship group of the topic comes from the static data dump
+            topic = self.topics.topic_for_killmail(killmail, WIRE_TOPIC_ROOT)
+            topic_done = time.perf_counter()
+            STAGE_SECONDS['static_lookup'].observe(topic_done - start)
+            self.recent_killmails.add(sequence, topic, data)
+            region_id = parse_topic(topic)[0]
+            region_previous = self.region_sequences.get(region_id, 0)
+            self.region_sequences[region_id] = sequence
+            self.last_sequence = sequence
+            # Subscribers that dropped this killmail can have it sent again from the archive
+            if record:
+                self.killmail_writer.put_broadcast(self.epoch, sequence, kill_id)
+            if 'legacy' in formats:
+                legacy_topic = self.topics.topic_for_killmail(killmail)
+                self.socket.send_string(zkb_wire.encode_legacy(legacy_topic, data, killmail_string))
+            if 'multipart' in formats:
+                encoding = zkb_wire.default_encoding()
+
+                # Names not published before go out on the names topic first, and with this killmail
+                new_names = self.published_names.update(data['names'])
+                if any(new_names.values()):
+                    self.names_sequence += 1
+                    self.socket.send_multipart(zkb_wire.encode_names(new_names, self.epoch, self.names_sequence,
+                                                                     encoding))
 
-            # Message to console
-            print(f'Broadcasting {kill_id}')
+                flags = zkb_wire.FLAG_NAMES_DELTA
+                if names_skipped:
+                    flags |= zkb_wire.FLAG_NAMES_SKIPPED
+
+                # The json body can reuse the archived string, msgpack packs the killmail once here
+                packed_killmail = None
+                if encoding == zkb_wire.ENCODING_JSON and killmail_string is not None:
+                    packed_killmail = killmail_string.encode('utf-8')
+                self.socket.send_multipart(zkb_wire.encode_multipart(
+                    topic, {'killmail': killmail, 'names': new_names}, self.epoch, sequence, encoding,
+                    packed_killmail, flags=flags, region_previous=region_previous))
+        except zmq.ZMQError as e:
+            print(f'   xxx When broadcasting {kill_id} got exception [{e}]')
+        STAGE_SECONDS['publish'].observe(time.perf_counter() - topic_done)
+        observe_killmail_lag(LAG_SECONDS['published'], data['killmail'])
+
+        # Message to console
+        print(f'Broadcasting {kill_id}')
+
+    '''
+        Queue depths, queue capacities, and the number of killmails that have passed each stage
+    '''
+    def get_stage_stats(self):
+        queues = {
+            'persist': self.persist_queue,
+            'writer': self.killmail_writer.queue,
+            'enrich': self.enrich_queue,
+            'publish': self.publish_queue,
+        }
+        return {
+            'queues': {name: x.qsize() for name, x in queues.items()},
+            'capacity': {name: x.maxsize for name, x in queues.items()},
+            'reorder': len(self.reorder_buffer),
+            'counts': self.get_stage_counts(),
+            'http': self.http.get_stats(),
+            'dedup': self.seen_killmails.get_stats(),
+            'sources': self.get_source_stats(),
+        }
+
+    # Killmails admitted and duplicates dropped from each source, and seconds since it was last heard from
+    def get_source_stats(self):
+        now = time.monotonic()
+        with self.admit_lock:
+            return {source: {'killmails': x['killmails'], 'duplicates': x['duplicates'],
+                             'idle': round(now - x['last_seen'], 1)} for source, x in self.sources.items()}
+
+    def print_stage_stats(self):
+        stats = self.get_stage_stats()
+        queues = '  '.join(f'{name} {depth}/{stats["capacity"][name]}' for name, depth in stats['queues'].items())
+        counts = '  '.join(f'{name} {count}' for name, count in stats['counts'].items())
+        replays = self.replay_stats
+        print(f'--- queues: {queues}  reorder {stats["reorder"]}  |  {counts}  |  replayed {replays["memory"]} from '
+              f'memory, {replays["archive"]} from archive in {replays["requests"]} requests')
+        sources = '  '.join(f'{source} {x["killmails"]} new {x["duplicates"]} duplicate {x["idle"]}s idle'
+                            for source, x in stats['sources'].items())
+        if sources:
+            print(f'--- sources: {sources}')
+        for host, x in stats['http'].items():
+            print(f'--- {host}: {x["requests"]} requests on {x["connections"]} connections, {x["reused"]} reused, '
+                  f'connect {x["connect_ms"]} ms, request {x["request_ms"]} ms, {x["errors"]} errors')
+
+    # Start the thread of every pipeline stage, and the control server
+    def start(self):
+        stages = [self.fetch_stage, self.persist_stage, self.publish_stage, self.control_server.run]
+        stages += [self.enrich_stage] * self.enrich_workers
+        if self.ingest_socket is not None:
+            stages.append(self.ingest_stage)
+        # The stages admitting killmails, they stop on stop_event
+        self.source_threads = []
+        for stage in stages:
+            thread = threading.Thread(target=stage, name=stage.__name__, daemon=True)
+            thread.start()
+            if stage in (self.fetch_stage, self.ingest_stage):
+                self.source_threads.append(thread)
+
+    '''
+        Stop admitting killmails, and wait until every admitted killmail reached the killmail writer before writing
+        them out. A fetch waiting on a RedisQ long poll is given until its read timeout to finish.
+    '''
+    def stop(self):
+        self.stop_event.set()
+        print('--- Stopping killmail sources...')
+        for thread in self.source_threads:
+            thread.join(timeout=self.http.connect_timeout + self.http.read_timeout)
+            if thread.is_alive():
+                print(f'   xxx {thread.name} did not stop, a killmail it fetches now is not archived')
+        print(f'--- Archiving {self.persist_queue.qsize()} queued killmails...')
+        self.persist_queue.join()
+        print('--- Flushing killmail writer...')
+        self.killmail_writer.close()
+
+    '''
+        Main loop: 
+            Fetch killmails
+            Save the killmail to sqlite
+            Resolve all character, corporation, and alliance IDs from the name cache, using ESI only for misses
+            Broadcast to ZMQ subscribers a dictionary containing the killmail and a dictionary of names
+        Every stage runs on its own thread, this thread reports queue depths every stats_interval seconds.
+    '''
+    def main_loop(self, stats_interval=60.0):
+        print(f'--- Redisq Listener running, {self.enrich_workers} enrichment workers ---')
+        self.start()
+
+        try:
+            while True:
+                time.sleep(stats_interval if stats_interval > 0 else 60.0)
+                if stats_interval > 0:
+                    self.print_stage_stats()
+        except KeyboardInterrupt:
+            self.stop()
+            self.print_stage_stats()
 
 
     """"
         Simulate a stream of incoming killmails to test ZMQ subscribers
+        names holds the names of every id in the killmails, saved by --loaddata, so no ESI request is made.
+        Killmails are broadcast rate per second, or as fast as possible when rate is 0. With speedup, they keep the
+        spacing of their killmail_time instead, divided by speedup. killmails can be any iterable, it is read as the
+        replay goes.
     """
-    def test_data_replay(self, killmails, delay=1.0):
-        for killmail in killmails:
-            killmail_id = killmail['killmail_id']
-            print(f'Broadcasting {killmail_id}')
-            data = {
-                'killmail': killmail,
-                'names': lookup_esi_names.get_names_for_killmail(killmail)
-            }
+    def test_data_replay(self, killmails, names=None, rate=1.0, speedup=None):
+        threading.Thread(target=self.control_server.run, name='control_server', daemon=True).start()
+        table = NameTable(max_size=max(NameTable.DEFAULT_MAX_SIZE, sum(len(x) for x in (names or {}).values())))
+        table.update(names or {})
+        # Names subscribers ask for come from the same names, ESI is never asked
+        self.name_resolver = NameResolver(self.cache_killmails, fetch_names=table.lookup)
+
+        first_time = None
+        start = time.perf_counter()
+        sequence = 0
+        behind = 0.0
+        try:
+            for sequence, killmail in enumerate(killmails, 1):
+                # Killmails are due at a time from the start, so time spent broadcasting does not add up
+                if speedup:
+                    killmail_time = to_timestamp(killmail['killmail_time'])
+                    first_time = killmail_time if first_time is None else first_time
+                    # abs() paces a replay newest first the same way
+                    due = start + abs(killmail_time - first_time) / speedup
+                else:
+                    due = start + (sequence - 1) / rate if rate else start
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                else:
+                    behind = max(behind, -wait)
+
+                data = {
+                    'killmail': killmail,
+                    'names': table.names_for_killmail(killmail)
+                }
+                # Test data is not archived, recording it would make the live feed drop these killmail ids
+                self.broadcast(killmail['killmail_id'], data, sequence=sequence, record=False)
+        except KeyboardInterrupt:
+            pass
+
+        elapsed = time.perf_counter() - start
+        report = f'--- Replayed {sequence} killmails in {elapsed:.2f} seconds, ' \
+                 f'{sequence / max(elapsed, 1e-9):.1f} killmails/s'
+        if speedup or rate:
+            report += f', at most {behind:.3f} seconds behind schedule'
+        print(report)
+
+
+class ShardFetcher(RedisqPoller):
+    '''
+        Polls RedisQ with a queue id of its own and pushes every killmail to a listener started with --ingest-bind.
+        Run several, on other hosts as well, so killmails keep arriving when one of them or the listener's own
+        RedisQ connection fails. While the listener is unreachable up to send_hwm killmails are held and sent once it
+        is back, RedisQ keeps the killmails of a queue id for a while after that.
+    '''
+    DEFAULT_SEND_HWM = 10000
+
+    def __init__(self, session_id, ingest_address, redisq_url=RedisqPoller.REDISQ_URL, http=None,
+                 send_hwm=DEFAULT_SEND_HWM):
+        super().__init__(session_id, redisq_url, http)
+        self.source = session_id.encode('utf-8')
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.PUSH)
+        self.socket.setsockopt(zmq.SNDHWM, send_hwm)
+        self.socket.connect(ingest_address)
+
+    def main_loop(self):
+        print(f'--- Fetching with queue id {self.session_id} ---')
+        while True:
+            start = time.perf_counter()
             try:
-                # print(f'{self.zmq_topic} {json.dumps(data)}')
-                self.socket.send_string(f'{self.zmq_topic} {json.dumps(data)}')
-            except zmq.ZMQError as e:
-                print(f'   xxx When broadcasting {killmail_id} got exception [{e}]')
-            except json.JSONDecodeError as e:
-                print(f'   xxx Error decoding JSON [{e}] [{killmail}')
-            time.sleep(delay)
+                killmail = self.get_next_redisq(self.session_id)
+            except ZKBRedisQError as e:
+                FETCH_ERRORS.inc()
+                self.handle_fetch_failure(e)
+                continue
+            STAGE_SECONDS['fetch'].observe(time.perf_counter() - start)
+
+            if killmail is None:
+                # Tells the listener this fetcher is up, dropped rather than queued while the listener is away
+                try:
+                    self.socket.send_multipart([self.source, b''], flags=zmq.NOBLOCK)
+                except zmq.Again:
+                    pass
+                continue
+            # Blocks once send_hwm killmails wait for the listener, RedisQ holds the rest
+            self.socket.send_multipart([self.source, json.dumps(killmail).encode('utf-8')])
+            print(f'Forwarding {killmail.get("killmail_id")}')
 
 
 # ######################################################################################################
 # Utility functions
 
+# Load the per solar system table from the static data. The listener still runs without it, but killmails are
+# archived without a region.
+def load_solarsystems():
+    try:
+        return SolarSystemTable.load_or_build(LookupEveStaticDump())
+    except SolarSystemTableException as e:
+        print(f'   xxx Static data not available, killmails will be archived without regions [{e}]')
+        return None
+
+# Lag of a killmail from its killmail_time, killmails with an invalid time are left out
+def observe_killmail_lag(histogram, killmail):
+    try:
+        metrics.observe_lag(histogram, to_timestamp(killmail['killmail_time']))
+    except (KeyError, TypeError, ValueError):
+        pass
+
+# Names dictionary of a killmail whose names were not resolved
+def empty_names():
+    return {'character_ids': {0: ''}, 'corporation_ids': {0: ''}, 'alliance_ids': {0: ''}}
+
+def get_region_lookup(solarsystems):
+    return solarsystems.get_region_id if solarsystems is not None else None
+
+# Ship group lookup for topics, used from the publish thread and by replays on the control thread
+def load_groups_lookup():
+    return LookupEveStaticDump(thread_safe=True).get_groups_for_types
+
 def cache_save_zkb_region(region_id, killmails):
     with open(f'cache/zkb_regions/{region_id}.json', 'w') as fp:
         fp.write(json.dumps(killmails))
@@ -186,26 +833,37 @@ def cache_load_zkb_region(region_id):
         return json.loads(fp.read())
 
 def cache_save_esi_region(region_id, killmails):
-    with open(f'cache/esi_regions/{region_id}.json', 'w') as fp:
-        fp.write(json.dumps(killmails))
+    ReplayCache.write(f'cache/esi_regions/{region_id}.jsonl', killmails)
 
+# Streamed replay data, a json list saved by earlier versions is converted first
 def cache_load_esi_region(region_id):
-    with open(f'cache/esi_regions/{region_id}.json', 'r') as fp:
-        return json.loads(fp.read())
+    return ReplayCache.open_region('cache/esi_regions', region_id)
+
+def cache_save_esi_names(region_id, names):
+    with open(f'cache/esi_regions/{region_id}_names.json', 'w') as fp:
+        fp.write(json.dumps(names))
 
-def download_from_zkillboard(region_id, num_pages):
+# Names saved by --loaddata, None when the test data was loaded before names were saved with it
+def cache_load_esi_names(region_id):
+    try:
+        with open(f'cache/esi_regions/{region_id}_names.json', 'r') as fp:
+            return zkb_wire.names_keys_to_int(json.loads(fp.read()))
+    except OSError:
+        return None
+
+def download_from_zkillboard(region_id, num_pages, http):
     killmails = []
 
     for page in range(1, num_pages + 1):
         url = f'https://zkillboard.com/api/kills/regionID/{region_id}/page/{page}/'
         print(f'Downloading {url}')
-        r = requests.get(url)
+        r = http.get(url)
         killmails += json.loads(r.content)
         time.sleep(1)
     return killmails
 
 def download_from_esi(killmails):
-    cache = FileCache(path=os.path.join(ROOT_DIR, 'cache/esipy_swagger'))
+    cache = FileCache(path=os.path.join(data_def.ROOT_DIR, 'cache/esipy_swagger'))
     esi_app = EsiApp(cache=cache, cache_time=60 * 60 * 24)
     app = esi_app.get_latest_swagger
 
@@ -232,6 +890,15 @@ def download_from_esi(killmails):
 
     return full_killmails
 
+# Names of every id in the killmails, with one bulk ESI request per 1000 ids
+def download_names(killmails):
+    ids = {key: set() for key in zkb_wire.NAME_KEYS}
+    for killmail in killmails:
+        for entity in [killmail['victim']] + killmail['attackers']:
+            for key in zkb_wire.NAME_KEYS:
+                ids[key].add(entity.get(key[:-1], 0))
+    return EsiBulkNames().bulk_lookup_names(ids['character_ids'], ids['corporation_ids'], ids['alliance_ids'])
+
 
 
 # ######################################################################################################
@@ -240,27 +907,152 @@ def download_from_esi(killmails):
 @click.command()
 @click.option('--loaddata', 'mode', flag_value='loaddata', help='Load replay test data from zkillboard')
 @click.option('--replay', 'mode', flag_value='replay', help='Replay test data from zkillboard')
-def startup(mode):
+@click.option('--backfill', 'mode', flag_value='backfill',
+              help='Load historical killmails of --regions from zkillboard into the archive, resuming an earlier run')
+@click.option('--reindex', 'mode', flag_value='reindex', help='Index archived killmails saved before indexing existed')
+@click.option('--fetcher', 'mode', flag_value='fetcher',
+              help='Only fetch from RedisQ with --queue-id and push killmails to the listener at --ingest')
+@click.option('--compress-archive', 'mode', flag_value='compress',
+              help='Compress archived killmails saved as plain text, then vacuum the database')
+@click.option('--esi-names', type=click.Choice(['bulk', 'individual']), default='bulk',
+              help='Resolve names with one bulk ESI request per killmail, or one request per id')
+@click.option('--enrich-workers', default=4, help='Threads resolving names concurrently')
+@click.option('--queue-size', default=100, help='Maximum killmails waiting between pipeline stages')
+@click.option('--stats-interval', default=60.0, help='Seconds between queue depth reports, 0 to disable')
+@click.option('--commit-batch', default=100, help='Maximum killmails saved to sqlite per transaction')
+@click.option('--commit-interval', default=0.5, help='Maximum seconds a killmail waits before it is committed')
+@click.option('--compression', type=click.Choice(['auto', 'zstd', 'zlib', 'none']), default='auto',
+              help='Codec for archived killmails, auto uses zstd when installed and zlib otherwise')
+@click.option('--wire-format', type=click.Choice(['auto', 'legacy', 'multipart', 'both']), default='auto',
+              help='Broadcast format, auto publishes each format only while it has subscribers')
+@click.option('--recent-kills', default=RecentKillmails.DEFAULT_SIZE,
+              help='Broadcast killmails kept in memory for subscribers catching up')
+@click.option('--send-hwm', default=ZKBRedisQ.DEFAULT_SEND_HWM,
+              help='Messages queued for each subscriber before ZMQ drops messages to it')
+@click.option('--enrich-policy', type=click.Choice(['all', 'interest']), default='all',
+              help='Resolve names for every killmail, or only for killmails subscribers registered an interest in')
+@click.option('--rate', default=1.0, help='Killmails replayed per second, 0 for as fast as possible')
+@click.option('--speedup', type=float, default=None,
+              help='Replay with the original spacing of killmail times divided by this factor, instead of --rate')
+@click.option('--reverse', is_flag=True, help='Replay newest killmails first')
+@click.option('--start-at', default=None,
+              help='Start the replay at this killmail id, or at a killmail time as 2019-11-20T18:00:00Z')
+@click.option('--metrics-port', default=0, help='Serve stage latency metrics for Prometheus on this port, 0 to disable')
+@click.option('--metrics-file', default=None, help='Write a json snapshot of the metrics to this file periodically')
+@click.option('--regions', default=str(REGION_VENAL), help='Regions to backfill, comma separated')
+@click.option('--pages', default='1-25', help='zkillboard pages to backfill, as first-last')
+@click.option('--backfill-workers', default=4, help='zkillboard pages backfilled at a time')
+@click.option('--zkb-rate', default=1.0, help='zkillboard requests per second while backfilling')
+@click.option('--esi-rate', default=20.0, help='ESI requests per second while backfilling')
+@click.option('--checkpoint', default='cache/zkb_regions/backfill_checkpoint.json',
+              help='Pages already backfilled, delete to load them again')
+@click.option('--http-pool-size', default=4, help='Connections kept open to each RedisQ and zkillboard host')
+@click.option('--connect-timeout', default=5.0, help='Seconds to open a connection to RedisQ or zkillboard')
+@click.option('--read-timeout', default=30.0, help='Seconds to wait for a RedisQ or zkillboard response')
+@click.option('--queue-id', default=RedisqPoller.DEFAULT_QUEUE_ID,
+              help='RedisQ queue id, every listener and fetcher needs one of its own')
+@click.option('--ingest-bind', default=None,
+              help='Receive killmails from --fetcher processes on this address, as tcp://*:7274')
+@click.option('--ingest', default='tcp://127.0.0.1:7274', help='Address of the listener a --fetcher pushes to')
+@click.option('--dedup-size', default=SeenKillmails.DEFAULT_SIZE,
+              help='Recent killmail ids remembered to drop copies from other queue ids')
+def startup(mode, esi_names, enrich_workers, queue_size, stats_interval, commit_batch, commit_interval, compression,
+            wire_format, recent_kills, send_hwm, enrich_policy, rate, speedup, reverse, start_at, metrics_port,
+            metrics_file, regions, pages, backfill_workers, zkb_rate, esi_rate, checkpoint, http_pool_size,
+            connect_timeout, read_timeout, queue_id, ingest_bind, ingest, dedup_size):
+    http = HttpClient(pool_size=http_pool_size, connect_timeout=connect_timeout, read_timeout=read_timeout)
     if mode == 'loaddata':
         print('Downloading test data from zkillboard...')
-        zkillboard_killmails = download_from_zkillboard(REGION_VENAL, 25)
+        zkillboard_killmails = download_from_zkillboard(REGION_VENAL, 25, http)
         print('...finished downloading.')
         cache_save_zkb_region(REGION_VENAL, zkillboard_killmails)
         print('Downloading ESI killmails...')
         esi_killmails = download_from_esi(zkillboard_killmails)
         print('...finished downloading.')
         cache_save_esi_region(REGION_VENAL, esi_killmails)
+        print('Downloading names...')
+        cache_save_esi_names(REGION_VENAL, download_names(esi_killmails))
+        print('...finished downloading.')
         print('\n\nDone, data ready for replay.')
+    elif mode == 'backfill':
+        try:
+            region_ids = [int(x) for x in regions.split(',')]
+            first_page, last_page = (int(x) for x in pages.split('-')) if '-' in pages else (int(pages),) * 2
+        except ValueError:
+            raise click.BadParameter('use --regions 10000015,10000016 --pages 1-25')
+        print(f'Backfilling pages {first_page}-{last_page} of regions {regions}...')
+        cache = RedisqCache(region_lookup=get_region_lookup(load_solarsystems()), compression=compression)
+        backfill = Backfill(cache, checkpoint, workers=backfill_workers, zkb_rate=zkb_rate, esi_rate=esi_rate,
+                            http=http)
+
+        def progress(region_id, page, killmails):
+            print(f'Region {region_id} page {page}: {killmails} killmails')
+        try:
+            stats = backfill.run(region_ids, first_page, last_page, progress)
+            print(f'...loaded {stats["pages"]} pages, archived {stats["archived"]} of {stats["killmails"]} '
+                  f'killmails, {stats["failed_pages"]} pages failed.')
+            for host, x in stats['http'].items():
+                print(f'{host}: {x["requests"]} requests on {x["connections"]} connections, '
+                      f'connect {x["connect_ms"]} ms, request {x["request_ms"]} ms')
+        except KeyboardInterrupt:
+            print('...interrupted, run again to resume.')
+    elif mode == 'fetcher':
+        print(f'Starting in fetcher mode, pushing to {ingest}...\n\n')
+        try:
+            ShardFetcher(queue_id, ingest, http=http).main_loop()
+        except KeyboardInterrupt:
+            pass
+    elif mode == 'reindex':
+        print('Indexing archived killmails...')
+        indexed = RedisqCache(region_lookup=get_region_lookup(load_solarsystems())).reindex_killmails()
+        print(f'...indexed {indexed} killmails.')
+    elif mode == 'compress':
+        print('Compressing archived killmails...')
+        cache = RedisqCache(region_lookup=get_region_lookup(load_solarsystems()), compression=compression)
+        before = os.path.getsize(cache.db_path)
+        compressed = cache.compress_killmails()
+        print(f'...compressed {compressed} killmails, vacuuming...')
+        cache.vacuum()
+        stats = cache.archive_stats()
+        print(f'...{stats["compressed"]} of {stats["killmails"]} killmails compressed, database '
+              f'{before // 1024} KB -> {os.path.getsize(cache.db_path) // 1024} KB.')
     elif mode == 'replay':
         print('Starting in replay mode...\n\n')
-        test_killmails = cache_load_esi_region(REGION_VENAL)
-        test_killmails.reverse()
-        redisq_listener = ZKBRedisQ()
-        redisq_listener.test_data_replay(test_killmails)
+        try:
+            replay_cache = cache_load_esi_region(REGION_VENAL)
+        except ReplayCacheException as e:
+            print(f'   xxx Could not load test data, run --loaddata first [{e}]')
+            return
+        try:
+            if start_at is None:
+                test_killmails = replay_cache.killmails(reverse=reverse)
+            elif start_at.isdigit():
+                test_killmails = replay_cache.killmails(reverse=reverse, start_id=int(start_at))
+            else:
+                test_killmails = replay_cache.killmails(reverse=reverse, start_time=to_timestamp(start_at))
+        except (ValueError, ReplayCacheException) as e:
+            raise click.BadParameter(f'use --start-at with a killmail id or a time as 2019-11-20T18:00:00Z [{e}]')
+        exposition = metrics.start_exposition(metrics_port, metrics_file, stats_interval or 60.0)
+        test_names = cache_load_esi_names(REGION_VENAL)
+        if test_names is None:
+            print('   xxx No names saved with the test data, run --loaddata again. Replaying without names.')
+        redisq_listener = ZKBRedisQ(esi_names=esi_names, compression=compression, wire_format=wire_format,
+                                    send_hwm=send_hwm, http=http)
+        redisq_listener.test_data_replay(test_killmails, test_names, rate=rate, speedup=speedup)
+        replay_cache.close()
+        for x in exposition:
+            x.stop()
     else:
         print('Starting in normal mode...\n\n')
-        redisq_listener = ZKBRedisQ()
-        redisq_listener.main_loop()
+        exposition = metrics.start_exposition(metrics_port, metrics_file, stats_interval or 60.0)
+        redisq_listener = ZKBRedisQ(esi_names=esi_names, enrich_workers=enrich_workers, queue_size=queue_size,
+                                    commit_batch=commit_batch, commit_interval=commit_interval,
+                                    compression=compression, wire_format=wire_format, recent_kills=recent_kills,
+                                    send_hwm=send_hwm, enrich_policy=enrich_policy, http=http,
+                                    session_id=queue_id, ingest_bind=ingest_bind, dedup_size=dedup_size)
+        redisq_listener.main_loop(stats_interval)
+        for x in exposition:
+            x.stop()
 
     print('...exiting.')
 
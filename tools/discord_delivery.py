@@ -0,0 +1,249 @@
+'''
+    Deliver messages to Discord webhooks without blocking the caller.
+
+    Every webhook has its own queue and delivery thread, send() only queues the message. The ZMQ receive loop of
+    hook_bot never waits on Discord, a slow response or a rate limit only delays that one channel.
+
+    Each delivery thread:
+        - packs the messages queued while it was waiting into one post, one per line, up to Discord's 2000 characters
+        - follows the rate limit headers, and waits for X-RateLimit-Reset-After once X-RateLimit-Remaining reaches 0
+        - on a 429 waits retry_after and posts again, a global 429 pauses every webhook
+        - retries connection errors and 5xx responses with exponential backoff, and drops the post after MAX_ATTEMPTS
+    A webhook whose queue is full drops its oldest message, send() never blocks.
+
+        delivery = DiscordDelivery()
+        delivery.send('https://discord.com/api/webhooks/<id>/<token>', 'message')
+        ...
+        delivery.close()
+'''
+
+import threading
+import time
+from collections import deque
+
+import requests
+
+from tools import metrics
+
+
+class DiscordDeliveryException(Exception):
+    '''Raise whenever any error or exception occurs'''
+
+
+# Webhook id from a webhook url, for log messages that must not show the token
+def webhook_name(url):
+    parts = url.rstrip('/').split('/')
+    return parts[-2] if len(parts) >= 2 else url
+
+
+class WebhookQueue(object):
+    '''
+        Queue and delivery thread of one webhook url, created by DiscordDelivery.send()
+    '''
+    MAX_CONTENT = 2000      # Discord's limit on the content of one message
+    MAX_ATTEMPTS = 5        # Posts of the same content that failed with an error before it is dropped
+    BACKOFF = 1.0           # Seconds before the first retry, doubled for every retry after it
+    MAX_BACKOFF = 60.0
+
+    def __init__(self, delivery, url, max_queued):
+        self.delivery = delivery
+        self.url = url
+        self.name = webhook_name(url)
+        self.max_queued = max_queued
+        self.messages = deque()
+        self.condition = threading.Condition()
+        self.stopping = False
+        # monotonic time before which the rate limit of this webhook is used up
+        self.ready_at = 0.0
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': delivery.user_agent})
+        self.stats = {'queued': 0, 'sent': 0, 'posts': 0, 'rate_limited': 0, 'retries': 0, 'dropped': 0}
+        self.post_seconds = metrics.histogram('discord_post_seconds', 'Seconds per webhook post', webhook=self.name)
+        self.queue_seconds = metrics.histogram('discord_queue_seconds', 'Seconds messages wait before they are posted',
+                                               webhook=self.name)
+        self.lag_seconds = metrics.histogram('hook_lag_seconds', 'Seconds from killmail_time', metrics.LAG_BUCKETS,
+                                             point='delivered')
+        self.thread = threading.Thread(target=self.run, name=f'webhook_{self.name}', daemon=True)
+        self.thread.start()
+
+    # Messages are queued as (content, monotonic time queued, unix time the lag is measured from or None)
+    def put(self, message, since=None):
+        with self.condition:
+            if len(self.messages) >= self.max_queued:
+                self.messages.popleft()
+                self.stats['dropped'] += 1
+            self.messages.append((message[:self.MAX_CONTENT], time.monotonic(), since))
+            self.stats['queued'] += 1
+            self.condition.notify()
+
+    def qsize(self):
+        with self.condition:
+            return len(self.messages)
+
+    # Deliver what is still queued and stop
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+
+    '''
+        Messages that fit into one post, oldest first, once the rate limit allows posting. Returns None once stopped
+        and empty. Messages keep queueing up while the rate limit is used up, and all go out in the next post.
+    '''
+    def _take_batch(self):
+        with self.condition:
+            while True:
+                if not self.messages:
+                    if self.stopping:
+                        return None
+                    self.condition.wait()
+                    continue
+                # Checked once messages are queued, a rate limit hit while waiting for them is still followed
+                wait = max(self.ready_at, self.delivery.global_ready_at) - time.monotonic()
+                if wait <= 0:
+                    break
+                self.condition.wait(wait)
+            batch = [self.messages.popleft()]
+            length = len(batch[0][0])
+            while self.messages and length + 1 + len(self.messages[0][0]) <= self.MAX_CONTENT:
+                length += 1 + len(self.messages[0][0])
+                batch.append(self.messages.popleft())
+            return batch
+
+    # Put a batch back in front of the queue, to be packed again with the messages that arrived since
+    def _requeue(self, batch):
+        with self.condition:
+            self.messages.extendleft(reversed(batch))
+
+    def run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            self._deliver(batch)
+
+    def _deliver(self, batch):
+        content = '\n'.join(x[0] for x in batch)
+        attempts = 0
+        backoff = self.BACKOFF
+        while True:
+            start = time.perf_counter()
+            try:
+                resp = self.session.post(self.url, json={'content': content}, timeout=self.delivery.timeout)
+                error = None
+            except requests.exceptions.RequestException as e:
+                resp = None
+                error = str(e)
+            self.post_seconds.observe(time.perf_counter() - start)
+
+            if resp is not None:
+                self.stats['posts'] += 1
+                self._read_rate_limit(resp)
+                if resp.status_code < 300:
+                    self.stats['sent'] += len(batch)
+                    self._observe_sent(batch)
+                    return
+                if resp.status_code == 429:
+                    self.stats['rate_limited'] += 1
+                    self._requeue(batch)
+                    return
+                if resp.status_code < 500:
+                    # The webhook was deleted or the message is invalid, posting it again cannot help
+                    print(f'   xxx Discord webhook {self.name} rejected {len(batch)} messages - '
+                          f'[{resp.status_code}] [{resp.text[:200]}]')
+                    self.stats['dropped'] += len(batch)
+                    return
+                error = f'status code {resp.status_code}'
+
+            attempts += 1
+            if attempts >= self.MAX_ATTEMPTS:
+                print(f'   xxx Discord webhook {self.name} failed {attempts} times, dropping {len(batch)} messages '
+                      f'[{error}]')
+                self.stats['dropped'] += len(batch)
+                return
+            self.stats['retries'] += 1
+            time.sleep(backoff)
+            backoff = min(backoff * 2, self.MAX_BACKOFF)
+
+    def _observe_sent(self, batch):
+        now = time.monotonic()
+        for _, queued, since in batch:
+            self.queue_seconds.observe(now - queued)
+            if since is not None:
+                metrics.observe_lag(self.lag_seconds, since)
+
+    # Note when posting is allowed again, from the rate limit headers and 429 responses
+    def _read_rate_limit(self, resp):
+        now = time.monotonic()
+        if resp.status_code == 429:
+            retry_after = None
+            try:
+                retry_after = float(resp.json().get('retry_after'))
+            except (ValueError, TypeError, AttributeError):
+                pass
+            if retry_after is None:
+                retry_after = header_float(resp, 'Retry-After', 1.0)
+            if resp.headers.get('X-RateLimit-Global', '').lower() == 'true':
+                self.delivery.pause(retry_after)
+            else:
+                self.ready_at = max(self.ready_at, now + retry_after)
+        elif header_float(resp, 'X-RateLimit-Remaining', 1) <= 0:
+            self.ready_at = max(self.ready_at, now + header_float(resp, 'X-RateLimit-Reset-After', 0.0))
+
+
+def header_float(resp, name, default):
+    try:
+        return float(resp.headers[name])
+    except (KeyError, ValueError):
+        return default
+
+
+class DiscordDelivery(object):
+    '''
+        timeout is the number of seconds to wait for Discord to answer a post.
+        max_queued is the number of messages each webhook queues before dropping its oldest.
+    '''
+    USER_AGENT = 'ZKBMonitor hook_bot'
+
+    def __init__(self, timeout=10.0, max_queued=1000, user_agent=USER_AGENT):
+        self.timeout = timeout
+        self.max_queued = max_queued
+        self.user_agent = user_agent
+        self.webhooks = {}
+        self.lock = threading.Lock()
+        # monotonic time before which a global rate limit stops every webhook
+        self.global_ready_at = 0.0
+
+    '''
+        Queue a message for a webhook url, returns immediately.
+        since is the unix time of the event the message is about, to measure how long it took to reach Discord.
+    '''
+    def send(self, url, message, since=None):
+        webhook = self.webhooks.get(url)
+        if webhook is None:
+            with self.lock:
+                webhook = self.webhooks.get(url)
+                if webhook is None:
+                    webhook = self.webhooks[url] = WebhookQueue(self, url, self.max_queued)
+        webhook.put(message, since)
+
+    # Stop posting to every webhook for seconds, after a global rate limit
+    def pause(self, seconds):
+        self.global_ready_at = max(self.global_ready_at, time.monotonic() + seconds)
+
+    # { webhook id: { 'queued', 'sent', 'posts', 'rate_limited', 'retries', 'dropped', 'waiting' } }
+    def get_stats(self):
+        with self.lock:
+            webhooks = list(self.webhooks.values())
+        return {x.name: {**x.stats, 'waiting': x.qsize()} for x in webhooks}
+
+    # Deliver what is queued, waiting up to timeout seconds. Returns the number of messages left undelivered.
+    def close(self, timeout=10.0):
+        with self.lock:
+            webhooks = list(self.webhooks.values())
+        for webhook in webhooks:
+            webhook.stop()
+        deadline = time.monotonic() + timeout
+        for webhook in webhooks:
+            webhook.thread.join(max(0.0, deadline - time.monotonic()))
+        return sum(x.qsize() for x in webhooks)
@@ -0,0 +1,78 @@
+'''
+    Resolve character, corporation, and alliance names in bulk using ESI's POST /universe/names/ endpoint.
+
+    One request resolves up to 1000 ids of any type, so a killmail with hundreds of attackers costs a single request
+    instead of one request per id. Ids are deduplicated and the invalid id 0 is skipped before anything is sent.
+
+    ESI rejects the whole request with a 404 when any id in it cannot be resolved. When that happens the chunk is split
+    in half and retried, so one bad id only loses its own name.
+'''
+
+import requests
+
+
+class EsiBulkNamesException(Exception):
+    '''Raise whenever any error or exception occurs'''
+
+class EsiBulkNames(object):
+    DEFAULT_BASE_URL = 'https://esi.evetech.net/latest'
+    CHUNK_SIZE = 1000       # Maximum ids accepted by /universe/names/
+    USER_AGENT = 'Something CCP can use to contact you and that define your app'
+
+    def __init__(self, base_url=DEFAULT_BASE_URL, timeout=10.0):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': self.USER_AGENT})
+        self.request_count = 0
+
+    # POST one chunk of ids, returns [{'id': x, 'name': 'y', 'category': 'z'}, ...]
+    def _post_names(self, ids):
+        url = f'{self.base_url}/universe/names/?datasource=tranquility'
+        self.request_count += 1
+        try:
+            resp = self.session.post(url, json=ids, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            raise EsiBulkNamesException(f'Error posting to {url}: [{e}]')
+
+        if resp.status_code == 404:
+            # At least one id could not be resolved, narrow it down
+            if len(ids) == 1:
+                return []
+            middle = len(ids) // 2
+            return self._post_names(ids[:middle]) + self._post_names(ids[middle:])
+        if resp.status_code != 200:
+            raise EsiBulkNamesException(f'Status code {resp.status_code} for {url} - [{resp.text[:200]}]')
+
+        try:
+            return resp.json()
+        except ValueError as e:
+            raise EsiBulkNamesException(f'Invalid JSON from {url} - [{e}]')
+
+    '''
+        Do a bulk lookup of all character, corporation, and alliance ids in the lists.
+        Returns the same dictionary as lookup_esi_names.bulk_lookup_names() {
+            'character_ids': { character_id: 'name' },
+            'corporation_ids': { corporation_id: 'name' },
+            'alliance_ids': { alliance_id: 'name' }
+        }
+    '''
+    def bulk_lookup_names(self, character_ids, corporation_ids, alliance_ids):
+        requested = {
+            'character_ids': {x for x in character_ids if x},
+            'corporation_ids': {x for x in corporation_ids if x},
+            'alliance_ids': {x for x in alliance_ids if x},
+        }
+        names = {key: {} for key in requested}
+
+        all_ids = sorted(set().union(*requested.values()))
+        for i in range(0, len(all_ids), self.CHUNK_SIZE):
+            for entry in self._post_names(all_ids[i:i + self.CHUNK_SIZE]):
+                for key, ids in requested.items():
+                    if entry['id'] in ids:
+                        names[key][entry['id']] = entry['name']
+
+        # Add empty strings for invalid id 0
+        for key in names:
+            names[key][0] = ''
+        return names
@@ -0,0 +1,192 @@
+'''
+    Connection pooled HTTP client shared by the RedisQ, zKillboard and other non-ESI requests of a process.
+
+    One requests.Session keeps connections alive between requests, so RedisQ long polls and zKillboard pages reuse an
+    open TCP + TLS connection instead of paying a handshake each. Each host gets at most pool_size connections; a
+    request finding them all busy waits for one to come back. Responses are requested gzip compressed, and every
+    request has a connect and a read timeout, so a dead connection is noticed.
+
+    Connections are timed as they are opened, so the handshakes saved are visible:
+        - http_connect_seconds{host}    opening a connection, TCP connect plus the TLS handshake
+        - http_request_seconds{host}    whole requests, including a RedisQ long poll
+        - http_connections_total{host}  connections opened, http_requests_total{host} requests sent
+    get_stats() returns the same per host, with how many requests reused an open connection. Hosts are named host, or
+    host:port when the port is not the default of the scheme.
+
+        http = HttpClient(pool_size=4, connect_timeout=5.0, read_timeout=30.0)
+        resp = http.get('https://zkillboard.com/api/kills/regionID/10000015/page/1/')
+
+    Request errors are raised as the requests.exceptions they are, the same as calling requests directly.
+'''
+
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from tools import metrics
+
+
+class HttpClientException(Exception):
+    '''Raise whenever any error or exception occurs'''
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+def host_name(host, port, default_port):
+    return host if port is None or port == default_port else f'{host}:{port}'
+
+
+class TimedAdapter(HTTPAdapter):
+    '''
+        HTTPAdapter whose connection pools open connections with the classes in pool_classes
+    '''
+    def __init__(self, pool_classes, **kwargs):
+        # HTTPAdapter.__init__ creates the pool manager, pool_classes must be set before it
+        self.pool_classes = pool_classes
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = self.pool_classes
+
+
+class HttpClient(object):
+    USER_AGENT = 'Something CCP can use to contact you and that define your app'
+    MAX_HOSTS = 10          # Hosts whose connections are kept open at the same time
+
+    '''
+        pool_size is the number of connections kept open to each host, and the most used at a time.
+        connect_timeout and read_timeout are in seconds, a request can give a read timeout of its own.
+    '''
+    def __init__(self, pool_size=4, connect_timeout=5.0, read_timeout=30.0, user_agent=USER_AGENT):
+        if pool_size < 1:
+            raise HttpClientException(f'pool_size must be at least 1, not {pool_size}')
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # { host: {'requests', 'connections', 'errors', 'connect_seconds', 'request_seconds'} }
+        self.stats = {}
+        self.host_metrics = {}
+        self.lock = threading.Lock()
+
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': user_agent, 'Accept-Encoding': 'gzip, deflate',
+                                     'Connection': 'keep-alive'})
+        adapter = TimedAdapter(self._timed_pool_classes(), pool_connections=self.MAX_HOSTS, pool_maxsize=pool_size,
+                               pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    # Connection pool classes whose connections report how long they took to open
+    def _timed_pool_classes(self):
+        client = self
+
+        class TimedHTTPConnection(HTTPConnection):
+            def connect(self):
+                start = time.perf_counter()
+                super().connect()
+                client.record_connect(host_name(self.host, self.port, self.default_port), time.perf_counter() - start)
+
+        # connect() includes the TLS handshake
+        class TimedHTTPSConnection(HTTPSConnection):
+            def connect(self):
+                start = time.perf_counter()
+                super().connect()
+                client.record_connect(host_name(self.host, self.port, self.default_port), time.perf_counter() - start)
+
+        class TimedHTTPConnectionPool(HTTPConnectionPool):
+            ConnectionCls = TimedHTTPConnection
+
+        class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+            ConnectionCls = TimedHTTPSConnection
+
+        return {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+
+    # ################################
+    # Requests
+
+    '''
+        Send a request on a pooled connection. timeout is the read timeout of this request, or a (connect, read)
+        tuple, the client's timeouts when None. Other arguments are passed to requests.Session.request().
+    '''
+    def request(self, method, url, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = (self.connect_timeout, self.read_timeout)
+        elif not isinstance(timeout, tuple):
+            timeout = (self.connect_timeout, timeout)
+        parts = urlsplit(url)
+        host = host_name(parts.hostname or '', parts.port, DEFAULT_PORTS.get(parts.scheme))
+        start = time.perf_counter()
+        try:
+            resp = self.session.request(method, url, timeout=timeout, **kwargs)
+        except requests.exceptions.RequestException:
+            self._record_request(host, time.perf_counter() - start, error=True)
+            raise
+        self._record_request(host, time.perf_counter() - start)
+        return resp
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+    # ################################
+    # Timing
+
+    def _host(self, host):
+        stats = self.stats.get(host)
+        if stats is None:
+            stats = self.stats[host] = {'requests': 0, 'connections': 0, 'errors': 0, 'connect_seconds': 0.0,
+                                        'request_seconds': 0.0}
+            self.host_metrics[host] = {
+                'connect': metrics.histogram('http_connect_seconds', 'Seconds to open a connection, TLS included',
+                                             host=host),
+                'request': metrics.histogram('http_request_seconds', 'Seconds per request', host=host),
+                'connections': metrics.counter('http_connections_total', 'Connections opened', host=host),
+                'requests': metrics.counter('http_requests_total', 'Requests sent', host=host),
+            }
+        return stats, self.host_metrics[host]
+
+    def record_connect(self, host, seconds):
+        with self.lock:
+            stats, host_metrics = self._host(host)
+            stats['connections'] += 1
+            stats['connect_seconds'] += seconds
+        host_metrics['connect'].observe(seconds)
+        host_metrics['connections'].inc()
+
+    def _record_request(self, host, seconds, error=False):
+        with self.lock:
+            stats, host_metrics = self._host(host)
+            stats['requests'] += 1
+            stats['errors'] += error
+            stats['request_seconds'] += seconds
+        host_metrics['request'].observe(seconds)
+        host_metrics['requests'].inc()
+
+    '''
+        { host: {'requests', 'connections', 'reused', 'errors', 'connect_ms', 'request_ms'} }, reused is the number
+        of requests sent on a connection that was already open, connect_ms and request_ms are averages
+    '''
+    def get_stats(self):
+        with self.lock:
+            stats = {host: dict(x) for host, x in self.stats.items()}
+        return {host: {
+            'requests': x['requests'],
+            'connections': x['connections'],
+            'reused': max(0, x['requests'] - x['connections']),
+            'errors': x['errors'],
+            'connect_ms': round(1000 * x['connect_seconds'] / x['connections'], 2) if x['connections'] else None,
+            'request_ms': round(1000 * x['request_seconds'] / x['requests'], 2) if x['requests'] else None,
+        } for host, x in stats.items()}
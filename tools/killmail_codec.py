@@ -0,0 +1,157 @@
+'''
+    Compression of killmail json with a dictionary trained on earlier killmails.
+
+    Killmails are small and very repetitive: the same keys, item flags and type ids appear in every one of them. On
+    their own they barely compress, but with a shared dictionary that already contains those strings most of each
+    killmail becomes back references.
+
+    zstd (the 'zstandard' package) is used when it is installed. Otherwise zlib with a preset dictionary is used, which
+    needs no extra packages but only looks back 32KB.
+
+    Compressed blobs are self describing:
+        1 byte      - codec, CODEC_ZLIB or CODEC_ZSTD
+        4 bytes     - id of the dictionary, unsigned little endian
+        rest        - compressed data
+    Killmails stored as plain text are returned unchanged by decode(), so old and new rows can be mixed.
+'''
+
+import struct
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class KillmailCodecException(Exception):
+    '''Raise whenever any error or exception occurs'''
+
+class KillmailCodec(object):
+    CODEC_ZLIB = 1
+    CODEC_ZSTD = 2
+    CODEC_NAMES = {'zlib': CODEC_ZLIB, 'zstd': CODEC_ZSTD}
+    HEADER_FORMAT = '<BI'
+    HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+    ZLIB_WINDOW = 32 * 1024
+    ZLIB_LEVEL = 6
+    ZSTD_LEVEL = 9
+    ZSTD_DICTIONARY_SIZE = 112 * 1024
+
+    '''
+        dictionaries is { dictionary_id: (codec, dictionary bytes) }
+        active_id is the dictionary new killmails are compressed with, None to leave new killmails uncompressed
+    '''
+    def __init__(self, dictionaries, active_id=None):
+        self.dictionaries = dict(dictionaries)
+        self.active_id = active_id
+        # zstd contexts must not be shared between threads, each thread builds its own
+        self.local = threading.local()
+        if active_id is not None and active_id not in self.dictionaries:
+            raise KillmailCodecException(f'unknown dictionary {active_id}')
+
+    # Pick the codec for 'auto', 'zstd' or 'zlib', returns None for 'none'
+    @classmethod
+    def select_codec(cls, compression):
+        if compression == 'none':
+            return None
+        if compression == 'auto':
+            return cls.CODEC_ZSTD if zstandard is not None else cls.CODEC_ZLIB
+        if compression == 'zstd' and zstandard is None:
+            raise KillmailCodecException('zstd compression requested but the zstandard package is not installed')
+        try:
+            return cls.CODEC_NAMES[compression]
+        except KeyError:
+            raise KillmailCodecException(f'unknown compression [{compression}]')
+
+    '''
+        Build a dictionary for codec from a list of killmail json strings.
+        zstd trains a real dictionary. For zlib the most recent samples are packed into the 32KB window, strings that
+        are near the end of a zlib dictionary are the cheapest to reference.
+    '''
+    @classmethod
+    def train(cls, codec, samples):
+        encoded = [x.encode('utf-8') if isinstance(x, str) else bytes(x) for x in samples]
+        if not encoded:
+            raise KillmailCodecException('no samples to train a dictionary with')
+
+        if codec == cls.CODEC_ZSTD:
+            if zstandard is None:
+                raise KillmailCodecException('the zstandard package is not installed')
+            try:
+                return zstandard.train_dictionary(cls.ZSTD_DICTIONARY_SIZE, encoded).as_bytes()
+            except zstandard.ZstdError as e:
+                raise KillmailCodecException(f'zstd dictionary training failed [{e}]')
+
+        dictionary = b''
+        for sample in reversed(encoded):
+            dictionary = sample + dictionary
+            if len(dictionary) >= cls.ZLIB_WINDOW:
+                break
+        return dictionary[-cls.ZLIB_WINDOW:]
+
+
+    # ################################
+    # Encode / decode
+
+    def _zstd_context(self, kind, dictionary_id):
+        contexts = self.local.__dict__.setdefault(kind, {})
+        context = contexts.get(dictionary_id)
+        if context is None:
+            dictionary = zstandard.ZstdCompressionDict(self.dictionaries[dictionary_id][1])
+            if kind == 'compressor':
+                context = zstandard.ZstdCompressor(level=self.ZSTD_LEVEL, dict_data=dictionary)
+            else:
+                context = zstandard.ZstdDecompressor(dict_data=dictionary)
+            contexts[dictionary_id] = context
+        return context
+
+    # False when value is a compressed blob whose dictionary is not loaded, such as one trained by another process
+    def knows(self, value):
+        if value is None or isinstance(value, str):
+            return True
+        try:
+            return struct.unpack_from(self.HEADER_FORMAT, bytes(value))[1] in self.dictionaries
+        except struct.error:
+            return True
+
+    # Compress a killmail json string, returns the string unchanged when there is no active dictionary
+    def encode(self, killmail):
+        if self.active_id is None:
+            return killmail
+        codec, dictionary = self.dictionaries[self.active_id]
+        raw = killmail.encode('utf-8')
+        header = struct.pack(self.HEADER_FORMAT, codec, self.active_id)
+
+        if codec == self.CODEC_ZSTD:
+            return header + self._zstd_context('compressor', self.active_id).compress(raw)
+
+        compressor = zlib.compressobj(self.ZLIB_LEVEL, zdict=dictionary)
+        return header + compressor.compress(raw) + compressor.flush()
+
+    # Return the killmail json string for a stored value, which is either plain text or a compressed blob
+    def decode(self, value):
+        if value is None or isinstance(value, str):
+            return value
+
+        value = bytes(value)
+        try:
+            codec, dictionary_id = struct.unpack_from(self.HEADER_FORMAT, value)
+            stored_codec, dictionary = self.dictionaries[dictionary_id]
+        except (struct.error, KeyError):
+            raise KillmailCodecException('killmail blob has an unknown dictionary')
+        if codec != stored_codec:
+            raise KillmailCodecException(f'killmail blob codec {codec} does not match dictionary {dictionary_id}')
+
+        try:
+            if codec == self.CODEC_ZSTD:
+                if zstandard is None:
+                    raise KillmailCodecException('zstd killmail found but the zstandard package is not installed')
+                raw = self._zstd_context('decompressor', dictionary_id).decompress(value[self.HEADER_SIZE:])
+            else:
+                decompressor = zlib.decompressobj(zdict=dictionary)
+                raw = decompressor.decompress(value[self.HEADER_SIZE:]) + decompressor.flush()
+        except zlib.error as e:
+            raise KillmailCodecException(f'could not decompress killmail [{e}]')
+        return raw.decode('utf-8')
@@ -158,8 +158,6 @@ def bulk_alliance_lookup(alliance_list):
     Make all required operations for characters, corporations, and alliances    
 '''
 def make_character_operations(character_ids):
-    if len(character_ids) == 0:
-        return
     operations = []
     for id in character_ids:
         if id == 0:
@@ -172,8 +170,6 @@ def make_character_operations(character_ids):
     return operations
 
 def make_corporation_operations(corporation_ids):
-    if len(corporation_ids) == 0:
-        return
     operations = []
     for id in corporation_ids:
         if id == 0:
@@ -213,11 +209,12 @@ def bulk_lookup_names(character_ids, corporation_ids, alliance_ids):
         'alliance_ids': {}
     }
 
-    operations = make_character_operations(character_ids) \
-                 + make_corporation_operations(corporation_ids) \
-                 + make_alliance_operations(alliance_ids)
+    # Killmails list the same ids many times, only look each one up once
+    operations = make_character_operations(set(character_ids)) \
+                 + make_corporation_operations(set(corporation_ids)) \
+                 + make_alliance_operations(set(alliance_ids))
 
-    results = client.multi_request(operations)
+    results = client.multi_request(operations) if operations else []
 
     for result in results:
         if 'character_id' in result[0]._p['path']:
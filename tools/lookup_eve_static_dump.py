@@ -4,8 +4,14 @@
 
 import sqlite3
 import os
+import contextlib
+import threading
+import urllib.parse
 
 from data.definitions import ROOT_DIR
+from data.eve_type_ids import HOME_SYSTEM_ID
+from tools.static_snapshot import StaticSnapshot, StaticSnapshotException
+from tools.universe_graph import UniverseGraph, UniverseGraphException
 
 
 class LookupEveStaticDumpException(Exception):
@@ -14,125 +20,160 @@ class LookupEveStaticDumpException(Exception):
 class LookupEveStaticDump(object):
     DEFAULT_PATH = os.path.join(ROOT_DIR, 'data/sqlite-latest.sqlite')
     UNKNOWN_STRING = '!Unknown!'
-
-    def __init__(self):
-        pass
-
-
-    # Connect to the sqlite3 file and return a connection handle.
-    def connect_to_sql(self, db_path=DEFAULT_PATH):
+    CACHED_STATEMENTS = 256     # sqlite3 keeps this many compiled statements per connection
+    BATCH_SIZE = 500            # Maximum ids bound into a single IN (...) query
+
+    # thread_safe allows several worker threads to share one lookup object, access to the connection is serialized
+    # snapshot_path is a memory-mapped export made by tools/static_snapshot.py. It is used instead of sql when it exists
+    # and was exported from the static data dump at db_path, or when db_path does not exist at all.
+    def __init__(self, db_path=DEFAULT_PATH, thread_safe=False, snapshot_path=StaticSnapshot.DEFAULT_PATH):
+        self.db_path = db_path
+        self.thread_safe = thread_safe
+        self.db = None
+        self.lock = threading.RLock() if thread_safe else contextlib.nullcontext()
+        self.universe_graph = None
+        self.snapshot = self.open_snapshot(snapshot_path) if snapshot_path else None
+
+    # Map the snapshot at snapshot_path, returns None if it is missing or older than the static data dump
+    def open_snapshot(self, snapshot_path):
+        if not os.path.exists(snapshot_path):
+            return None
         try:
-            con = sqlite3.connect(db_path)
+            snapshot = StaticSnapshot(snapshot_path)
+        except StaticSnapshotException as e:
+            print(f'   xxx Ignoring static snapshot - [{e}]')
+            return None
+        if os.path.exists(self.db_path) and snapshot.get_data_version() != self._get_sde_version():
+            print(f'   xxx Ignoring static snapshot [{snapshot_path}], it was exported from a different static dump')
+            return None
+        return snapshot
+
+    def _get_sde_version(self):
+        sde_stat = os.stat(self.db_path)
+        return sde_stat.st_mtime_ns, sde_stat.st_size
+
+    # Identifies the static data the lookups are served from, as (mtime_ns, size) of the static data dump
+    def get_data_version(self):
+        if self.snapshot is not None:
+            return self.snapshot.get_data_version()
+        try:
+            return self._get_sde_version()
+        except OSError as e:
+            raise LookupEveStaticDumpException(f'could not stat static data dump [{self.db_path}] - [{e}]')
+
+
+    # Connect to the sqlite3 file read-only and return a connection handle.
+    def connect_to_sql(self, db_path=None):
+        if db_path is None:
+            db_path = self.db_path
+        if not os.path.exists(db_path):
+            raise LookupEveStaticDumpException(f'static data dump not found [{db_path}]')
+        uri = f'file:{urllib.parse.quote(os.path.abspath(db_path))}?mode=ro&immutable=1'
+        try:
+            con = sqlite3.connect(uri, uri=True, check_same_thread=not self.thread_safe,
+                                  cached_statements=self.CACHED_STATEMENTS)
         except sqlite3.Error as e:
             raise LookupEveStaticDumpException(f'sqlite error could not connect to database [{db_path}] - [{e}]')
 
         return con
 
+    # Return the shared connection, opening it on first use
+    def get_connection(self):
+        if self.db is None:
+            self.db = self.connect_to_sql()
+        return self.db
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    # Run a parameterized query on the shared connection and return all rows
+    def _execute(self, query_string, parameters=()):
+        with self.lock:
+            try:
+                return self.get_connection().execute(query_string, parameters).fetchall()
+            except sqlite3.Error as e:
+                raise LookupEveStaticDumpException(f'sqlite lookup error [{e}] - [{query_string}] {parameters}')
+
     # If lookup returns None, return UNKNOWN_STRING
     def _lookup_single_string_from_int(self, query_string, int_value):
-        db = self.connect_to_sql()
-        cursor = db.cursor()
-        formatted_query = ''
-        try:
-            formatted_query = query_string % (int_value,)
-            cursor.execute(formatted_query)
-            result = cursor.fetchone()
-            if result is None:
-                return self.UNKNOWN_STRING
-            return result[0]
-        except sqlite3.Error as e:
-            raise LookupEveStaticDumpException(f'sqlite lookup error [{e}] - [{formatted_query}]')
-
+        result = self._execute(query_string, (int_value,))
+        if len(result) == 0:
+            return self.UNKNOWN_STRING
+        return result[0][0]
 
     # If lookup returns None, return type_id 0 (invalid id) instead
     def _lookup_single_id_from_int(self, query_string, int_value):
-        db = self.connect_to_sql()
-        cursor = db.cursor()
-        formatted_query = ''
-        try:
-            formatted_query = query_string % (int_value,)
-            cursor.execute(formatted_query)
-            result = cursor.fetchone()
-            if result is None:
-                return 0
-            if result[0] is None:
-                return 0
-            return result[0]
-        except sqlite3.Error as e:
-            raise LookupEveStaticDumpException(f'sqlite lookup error [{e}] - [{formatted_query}]')
-
+        result = self._execute(query_string, (int_value,))
+        if len(result) == 0 or result[0][0] is None:
+            return 0
+        return result[0][0]
 
     # If no result is found return an empty list.
     def _lookup_multirow_int(self, query_string, int_value):
-        db = self.connect_to_sql()
-        cursor = db.cursor()
-        formatted_query = ''
-        try:
-            formatted_query = query_string % (int_value,)
-            cursor.execute(formatted_query)
-            result = cursor.fetchall()
-            if result is None:
-                return []
-            return result
-        except sqlite3.Error as e:
-            raise LookupEveStaticDumpException(f'sqlite lookup error [{e}] - [{formatted_query}]')
+        return self._execute(query_string, (int_value,))
 
     # If no result is found return an empty list.
     def _lookup_multirow_two_int(self, query_string, int_value_1, int_value_2):
-        db = self.connect_to_sql()
-        cursor = db.cursor()
-        formatted_query = ''
-
-        try:
-            formatted_query = query_string % (int_value_1, int_value_2)
-            cursor.execute(formatted_query)
-            result = cursor.fetchall()
-            if result is None:
-                return []
-            return [x[0] for x in result]
-        except sqlite3.Error as e:
-            raise LookupEveStaticDumpException(f'sqlite lookup error [{e}] - [{formatted_query}]')
+        return [x[0] for x in self._execute(query_string, (int_value_1, int_value_2))]
 
     # If no result is found return an empty list.
     def _lookup_multirow_two_float(self, query_string, float_value_1, float_value_2):
-        db = self.connect_to_sql()
-        cursor = db.cursor()
-        formatted_query = ''
-
-        try:
-            formatted_query = query_string % (float_value_1, float_value_2)
-            cursor.execute(formatted_query)
-            result = cursor.fetchall()
-            if result is None:
-                return []
-            return [x[0] for x in result]
-        except sqlite3.Error as e:
-            raise LookupEveStaticDumpException(f'sqlite lookup error [{e}] - [{formatted_query}]')
+        return [x[0] for x in self._execute(query_string, (float_value_1, float_value_2))]
+
+    # Batch lookup, query_string selects (id, value) and contains one '{}' where the IN (...) placeholders go.
+    # Returns { id: value }, ids that are not found map to 'missing'
+    def _lookup_batch(self, query_string, int_values, missing):
+        ids = list({x for x in int_values if x is not None})
+        results = {}
+        for i in range(0, len(ids), self.BATCH_SIZE):
+            chunk = ids[i:i + self.BATCH_SIZE]
+            chunk_query = query_string.format(','.join('?' * len(chunk)))
+            for key, value in self._execute(chunk_query, chunk):
+                results[key] = value
+        for x in ids:
+            if x not in results or results[x] is None:
+                results[x] = missing
+        return results
 
     ########################
     # Type and Groups
     def get_type_name(self, type_id):
-        sql_query = "SELECT typeName FROM invTypes WHERE typeID = %s"
+        if self.snapshot is not None:
+            return self.snapshot.get_type_name(type_id)
+        sql_query = "SELECT typeName FROM invTypes WHERE typeID = ?"
         return self._lookup_single_string_from_int(sql_query, type_id)
 
     def get_group_for_type(self, type_id):
-        sql_query = "SELECT groupID FROM invTypes WHERE typeID = %s"
+        if self.snapshot is not None:
+            return self.snapshot.get_group_for_type(type_id)
+        sql_query = "SELECT groupID FROM invTypes WHERE typeID = ?"
         return self._lookup_single_string_from_int(sql_query, type_id)
 
     def get_typelist_for_group(self, group_id):
-        sql_query = "SELECT typeID FROM invTypes WHERE groupID = %s"
+        if self.snapshot is not None:
+            return self.snapshot.get_typelist_for_group(group_id)
+        sql_query = "SELECT typeID FROM invTypes WHERE groupID = ?"
         return self._lookup_multirow_int(sql_query, group_id)
 
     def get_marketgroup_for_type_id(self, type_id):
-        sql_query = "SELECT marketGroupID FROM invTypes WHERE typeID = %s"
+        if self.snapshot is not None:
+            return self.snapshot.get_marketgroup_for_type_id(type_id)
+        sql_query = "SELECT marketGroupID FROM invTypes WHERE typeID = ?"
         return self._lookup_single_id_from_int(sql_query, type_id)
 
     def get_marketgroup_name(self, marketgroup_id):
-        sql_query = "SELECT marketGroupName FROM invMarketGroups WHERE marketGroupID = %s"
+        if self.snapshot is not None:
+            return self.snapshot.get_marketgroup_name(marketgroup_id)
+        sql_query = "SELECT marketGroupName FROM invMarketGroups WHERE marketGroupID = ?"
         return self._lookup_single_string_from_int(sql_query, marketgroup_id)
 
     def get_marketgroup_parentgroup_id(self, marketgroup_id):
-        sql_query = "SELECT parentGroupID FROM invMarketGroups WHERE marketGroupID = %s"
+        if self.snapshot is not None:
+            return self.snapshot.get_marketgroup_parentgroup_id(marketgroup_id)
+        sql_query = "SELECT parentGroupID FROM invMarketGroups WHERE marketGroupID = ?"
         return self._lookup_single_id_from_int(sql_query, marketgroup_id)
 
     def get_marketgroup_top_level_parent(self, marketgroup_id):
@@ -149,45 +190,115 @@ class LookupEveStaticDump(object):
 
 
 
+    # Batch lookup, returns { type_id: 'name' }
+    def get_type_names(self, type_ids):
+        if self.snapshot is not None:
+            return self.snapshot.get_type_names(type_ids)
+        sql_query = "SELECT typeID, typeName FROM invTypes WHERE typeID IN ({})"
+        return self._lookup_batch(sql_query, type_ids, self.UNKNOWN_STRING)
+
+    def get_groups_for_types(self, type_ids):
+        if self.snapshot is not None:
+            return self.snapshot.get_groups_for_types(type_ids)
+        sql_query = "SELECT typeID, groupID FROM invTypes WHERE typeID IN ({})"
+        return self._lookup_batch(sql_query, type_ids, 0)
+
+
     ########################
     # Map
 
     # Name lookup
     def get_solarsystem_name(self, solarsystem_id):
-        sql_query = "SELECT solarSystemName FROM mapSolarSystems WHERE solarSystemID = %s"
+        if self.snapshot is not None:
+            return self.snapshot.get_solarsystem_name(solarsystem_id)
+        sql_query = "SELECT solarSystemName FROM mapSolarSystems WHERE solarSystemID = ?"
         return self._lookup_single_string_from_int(sql_query, solarsystem_id)
 
     def get_constellation_name(self, constellation_id):
-        sql_query = "SELECT constellationName FROM mapConstellations WHERE constellationID = %s"
+        if self.snapshot is not None:
+            return self.snapshot.get_constellation_name(constellation_id)
+        sql_query = "SELECT constellationName FROM mapConstellations WHERE constellationID = ?"
         return self._lookup_single_string_from_int(sql_query, constellation_id)
 
     def get_region_name(self, region_id):
-        sql_query = "SELECT regionName FROM mapRegions WHERE regionID = %s"
+        if self.snapshot is not None:
+            return self.snapshot.get_region_name(region_id)
+        sql_query = "SELECT regionName FROM mapRegions WHERE regionID = ?"
         return self._lookup_single_string_from_int(sql_query, region_id)
 
 
+    # Batch name lookup, returns { id: 'name' }
+    def get_solarsystem_names(self, solarsystem_ids):
+        if self.snapshot is not None:
+            return self.snapshot.get_solarsystem_names(solarsystem_ids)
+        sql_query = "SELECT solarSystemID, solarSystemName FROM mapSolarSystems WHERE solarSystemID IN ({})"
+        return self._lookup_batch(sql_query, solarsystem_ids, self.UNKNOWN_STRING)
+
+    def get_constellation_names(self, constellation_ids):
+        if self.snapshot is not None:
+            return self.snapshot.get_constellation_names(constellation_ids)
+        sql_query = "SELECT constellationID, constellationName FROM mapConstellations WHERE constellationID IN ({})"
+        return self._lookup_batch(sql_query, constellation_ids, self.UNKNOWN_STRING)
+
+    def get_region_names(self, region_ids):
+        if self.snapshot is not None:
+            return self.snapshot.get_region_names(region_ids)
+        sql_query = "SELECT regionID, regionName FROM mapRegions WHERE regionID IN ({})"
+        return self._lookup_batch(sql_query, region_ids, self.UNKNOWN_STRING)
+
+
     # Misc lookup
     def get_solarsystem_security(self, solarsystem_id):
-        sql_query = "SELECT security FROM mapSolarSystems WHERE solarSystemID = %s"
+        if self.snapshot is not None:
+            return self.snapshot.get_solarsystem_security(solarsystem_id)
+        sql_query = "SELECT security FROM mapSolarSystems WHERE solarSystemID = ?"
         return self._lookup_single_string_from_int(sql_query, solarsystem_id)
 
 
     # Cross reference
     def get_solarsystem_constellation(self, solarsystem_id):
-        sql_query = "SELECT constellationID FROM mapSolarSystems WHERE solarSystemID = %s"
+        if self.snapshot is not None:
+            return self.snapshot.get_solarsystem_constellation(solarsystem_id)
+        sql_query = "SELECT constellationID FROM mapSolarSystems WHERE solarSystemID = ?"
         return self._lookup_single_string_from_int(sql_query, solarsystem_id)
 
     def get_solarsystem_region(self, solarsystem_id):
-        sql_query = "SELECT regionID FROM mapSolarSystems WHERE solarSystemID = %s"
+        if self.snapshot is not None:
+            return self.snapshot.get_solarsystem_region(solarsystem_id)
+        sql_query = "SELECT regionID FROM mapSolarSystems WHERE solarSystemID = ?"
         return self._lookup_single_string_from_int(sql_query, solarsystem_id)
 
+    # Batch lookup, returns { solarsystem_id: region_id }
+    def get_solarsystem_regions(self, solarsystem_ids):
+        if self.snapshot is not None:
+            return self.snapshot.get_solarsystem_regions(solarsystem_ids)
+        sql_query = "SELECT solarSystemID, regionID FROM mapSolarSystems WHERE solarSystemID IN ({})"
+        return self._lookup_batch(sql_query, solarsystem_ids, 0)
+
+    # Every solar system joined with its region and constellation names. Returns a list of
+    # (solarsystem_id, name, region_id, region_name, constellation_id, constellation_name, security)
+    def get_all_solarsystems(self):
+        if self.snapshot is not None:
+            return self.snapshot.get_all_solarsystems()
+        sql_query = (
+            "SELECT s.solarSystemID, s.solarSystemName, s.regionID, r.regionName, s.constellationID, "
+            "c.constellationName, s.security FROM mapSolarSystems s "
+            "LEFT JOIN mapRegions r ON r.regionID = s.regionID "
+            "LEFT JOIN mapConstellations c ON c.constellationID = s.constellationID"
+        )
+        return self._execute(sql_query)
+
     def get_all_solarsystem_id_by_security(self, min_security, max_security):
-        sql_query = "SELECT solarSystemID FROM mapSolarSystems WHERE security BETWEEN %s AND %s"
+        if self.snapshot is not None:
+            return self.snapshot.get_all_solarsystem_id_by_security(min_security, max_security)
+        sql_query = "SELECT solarSystemID FROM mapSolarSystems WHERE security BETWEEN ? AND ?"
         return self._lookup_multirow_two_float(sql_query, min_security, max_security)
 
 
     def get_jumps_in_solarsystem(self, solarsystem_id):
-        sql_query = "SELECT toSolarSystemID FROM mapSolarSystemJumps WHERE fromSolarSystemID = %s"
+        if self.snapshot is not None:
+            return self.snapshot.get_jumps_in_solarsystem(solarsystem_id)
+        sql_query = "SELECT toSolarSystemID FROM mapSolarSystemJumps WHERE fromSolarSystemID = ?"
         result =  self._lookup_multirow_int(sql_query, solarsystem_id)
         if not isinstance(result, list):    # TODO improve error checking
             raise LookupEveStaticDumpException('Invalid Result')
@@ -198,56 +309,38 @@ class LookupEveStaticDump(object):
     # ################################3
     # Routes
 
-    # Find a route between two systems in the universe
-    def find_route(self, start_solarsystem_id, target_solarsystem_id):
-        def make_route_dict(from_system_id, distance):
-            return {'from_system_id': from_system_id, 'distance': distance}
-
-        sanity = 250    # Maximum route size before abort
-        list_route_dict = {}
-        list_to_walk = {}
-        is_route_found = False
-
-        # Start the list_to_walk off with the target_solarsystem_id, and a from_system_id/distance to nowhere.
-        list_to_walk[target_solarsystem_id] = make_route_dict(0, 0)
-
-        # As long as list_to_walk has systems to jump into, jump into those systems, get a list of their exits,
-        # jump through those exits, and repeat until we find the start_solarsystem_id or run out of exits
-        # Stop as soon as start_solarsystem_id is found
-        while not is_route_found and len(list_to_walk) > 0 and sanity > 0:
-            sanity -= 1
-            new_to_walk = {}
-            for item_system_id, item_value in list_to_walk.items():
-                exit_list = self.get_jumps_in_solarsystem(item_system_id)
-                new_distance = item_value['distance'] + 1
+    # Load mapSolarSystemJumps once into an in-memory graph, and precompute all distances from the home system
+    # A snapshot already holds the graph in CSR form, so it is used in place without copying
+    def get_universe_graph(self):
+        with self.lock:
+            if self.universe_graph is not None:
+                return self.universe_graph
 
-                for exit in exit_list:
-                    if exit not in list_route_dict.keys():
-                        new_to_walk[exit] = make_route_dict(item_system_id, new_distance)
-                        list_route_dict[exit] = make_route_dict(item_system_id, new_distance)
-                        if exit == start_solarsystem_id:
-                            is_route_found = True
-                            break
-
-            list_to_walk = new_to_walk
-
-        # Should never happen
-        if sanity <= 0:
-            raise LookupEveStaticDumpException(f'{__file__} : find_route() sanity exceeded!')
-
-        # If we did not find a route, return an empty list
-        if not is_route_found:
-            return []
-
-        # Using the list_route_dict that we created, walk from start to target to produce the shortest_route list
-        current_system = start_solarsystem_id
-        shortest_route = []
-
-        while current_system != target_solarsystem_id:
-            shortest_route.append(current_system)
-            current_system = list_route_dict[current_system]['from_system_id']
+            if self.snapshot is not None:
+                graph = UniverseGraph(*self.snapshot.get_jump_graph_arrays())
+            else:
+                sql_query = "SELECT fromSolarSystemID, toSolarSystemID FROM mapSolarSystemJumps"
+                graph = UniverseGraph.from_jumps(self._execute(sql_query))
 
-        # shortest_route is a list of solarsystem_id that form a route from start to target
-        return shortest_route
+            if HOME_SYSTEM_ID in graph:
+                graph.precompute(HOME_SYSTEM_ID)
+            self.universe_graph = graph
+            return graph
 
+    # Find a route between two systems in the universe
+    # Returns a list of solarsystem_id starting with start_solarsystem_id and ending with the system before
+    # target_solarsystem_id, or an empty list if no route exists.
+    def find_route(self, start_solarsystem_id, target_solarsystem_id):
+        try:
+            with self.lock:
+                return self.get_universe_graph().find_route(start_solarsystem_id, target_solarsystem_id)
+        except UniverseGraphException as e:
+            raise LookupEveStaticDumpException(f'error finding route - [{e}]')
 
+    # Number of jumps between two systems, or -1 if no route exists
+    def get_jump_count(self, start_solarsystem_id, target_solarsystem_id):
+        try:
+            with self.lock:
+                return self.get_universe_graph().get_jump_count(start_solarsystem_id, target_solarsystem_id)
+        except UniverseGraphException as e:
+            raise LookupEveStaticDumpException(f'error counting jumps - [{e}]')
@@ -0,0 +1,277 @@
+'''
+    Latency histograms and counters for the listener and hook_bot.
+
+    Metrics are registered once, by name and labels, and updated from the hot path:
+        FETCH_SECONDS = metrics.histogram('zkb_stage_seconds', 'Seconds spent in each pipeline stage', stage='fetch')
+        start = time.perf_counter()
+        ...
+        FETCH_SECONDS.observe(time.perf_counter() - start)
+    An update is a bucket search and two additions under a lock of its own, around a microsecond.
+
+    The registry can be read two ways:
+        - MetricsServer serves the Prometheus text format on http://<host>:<port>/metrics
+        - SnapshotWriter writes a json snapshot to a file every interval seconds, replacing it atomically
+    Histograms keep cumulative bucket counts, their sum and count, the same as Prometheus histograms. Snapshots also
+    carry estimated percentiles.
+'''
+
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MetricsException(Exception):
+    '''Raise whenever any error or exception occurs'''
+
+
+# Seconds, from a fast sqlite insert to a slow ESI request
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Seconds from killmail_time, killmails reach RedisQ seconds to hours after they happened
+LAG_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1800, 3600, 3 * 3600, 12 * 3600)
+
+
+class Counter(object):
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram(object):
+    '''
+        buckets are the upper bounds of the buckets, ascending. Observations above the last bound are only counted in
+        the +Inf bucket.
+    '''
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # counts[i] counts observations in bucket i only, the last one is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    # Bucket upper bound holding the given share of observations, '+Inf' above the last bucket, None before the
+    # first observation
+    def percentile(self, share, counts=None, count=None):
+        counts = counts if counts is not None else self.counts
+        count = count if count is not None else self.count
+        if not count:
+            return None
+        rank = share * count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound if bound != float('inf') else '+Inf'
+        return '+Inf'
+
+    def snapshot(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+        return {
+            'count': count,
+            'sum': round(total, 6),
+            'buckets': {str(bound): sum(counts[:i + 1]) for i, bound in enumerate(self.buckets)},
+            'p50': self.percentile(0.5, counts, count),
+            'p90': self.percentile(0.9, counts, count),
+            'p99': self.percentile(0.99, counts, count),
+        }
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        # { (name, labels): metric }, labels is a sorted tuple of (key, value)
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, help, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = self.metrics[key] = cls(name, help, key[1], *args)
+            elif not isinstance(metric, cls):
+                raise MetricsException(f'[{name}] is already registered as a {type(metric).__name__}')
+            return metric
+
+    def counter(self, name, help='', **labels):
+        return self._get_or_create(Counter, name, help, labels)
+
+    def histogram(self, name, help='', buckets=LATENCY_BUCKETS, **labels):
+        return self._get_or_create(Histogram, name, help, labels, buckets)
+
+    def _sorted(self):
+        with self.lock:
+            return sorted(self.metrics.items(), key=lambda x: x[0])
+
+    '''
+        { name: [ { 'labels': {...}, 'value': n } or { 'labels': {...}, 'count', 'sum', 'buckets', 'p50', ... } ] }
+    '''
+    def snapshot(self):
+        metrics = {}
+        for (name, labels), metric in self._sorted():
+            entry = {'labels': dict(labels)}
+            if isinstance(metric, Counter):
+                entry['value'] = metric.snapshot()
+            else:
+                entry.update(metric.snapshot())
+            metrics.setdefault(name, []).append(entry)
+        return metrics
+
+    # The Prometheus text exposition format
+    def to_prometheus(self):
+        lines = []
+        last_name = None
+        for (name, labels), metric in self._sorted():
+            if name != last_name:
+                kind = 'counter' if isinstance(metric, Counter) else 'histogram'
+                lines.append(f'# HELP {name} {metric.help}')
+                lines.append(f'# TYPE {name} {kind}')
+                last_name = name
+            if isinstance(metric, Counter):
+                lines.append(f'{name}{format_labels(labels)} {metric.snapshot()}')
+                continue
+            snapshot = metric.snapshot()
+            for bound, count in snapshot['buckets'].items():
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {count}')
+            lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {snapshot["count"]}')
+            lines.append(f'{name}_sum{format_labels(labels)} {snapshot["sum"]}')
+            lines.append(f'{name}_count{format_labels(labels)} {snapshot["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+# The registry the listener, hook_bot and the tools they use record into
+REGISTRY = MetricsRegistry()
+
+def counter(name, help='', **labels):
+    return REGISTRY.counter(name, help, **labels)
+
+def histogram(name, help='', buckets=LATENCY_BUCKETS, **labels):
+    return REGISTRY.histogram(name, help, buckets, **labels)
+
+# Lag of a killmail from its killmail_time, for LAG_BUCKETS histograms. timestamp is a unix time.
+def observe_lag(histogram, timestamp):
+    histogram.observe(max(0.0, time.time() - timestamp))
+
+
+# ######################################################################################################
+# Exposition
+
+class MetricsServer(object):
+    '''
+        Serve a registry in the Prometheus text format on http://host:port/metrics, from a background thread
+    '''
+    def __init__(self, port, host='127.0.0.1', registry=REGISTRY):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.httpd = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/metrics', '/metrics/'):
+                    self.send_error(404)
+                    return
+                payload = registry.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        except OSError as e:
+            raise MetricsException(f'could not serve metrics on {self.host}:{self.port} [{e}]')
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, name='metrics_server', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+
+class SnapshotWriter(object):
+    '''
+        Write a json snapshot of a registry to path every interval seconds, from a background thread
+    '''
+    def __init__(self, path, interval=60.0, registry=REGISTRY):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.stop_event = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, name='metrics_snapshot', daemon=True).start()
+        return self
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.write()
+
+    # Replace the file atomically, so readers never see half a snapshot
+    def write(self):
+        temp_path = f'{self.path}.tmp'
+        try:
+            with open(temp_path, 'w') as fp:
+                json.dump({'time': time.time(), 'metrics': self.registry.snapshot()}, fp)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f'   xxx Could not write metrics snapshot [{self.path}] - [{e}]')
+
+    def stop(self):
+        self.stop_event.set()
+        self.write()
+
+'''
+    Start the exposition configured on the command line. port 0 and path None leave that one out.
+'''
+def start_exposition(port=0, path=None, interval=60.0, registry=REGISTRY):
+    started = []
+    if port:
+        server = MetricsServer(port, registry=registry).start()
+        print(f'--- Metrics on http://{server.host}:{server.port}/metrics')
+        started.append(server)
+    if path:
+        started.append(SnapshotWriter(path, interval, registry).start())
+    return started
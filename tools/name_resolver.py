@@ -0,0 +1,193 @@
+'''
+    Tiered resolver for character, corporation, and alliance names.
+
+    Names are looked for in three places, cheapest first:
+        1. An in-process LRU cache
+        2. The name tables of the RedisqCache sqlite database
+        3. ESI, only for ids that were not found or whose entry is older than the TTL of that entity type
+    Names fetched from ESI are written back to sqlite and the LRU.
+
+    Corporation and alliance names almost never change, so they are kept much longer than character names.
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+from tools import metrics
+from tools.esi_bulk_names import EsiBulkNames
+from tools.redisq_cache import RedisqCacheException
+
+
+class NameResolver(object):
+    # Names dictionary key : RedisqCache table
+    ENTITY_TABLES = {
+        'character_ids': 'characters',
+        'corporation_ids': 'corporations',
+        'alliance_ids': 'alliances',
+    }
+    DEFAULT_TTL = {
+        'character_ids': 60 * 60 * 24 * 7,          # 1 week
+        'corporation_ids': 60 * 60 * 24 * 30,       # 30 days
+        'alliance_ids': 60 * 60 * 24 * 30,          # 30 days
+    }
+    DEFAULT_LRU_SIZE = 50000
+
+    '''
+        cache is the RedisqCache holding the name tables.
+        fetch_names(character_ids, corporation_ids, alliance_ids) resolves names that are not cached, and returns
+        the same dictionary as lookup_esi_names.bulk_lookup_names(). Defaults to one POST /universe/names/ request
+        per 1000 ids through EsiBulkNames.
+        ttl overrides DEFAULT_TTL for any of the entity types, in seconds.
+    '''
+    def __init__(self, cache, fetch_names=None, lru_size=DEFAULT_LRU_SIZE, ttl=None):
+        if fetch_names is None:
+            fetch_names = EsiBulkNames().bulk_lookup_names
+        self.cache = cache
+        self.fetch_names = fetch_names
+        self.lru_size = lru_size
+        self.ttl = dict(self.DEFAULT_TTL)
+        self.ttl.update(ttl or {})
+        self.lru = {key: OrderedDict() for key in self.ENTITY_TABLES}
+        self.lock = threading.Lock()
+        self.stats = {'lru_hits': 0, 'sqlite_hits': 0, 'esi_lookups': 0, 'esi_requests': 0, 'esi_errors': 0}
+        self.esi_seconds = metrics.histogram('zkb_stage_seconds', 'Seconds spent in each listener stage',
+                                             stage='esi_names')
+
+
+    # ################################
+    # LRU
+
+    # Returns the names that are in the LRU and not expired, and the ids that still need a lookup
+    def _lookup_lru(self, key, ids, now):
+        found = {}
+        missing = []
+        lru = self.lru[key]
+        with self.lock:
+            for id in ids:
+                entry = lru.get(id)
+                if entry is not None and now - entry[1] < self.ttl[key]:
+                    lru.move_to_end(id)
+                    found[id] = entry[0]
+                else:
+                    missing.append(id)
+            self.stats['lru_hits'] += len(found)
+        return found, missing
+
+    def _store_lru(self, key, entries):
+        lru = self.lru[key]
+        with self.lock:
+            for id, entry in entries.items():
+                lru[id] = entry
+                lru.move_to_end(id)
+            while len(lru) > self.lru_size:
+                lru.popitem(last=False)
+
+
+    # ################################
+    # Lookups
+
+    '''
+        Resolve names for lists of ids. Duplicates and the invalid id 0 are ignored.
+        Returns {
+            'character_ids': { character_id: 'name' },
+            'corporation_ids': { corporation_id: 'name' },
+            'alliance_ids': { alliance_id: 'name' }
+        }
+        Each dictionary also maps 0 to an empty string, the same as lookup_esi_names.bulk_lookup_names()
+    '''
+    def resolve(self, character_ids, corporation_ids, alliance_ids):
+        now = int(time.time())
+        requested = {
+            'character_ids': {x for x in character_ids if x},
+            'corporation_ids': {x for x in corporation_ids if x},
+            'alliance_ids': {x for x in alliance_ids if x},
+        }
+        names = {key: {} for key in self.ENTITY_TABLES}
+        stale = {key: {} for key in self.ENTITY_TABLES}
+        to_fetch = {}
+
+        for key, table in self.ENTITY_TABLES.items():
+            found, missing = self._lookup_lru(key, requested[key], now)
+            names[key].update(found)
+            if not missing:
+                to_fetch[key] = []
+                continue
+
+            try:
+                cached = self.cache.lookup_names(table, missing)
+            except RedisqCacheException as e:
+                print(f'   xxx Name cache lookup failed [{e}]')
+                cached = {}
+
+            fresh = {}
+            for id, (name, updated) in cached.items():
+                if now - updated < self.ttl[key]:
+                    fresh[id] = (name, updated)
+                else:
+                    stale[key][id] = name
+            self._count('sqlite_hits', len(fresh))
+            self._store_lru(key, fresh)
+            names[key].update({id: entry[0] for id, entry in fresh.items()})
+            to_fetch[key] = [x for x in missing if x not in fresh]
+
+        if any(to_fetch.values()):
+            fetched = self._fetch(to_fetch, now)
+            for key in self.ENTITY_TABLES:
+                # Fall back to an expired name if ESI could not refresh it
+                for id in to_fetch[key]:
+                    if id in fetched[key]:
+                        names[key][id] = fetched[key][id]
+                    elif id in stale[key]:
+                        names[key][id] = stale[key][id]
+
+        for key in self.ENTITY_TABLES:
+            names[key][0] = ''
+        return names
+
+    # Fetch names from ESI and write them back to sqlite and the LRU
+    def _fetch(self, to_fetch, now):
+        self._count('esi_requests', 1)
+        self._count('esi_lookups', sum(len(x) for x in to_fetch.values()))
+        start = time.perf_counter()
+        try:
+            fetched = self.fetch_names(to_fetch['character_ids'], to_fetch['corporation_ids'],
+                                       to_fetch['alliance_ids'])
+            self.esi_seconds.observe(time.perf_counter() - start)
+        except Exception as e:
+            self._count('esi_errors', 1)
+            print(f'   xxx ESI name lookup failed [{e}]')
+            return {key: {} for key in self.ENTITY_TABLES}
+
+        for key, table in self.ENTITY_TABLES.items():
+            entries = {id: name for id, name in fetched.get(key, {}).items() if id != 0}
+            fetched[key] = entries
+            if not entries:
+                continue
+            self._store_lru(key, {id: (name, now) for id, name in entries.items()})
+            try:
+                self.cache.insert_names(table, entries, now)
+            except RedisqCacheException as e:
+                print(f'   xxx Name cache insert failed [{e}]')
+        return fetched
+
+    # Enrichment workers resolve names on several threads, every counter is updated under the lock
+    def _count(self, name, amount):
+        with self.lock:
+            self.stats[name] += amount
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    '''
+        Resolve all character, corporation, and alliances in a killmail
+        Returns the same dictionary as lookup_esi_names.get_names_for_killmail()
+    '''
+    def get_names_for_killmail(self, killmail):
+        entities = [killmail['victim']] + killmail['attackers']
+        return self.resolve(
+            [x.get('character_id', 0) for x in entities],
+            [x.get('corporation_id', 0) for x in entities],
+            [x.get('alliance_id', 0) for x in entities]
+        )
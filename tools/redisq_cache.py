@@ -1,78 +1,726 @@
 '''
-    Caches killmails retreived from zkillboard.
-    TODO: Cache character, corpotation, and alliance names.
+    Caches killmails retreived from zkillboard, and character, corporation, and alliance names resolved from ESI.
+
+    Besides the raw killmail json, every killmail is indexed into `killmail_index` (time, location, victim, attacker
+    count, value) and `killmail_attackers` (one row per attacker), so history can be queried without parsing json.
+
+    Killmail json is stored compressed with a dictionary trained on the archive itself, see tools/killmail_codec.py.
+    Until enough killmails exist to train one, and for databases written before compression, killmails are plain text.
+    lookup_killmail() returns the json string either way.
+
+    `broadcasts` maps the (epoch, sequence) numbers the listener broadcast killmails under to killmail ids, so
+    subscribers that dropped messages can have them sent again from the archive.
 '''
 
 import sqlite3
 import os
+import calendar
+import json
+import queue
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
 
 from data.definitions import ROOT_DIR
+from tools.killmail_codec import KillmailCodec, KillmailCodecException
+from tools import metrics
 
 class RedisqCacheException(Exception):
     '''Raise whenever any error or exception occurs'''
 
 class RedisqCache(object):
     DEFAULT_PATH = os.path.join(ROOT_DIR, 'cache/zkb_redisq/zkb_cache.sqlite')
-    CREATE_CHARACTERS = 'CREATE TABLE IF NOT EXISTS `characters` (`id`  INTEGER NOT NULL,`name`  TEXT NOT NULL,PRIMARY KEY(`id`));'
-    CREATE_CORPORATIONS = 'CREATE TABLE IF NOT EXISTS `corporations` (`id`  INTEGER NOT NULL,`name`  TEXT NOT NULL,PRIMARY KEY(`id`));'
-    CREATE_ALLIANCES = 'CREATE TABLE IF NOT EXISTS `alliances` (`id`  INTEGER NOT NULL,`name`  TEXT NOT NULL,PRIMARY KEY(`id`));'
+    CREATE_CHARACTERS = 'CREATE TABLE IF NOT EXISTS `characters` (`id`  INTEGER NOT NULL,`name`  TEXT NOT NULL,`updated`  INTEGER NOT NULL DEFAULT 0,PRIMARY KEY(`id`));'
+    CREATE_CORPORATIONS = 'CREATE TABLE IF NOT EXISTS `corporations` (`id`  INTEGER NOT NULL,`name`  TEXT NOT NULL,`updated`  INTEGER NOT NULL DEFAULT 0,PRIMARY KEY(`id`));'
+    CREATE_ALLIANCES = 'CREATE TABLE IF NOT EXISTS `alliances` (`id`  INTEGER NOT NULL,`name`  TEXT NOT NULL,`updated`  INTEGER NOT NULL DEFAULT 0,PRIMARY KEY(`id`));'
     CREATE_KILLMAILS = 'CREATE TABLE IF NOT EXISTS `killmails` (`id` INTEGER NOT NULL, `killmail` TEXT NOT NULL, PRIMARY KEY(`id`));'
+    CREATE_KILLMAIL_INDEX = (
+        'CREATE TABLE IF NOT EXISTS `killmail_index` (`id` INTEGER NOT NULL, `killmail_time` INTEGER NOT NULL, '
+        '`solar_system_id` INTEGER NOT NULL, `region_id` INTEGER, `ship_type_id` INTEGER, '
+        '`victim_character_id` INTEGER, `victim_corporation_id` INTEGER, `victim_alliance_id` INTEGER, '
+        '`attacker_count` INTEGER NOT NULL, `total_value` REAL, PRIMARY KEY(`id`));'
+    )
+    CREATE_KILLMAIL_ATTACKERS = (
+        'CREATE TABLE IF NOT EXISTS `killmail_attackers` (`killmail_id` INTEGER NOT NULL, `character_id` INTEGER, '
+        '`corporation_id` INTEGER, `alliance_id` INTEGER, `ship_type_id` INTEGER, `final_blow` INTEGER NOT NULL);'
+    )
+    CREATE_INDEXES = (
+        'CREATE INDEX IF NOT EXISTS `idx_killmail_time` ON `killmail_index` (`killmail_time`);',
+        'CREATE INDEX IF NOT EXISTS `idx_killmail_region` ON `killmail_index` (`region_id`, `killmail_time`);',
+        'CREATE INDEX IF NOT EXISTS `idx_killmail_system` ON `killmail_index` (`solar_system_id`, `killmail_time`);',
+        'CREATE INDEX IF NOT EXISTS `idx_killmail_ship` ON `killmail_index` (`ship_type_id`, `killmail_time`);',
+        'CREATE INDEX IF NOT EXISTS `idx_killmail_victim_character` ON `killmail_index` (`victim_character_id`);',
+        'CREATE INDEX IF NOT EXISTS `idx_killmail_victim_corporation` ON `killmail_index` (`victim_corporation_id`);',
+        'CREATE INDEX IF NOT EXISTS `idx_killmail_victim_alliance` ON `killmail_index` (`victim_alliance_id`);',
+        'CREATE INDEX IF NOT EXISTS `idx_attacker_killmail` ON `killmail_attackers` (`killmail_id`);',
+        'CREATE INDEX IF NOT EXISTS `idx_attacker_character` ON `killmail_attackers` (`character_id`);',
+        'CREATE INDEX IF NOT EXISTS `idx_attacker_corporation` ON `killmail_attackers` (`corporation_id`);',
+        'CREATE INDEX IF NOT EXISTS `idx_attacker_alliance` ON `killmail_attackers` (`alliance_id`);',
+        'CREATE INDEX IF NOT EXISTS `idx_broadcast_killmail` ON `broadcasts` (`killmail_id`);',
+    )
+    CREATE_DICTIONARIES = (
+        'CREATE TABLE IF NOT EXISTS `killmail_dictionaries` (`id` INTEGER NOT NULL, `codec` INTEGER NOT NULL, '
+        '`dictionary` BLOB NOT NULL, `created` INTEGER NOT NULL, PRIMARY KEY(`id`));'
+    )
+    CREATE_BROADCASTS = (
+        'CREATE TABLE IF NOT EXISTS `broadcasts` (`epoch` INTEGER NOT NULL, `sequence` INTEGER NOT NULL, '
+        '`killmail_id` INTEGER NOT NULL, PRIMARY KEY(`epoch`, `sequence`));'
+    )
+    INDEX_COLUMNS = ('id', 'killmail_time', 'solar_system_id', 'region_id', 'ship_type_id', 'victim_character_id',
+                     'victim_corporation_id', 'victim_alliance_id', 'attacker_count', 'total_value')
+    NAME_TABLES = ('characters', 'corporations', 'alliances')
+    BATCH_SIZE = 500    # Maximum ids bound into a single IN (...) query
+    TRAIN_MIN_SAMPLES = 500     # Killmails needed before a compression dictionary is trained
+    TRAIN_SAMPLES = 5000        # Most recent killmails a dictionary is trained on
 
-    def __init__(self):
-            self.first_check_of_database()
+    '''
+        region_lookup(solar_system_id) returns the region of a solar system for the killmail index. Without it the
+        region column is left empty.
+        compression is 'auto' (zstd when installed, otherwise zlib), 'zstd', 'zlib', or 'none' to store new
+        killmails as plain text. Compressed killmails are always readable.
+    '''
+    def __init__(self, db_path=DEFAULT_PATH, region_lookup=None, compression='auto'):
+        self.db_path = db_path
+        self.region_lookup = region_lookup
+        try:
+            self.compression_codec = KillmailCodec.select_codec(compression)
+        except KillmailCodecException as e:
+            raise RedisqCacheException(str(e))
+        self.untrained_inserts = 0
+        self.first_check_of_database()
+        self.codec = self.load_codec()
+        if self.codec.active_id is None and self.compression_codec is not None:
+            self.train_codec()
 
     # Try opening the database and create needed tables if they do not exist.
     def first_check_of_database(self):
         db = self.connect_to_sql()
         cursor = db.cursor()
         try:
+            # Write ahead logging lets readers work while the writer commits, and is stored in the database file
+            cursor.execute('PRAGMA journal_mode=WAL')
             cursor.execute(self.CREATE_CHARACTERS)
             cursor.execute(self.CREATE_CORPORATIONS)
             cursor.execute(self.CREATE_ALLIANCES)
             cursor.execute(self.CREATE_KILLMAILS)
+            cursor.execute(self.CREATE_KILLMAIL_INDEX)
+            cursor.execute(self.CREATE_KILLMAIL_ATTACKERS)
+            cursor.execute(self.CREATE_DICTIONARIES)
+            cursor.execute(self.CREATE_BROADCASTS)
+            for create_index in self.CREATE_INDEXES:
+                cursor.execute(create_index)
+            # Name tables created before names were cached have no `updated` column
+            for table in self.NAME_TABLES:
+                columns = [x[1] for x in cursor.execute(f'PRAGMA table_info(`{table}`)')]
+                if 'updated' not in columns:
+                    cursor.execute(f'ALTER TABLE `{table}` ADD COLUMN `updated` INTEGER NOT NULL DEFAULT 0')
             db.commit()
         except sqlite3.Error as e:
             raise RedisqCacheException(f'sqlite error opening killmail cache database - [{e}]')
+        finally:
+            db.close()
 
 
     # Connect to the sqlite3 file and return a connection handle.
-    def connect_to_sql(self, db_path=DEFAULT_PATH):
+    # With WAL, synchronous=NORMAL only syncs at checkpoints. A power loss can drop the last commits, but can never
+    # corrupt the database.
+    def connect_to_sql(self, db_path=None):
+        if db_path is None:
+            db_path = self.db_path
         try:
             con = sqlite3.connect(db_path)
+            con.execute('PRAGMA synchronous=NORMAL')
         except sqlite3.Error as e:
             raise RedisqCacheException(f'sqlite error connecting to database - [{db_path}] - [{e}]')
 
         return con
 
-    # Either return a string name or None to indicate that the name is not in the database
-    def _lookup_single_item(self, query_string):
+    # Either return a single value or None to indicate that the row is not in the database
+    def _lookup_single_item(self, query_string, parameters=()):
         db = self.connect_to_sql()
         cursor = db.cursor()
         try:
-            cursor.execute(query_string)
+            cursor.execute(query_string, parameters)
             result = cursor.fetchone()
             if result is None:
                 return None
             return result[0]
         except sqlite3.Error as e:
             raise RedisqCacheException(f'sqlite error performing query - [{e}] - [{query_string}]')
+        finally:
+            db.close()
 
-    # Get a killmail by id
+    # Get a killmail by id, returns the killmail json string or None
     def lookup_killmail(self, killmail_id):
-        sql_query = f'SELECT name FROM killmails WHERE id = {killmail_id}'
-        return self._lookup_single_item(sql_query)
+        sql_query = 'SELECT killmail FROM killmails WHERE id = ?'
+        return self.decode_killmail(self._lookup_single_item(sql_query, (killmail_id,)))
+
+    # Get many killmails, returns { killmail_id: killmail json string } for the ids that are in the database
+    def lookup_killmails(self, killmail_ids):
+        killmail_ids = list(killmail_ids)
+        killmails = {}
+        db = self.connect_to_sql()
+        try:
+            for i in range(0, len(killmail_ids), self.BATCH_SIZE):
+                chunk = killmail_ids[i:i + self.BATCH_SIZE]
+                sql_query = f'SELECT id, killmail FROM killmails WHERE id IN ({",".join("?" * len(chunk))})'
+                for killmail_id, killmail in db.execute(sql_query, chunk):
+                    killmails[killmail_id] = self.decode_killmail(killmail)
+        except sqlite3.Error as e:
+            raise RedisqCacheException(f'sqlite error looking up killmails - [{e}]')
+        finally:
+            db.close()
+        return killmails
 
-    # Add a killmail to the database
+    # Set of the killmail ids that are in the database, without reading the killmails
+    def archived_killmail_ids(self, killmail_ids):
+        db = self.connect_to_sql()
+        try:
+            return self._existing_killmail_ids(db, list(killmail_ids))
+        except sqlite3.Error as e:
+            raise RedisqCacheException(f'sqlite error looking up killmail ids - [{e}]')
+        finally:
+            db.close()
+
+
+    # Add a killmail to the database, killmail is the json string
     def insert_killmail(self, killmail_id, killmail):
+        self.insert_killmails([(killmail_id, killmail, None)])
+
+    '''
+        Add many killmails in a single transaction, rows is a list of (killmail_id, killmail_string, killmail_dict).
+        killmail_dict is the parsed killmail used to fill the index tables, when it is None the string is parsed.
+        Pass an open connection to reuse it, otherwise one is opened and closed for this call.
+    '''
+    def insert_killmails(self, rows, db=None):
+        close_db = db is None
+        if close_db:
+            db = self.connect_to_sql()
+
+        sql_query = f'INSERT OR IGNORE INTO Killmails (id, killmail) VALUES (?, ?);'
+        try:
+            with db:
+                # RedisQ can deliver the same killmail more than once, and another process can archive it at the
+                # same time, keep the first copy. Only killmails this transaction inserted are indexed.
+                new_rows = []
+                codec = self.codec
+                for row in rows:
+                    if db.execute(sql_query, (row[0], codec.encode(row[1]))).rowcount == 1:
+                        new_rows.append(row)
+                self._insert_index_rows(db, new_rows)
+
+            # A new archive is stored as text until there are enough killmails to train a dictionary on
+            if codec.active_id is None and self.compression_codec is not None:
+                self.untrained_inserts += len(new_rows)
+                if self.untrained_inserts >= self.TRAIN_MIN_SAMPLES:
+                    self.untrained_inserts = 0
+                    self.train_codec(db)
+        except sqlite3.Error as e:
+            raise RedisqCacheException(f'sqlite error inserting {len(rows)} killmails - [{e}] - [{sql_query}]')
+        finally:
+            if close_db:
+                db.close()
+
+    def _existing_killmail_ids(self, db, killmail_ids):
+        existing = set()
+        for i in range(0, len(killmail_ids), self.BATCH_SIZE):
+            chunk = killmail_ids[i:i + self.BATCH_SIZE]
+            sql_query = f'SELECT id FROM killmails WHERE id IN ({",".join("?" * len(chunk))})'
+            existing.update(x[0] for x in db.execute(sql_query, chunk))
+        return existing
+
+    # Fill killmail_index and killmail_attackers for (killmail_id, killmail_string, killmail_dict) rows
+    def _insert_index_rows(self, db, rows):
+        index_rows = []
+        attacker_rows = []
+        for killmail_id, killmail_string, killmail in rows:
+            try:
+                if killmail is None:
+                    killmail = json.loads(killmail_string)
+                index_row, attackers = extract_killmail_index(killmail, self.region_lookup)
+            except (ValueError, KeyError, TypeError) as e:
+                print(f'   xxx Could not index killmail {killmail_id} [{e}]')
+                continue
+            index_rows.append(index_row)
+            attacker_rows += attackers
+
+        columns = ', '.join(self.INDEX_COLUMNS)
+        db.executemany(f'INSERT OR REPLACE INTO killmail_index ({columns}) '
+                       f'VALUES ({", ".join("?" * len(self.INDEX_COLUMNS))})', index_rows)
+        db.executemany('INSERT INTO killmail_attackers (killmail_id, character_id, corporation_id, alliance_id, '
+                       'ship_type_id, final_blow) VALUES (?, ?, ?, ?, ?, ?)', attacker_rows)
+
+    '''
+        Index killmails that were saved before the index tables existed. Works through the archive batch_size rows
+        at a time, returns the number of killmails indexed.
+    '''
+    def reindex_killmails(self, batch_size=1000):
         db = self.connect_to_sql()
-        cursor = db.cursor()
+        indexed = 0
+        sql_query = ('SELECT id, killmail FROM killmails WHERE id > ? AND id NOT IN (SELECT id FROM killmail_index) '
+                     'ORDER BY id LIMIT ?')
+        try:
+            last_id = 0
+            while True:
+                rows = db.execute(sql_query, (last_id, batch_size)).fetchall()
+                if not rows:
+                    break
+                with db:
+                    self._insert_index_rows(db, [(x[0], self.decode_killmail(x[1]), None) for x in rows])
+                indexed += len(rows)
+                last_id = rows[-1][0]
+        except sqlite3.Error as e:
+            raise RedisqCacheException(f'sqlite error indexing killmails - [{e}]')
+        finally:
+            db.close()
+        return indexed
+
+
+    # ################################
+    # Broadcasts
+
+    # Set of the killmail ids that were broadcast, in any epoch
+    def broadcast_killmail_ids(self, killmail_ids):
+        killmail_ids = list(killmail_ids)
+        broadcast = set()
+        db = self.connect_to_sql()
+        try:
+            for i in range(0, len(killmail_ids), self.BATCH_SIZE):
+                chunk = killmail_ids[i:i + self.BATCH_SIZE]
+                sql_query = f'SELECT killmail_id FROM broadcasts WHERE killmail_id IN ({",".join("?" * len(chunk))})'
+                broadcast.update(x[0] for x in db.execute(sql_query, chunk))
+        except sqlite3.Error as e:
+            raise RedisqCacheException(f'sqlite error looking up broadcasts - [{e}]')
+        finally:
+            db.close()
+        return broadcast
+
+    # Highest killmail id that was broadcast, 0 before the first broadcast
+    def max_broadcast_killmail_id(self):
+        return self._lookup_single_item('SELECT MAX(killmail_id) FROM broadcasts') or 0
+
+    # Record which killmails were broadcast, rows is a list of BroadcastRow
+    def insert_broadcasts(self, rows, db=None):
+        close_db = db is None
+        if close_db:
+            db = self.connect_to_sql()
+        sql_query = 'INSERT OR REPLACE INTO broadcasts (epoch, sequence, killmail_id) VALUES (?, ?, ?);'
+        try:
+            with db:
+                db.executemany(sql_query, rows)
+        except sqlite3.Error as e:
+            raise RedisqCacheException(f'sqlite error inserting {len(rows)} broadcasts - [{e}] - [{sql_query}]')
+        finally:
+            if close_db:
+                db.close()
+
+    '''
+        Killmails broadcast in epoch with a sequence after `after`, and up to until when it is not None, oldest
+        first. region_ids limits them to killmails indexed in those regions when it is not None.
+        Returns a list of (sequence, killmail_id, killmail json string), broadcasts of killmails that are not in the
+        archive are left out.
+    '''
+    def lookup_broadcasts(self, epoch, after, until=None, region_ids=None, limit=1000):
+        clauses = ['b.epoch = ?', 'b.sequence > ?']
+        parameters = [epoch, after]
+        if until is not None:
+            clauses.append('b.sequence <= ?')
+            parameters.append(until)
+        if region_ids is not None:
+            region_ids = list(region_ids)
+            clauses.append(f'b.killmail_id IN (SELECT id FROM killmail_index WHERE region_id IN '
+                           f'({",".join("?" * len(region_ids))}))')
+            parameters += region_ids
+        parameters.append(limit)
+
+        sql_query = (f'SELECT b.sequence, b.killmail_id, k.killmail FROM broadcasts b '
+                     f'JOIN killmails k ON k.id = b.killmail_id WHERE {" AND ".join(clauses)} '
+                     f'ORDER BY b.sequence LIMIT ?')
+        db = self.connect_to_sql()
+        try:
+            return [(sequence, killmail_id, self.decode_killmail(killmail))
+                    for sequence, killmail_id, killmail in db.execute(sql_query, parameters)]
+        except sqlite3.Error as e:
+            raise RedisqCacheException(f'sqlite error looking up broadcasts - [{e}] - [{sql_query}]')
+        finally:
+            db.close()
+
+
+    # ################################
+    # Compression
+
+    # Build the codec from the stored dictionaries, the newest one of the configured codec compresses new killmails
+    def load_codec(self, db=None):
+        close_db = db is None
+        if close_db:
+            db = self.connect_to_sql()
+        try:
+            rows = db.execute('SELECT id, codec, dictionary FROM killmail_dictionaries ORDER BY id').fetchall()
+        except sqlite3.Error as e:
+            raise RedisqCacheException(f'sqlite error loading compression dictionaries - [{e}]')
+        finally:
+            if close_db:
+                db.close()
+
+        dictionaries = {id: (codec, bytes(dictionary)) for id, codec, dictionary in rows}
+        active_id = None
+        for id, (codec, dictionary) in dictionaries.items():
+            if codec == self.compression_codec:
+                active_id = id
+        return KillmailCodec(dictionaries, active_id)
+
+    '''
+        Train a new dictionary on the most recent killmails and compress new killmails with it.
+        Returns the dictionary id, or None when compression is off or there are fewer than TRAIN_MIN_SAMPLES
+        killmails. Existing killmails keep their dictionary, compress_killmails() converts plain text ones.
+        A dictionary another process sharing the archive already trained for the same codec is used instead.
+    '''
+    def train_codec(self, db=None):
+        if self.compression_codec is None:
+            return None
+        close_db = db is None
+        if close_db:
+            db = self.connect_to_sql()
+        try:
+            self.codec = self.load_codec(db)
+            if self.codec.active_id is not None:
+                return self.codec.active_id
+            rows = db.execute('SELECT killmail FROM killmails ORDER BY id DESC LIMIT ?',
+                              (self.TRAIN_SAMPLES,)).fetchall()
+            if len(rows) < self.TRAIN_MIN_SAMPLES:
+                return None
+            samples = [self.decode_killmail(x[0]) for x in reversed(rows)]
+            try:
+                dictionary = KillmailCodec.train(self.compression_codec, samples)
+            except KillmailCodecException as e:
+                print(f'   xxx Could not train a compression dictionary [{e}]')
+                return None
+            with db:
+                # Checked again under the write lock, another process may have stored one while this one trained
+                db.execute('BEGIN IMMEDIATE')
+                row = db.execute('SELECT MAX(id) FROM killmail_dictionaries WHERE codec = ?',
+                                 (self.compression_codec,)).fetchone()
+                if row[0] is not None:
+                    dictionary_id = row[0]
+                else:
+                    dictionary_id = db.execute('INSERT INTO killmail_dictionaries (codec, dictionary, created) '
+                                               'VALUES (?, ?, ?)',
+                                               (self.compression_codec, dictionary, int(time.time()))).lastrowid
+            self.codec = self.load_codec(db)
+            return dictionary_id
+        except sqlite3.Error as e:
+            raise RedisqCacheException(f'sqlite error training a compression dictionary - [{e}]')
+        finally:
+            if close_db:
+                db.close()
+
+    # Killmail json string for a value of the killmail column
+    def decode_killmail(self, value):
+        try:
+            if not self.codec.knows(value):
+                # Another process sharing the archive trained a dictionary since they were loaded
+                self.codec = self.load_codec()
+            return self.codec.decode(value)
+        except KillmailCodecException as e:
+            raise RedisqCacheException(f'could not decode killmail - [{e}]')
+
+    '''
+        Compress killmails that are stored as plain text, batch_size rows per transaction.
+        Trains a dictionary first when there is none. Returns the number of killmails compressed.
+        The database file only shrinks after vacuum().
+    '''
+    def compress_killmails(self, batch_size=1000):
+        if self.compression_codec is None:
+            raise RedisqCacheException('compression is disabled')
+        if self.codec.active_id is None and self.train_codec() is None:
+            return 0
+
+        db = self.connect_to_sql()
+        compressed = 0
+        sql_query = ("SELECT id, killmail FROM killmails WHERE id > ? AND typeof(killmail) = 'text' "
+                     'ORDER BY id LIMIT ?')
+        try:
+            last_id = 0
+            while True:
+                rows = db.execute(sql_query, (last_id, batch_size)).fetchall()
+                if not rows:
+                    break
+                with db:
+                    db.executemany('UPDATE killmails SET killmail = ? WHERE id = ?',
+                                   [(self.codec.encode(x[1]), x[0]) for x in rows])
+                compressed += len(rows)
+                last_id = rows[-1][0]
+        except sqlite3.Error as e:
+            raise RedisqCacheException(f'sqlite error compressing killmails - [{e}]')
+        finally:
+            db.close()
+        return compressed
+
+    # Rebuild the database file to give the space freed by compress_killmails() back to the file system
+    def vacuum(self):
+        db = self.connect_to_sql()
+        try:
+            db.execute('VACUUM')
+        except sqlite3.Error as e:
+            raise RedisqCacheException(f'sqlite error vacuuming database - [{e}]')
+        finally:
+            db.close()
 
-        sql_query = f'INSERT INTO Killmails (id, killmail) VALUES (?, ?);'
+    # Returns { 'killmails', 'compressed', 'stored_bytes' } for the killmail archive
+    def archive_stats(self):
+        sql_query = ("SELECT COUNT(*), COALESCE(SUM(typeof(killmail) = 'blob'), 0), "
+                     'COALESCE(SUM(length(CAST(killmail AS BLOB))), 0) FROM killmails')
+        db = self.connect_to_sql()
+        try:
+            killmails, compressed, stored_bytes = db.execute(sql_query).fetchone()
+        except sqlite3.Error as e:
+            raise RedisqCacheException(f'sqlite error reading archive size - [{e}]')
+        finally:
+            db.close()
+        return {'killmails': killmails, 'compressed': compressed, 'stored_bytes': stored_bytes}
+
+
+    # ################################
+    # Killmail queries
+    #
+    # These are answered from killmail_index and killmail_attackers only, no killmail json is read.
+    # start_time and end_time are unix timestamps or datetime objects, either may be None for an open window.
+    # Each returns a list of dictionaries with the INDEX_COLUMNS, newest first.
+
+    def _query_index(self, where, parameters, start_time, end_time, limit):
+        clauses = [where]
+        parameters = list(parameters)
+        if start_time is not None:
+            clauses.append('killmail_time >= ?')
+            parameters.append(to_timestamp(start_time))
+        if end_time is not None:
+            clauses.append('killmail_time < ?')
+            parameters.append(to_timestamp(end_time))
+        parameters.append(limit)
+
+        sql_query = (f'SELECT {", ".join(self.INDEX_COLUMNS)} FROM killmail_index WHERE {" AND ".join(clauses)} '
+                     f'ORDER BY killmail_time DESC LIMIT ?')
+        db = self.connect_to_sql()
+        try:
+            return [dict(zip(self.INDEX_COLUMNS, row)) for row in db.execute(sql_query, parameters)]
+        except sqlite3.Error as e:
+            raise RedisqCacheException(f'sqlite error querying killmails - [{e}] - [{sql_query}]')
+        finally:
+            db.close()
+
+    def kills_by_time(self, start_time=None, end_time=None, limit=1000):
+        return self._query_index('1', (), start_time, end_time, limit)
+
+    def kills_by_region(self, region_id, start_time=None, end_time=None, limit=1000):
+        return self._query_index('region_id = ?', (region_id,), start_time, end_time, limit)
+
+    def kills_by_solar_system(self, solar_system_id, start_time=None, end_time=None, limit=1000):
+        return self._query_index('solar_system_id = ?', (solar_system_id,), start_time, end_time, limit)
+
+    # Victim ship type in ship_type_ids, for example data.eve_type_ids.id_caps
+    def kills_by_ship_types(self, ship_type_ids, start_time=None, end_time=None, limit=1000):
+        ship_type_ids = list(ship_type_ids)
+        where = f'ship_type_id IN ({",".join("?" * len(ship_type_ids))})'
+        return self._query_index(where, ship_type_ids, start_time, end_time, limit)
+
+    # role is 'victim', 'attacker', or 'any'
+    def _kills_by_entity(self, column, entity_id, role, start_time, end_time, limit):
+        clauses = []
+        parameters = []
+        if role in ('victim', 'any'):
+            clauses.append(f'victim_{column} = ?')
+            parameters.append(entity_id)
+        if role in ('attacker', 'any'):
+            clauses.append(f'id IN (SELECT killmail_id FROM killmail_attackers WHERE {column} = ?)')
+            parameters.append(entity_id)
+        if not clauses:
+            raise RedisqCacheException(f'invalid role [{role}]')
+        return self._query_index(f'({" OR ".join(clauses)})', parameters, start_time, end_time, limit)
+
+    def kills_by_character(self, character_id, role='any', start_time=None, end_time=None, limit=1000):
+        return self._kills_by_entity('character_id', character_id, role, start_time, end_time, limit)
+
+    def kills_by_corporation(self, corporation_id, role='any', start_time=None, end_time=None, limit=1000):
+        return self._kills_by_entity('corporation_id', corporation_id, role, start_time, end_time, limit)
+
+    def kills_by_alliance(self, alliance_id, role='any', start_time=None, end_time=None, limit=1000):
+        return self._kills_by_entity('alliance_id', alliance_id, role, start_time, end_time, limit)
+
+    # Attackers of one killmail, as dictionaries
+    def get_attackers(self, killmail_id):
+        columns = ('character_id', 'corporation_id', 'alliance_id', 'ship_type_id', 'final_blow')
+        sql_query = f'SELECT {", ".join(columns)} FROM killmail_attackers WHERE killmail_id = ?'
+        db = self.connect_to_sql()
+        try:
+            return [dict(zip(columns, row)) for row in db.execute(sql_query, (killmail_id,))]
+        except sqlite3.Error as e:
+            raise RedisqCacheException(f'sqlite error querying attackers - [{e}] - [{sql_query}]')
+        finally:
+            db.close()
+
+    # Look up cached names, table is one of NAME_TABLES
+    # Returns { id: (name, updated) } for the ids that are in the database, updated is a unix timestamp
+    def lookup_names(self, table, ids):
+        if table not in self.NAME_TABLES:
+            raise RedisqCacheException(f'invalid name table [{table}]')
+        ids = list(ids)
+        names = {}
+        db = self.connect_to_sql()
         try:
-            cursor.execute(sql_query, (killmail_id, killmail))
+            for i in range(0, len(ids), self.BATCH_SIZE):
+                chunk = ids[i:i + self.BATCH_SIZE]
+                sql_query = f'SELECT id, name, updated FROM `{table}` WHERE id IN ({",".join("?" * len(chunk))})'
+                for id, name, updated in db.execute(sql_query, chunk):
+                    names[id] = (name, updated)
+        except sqlite3.Error as e:
+            raise RedisqCacheException(f'sqlite error looking up names - [{e}] - [{table}]')
+        finally:
+            db.close()
+        return names
+
+    # Insert or refresh names, names is { id: 'name' } and updated is a unix timestamp
+    def insert_names(self, table, names, updated):
+        if table not in self.NAME_TABLES:
+            raise RedisqCacheException(f'invalid name table [{table}]')
+        db = self.connect_to_sql()
+        sql_query = f'INSERT OR REPLACE INTO `{table}` (id, name, updated) VALUES (?, ?, ?);'
+        try:
+            db.executemany(sql_query, [(id, name, updated) for id, name in names.items()])
             db.commit()
         except sqlite3.Error as e:
-            raise RedisqCacheException(f'sqlite error inserting killmail - [{e}] - [{sql_query}]')
+            raise RedisqCacheException(f'sqlite error inserting names - [{e}] - [{sql_query}]')
+        finally:
+            db.close()
+
+
+
+# ######################################################################################################
+# Killmail index helpers
+
+# Unix timestamp from a datetime, an ESI time string such as '2019-11-15T12:34:56Z', or a number
+def to_timestamp(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            return calendar.timegm(value.timetuple())
+        return int(value.timestamp())
+    if isinstance(value, str):
+        return calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%SZ'))
+    return int(value)
+
+'''
+    Extract the indexed columns from a killmail.
+    Returns (index_row, attacker_rows) matching RedisqCache.INDEX_COLUMNS and the killmail_attackers columns.
+    total_value comes from the zkillboard metadata that get_next_redisq() stores in killmail['zkb'], when present.
+'''
+def extract_killmail_index(killmail, region_lookup=None):
+    killmail_id = killmail['killmail_id']
+    solar_system_id = killmail['solar_system_id']
+    victim = killmail['victim']
+    attackers = killmail['attackers']
+    region_id = region_lookup(solar_system_id) if region_lookup is not None else None
+    total_value = (killmail.get('zkb') or {}).get('totalValue')
+
+    index_row = (
+        killmail_id, to_timestamp(killmail['killmail_time']), solar_system_id, region_id or None,
+        victim.get('ship_type_id'), victim.get('character_id'), victim.get('corporation_id'),
+        victim.get('alliance_id'), len(attackers), total_value
+    )
+    attacker_rows = [
+        (killmail_id, x.get('character_id'), x.get('corporation_id'), x.get('alliance_id'), x.get('ship_type_id'),
+         1 if x.get('final_blow') else 0)
+        for x in attackers
+    ]
+    return index_row, attacker_rows
+
+
+BroadcastRow = namedtuple('BroadcastRow', ['epoch', 'sequence', 'killmail_id'])
+
+
+class KillmailWriter(object):
+    '''
+        Background thread that saves killmails to a RedisqCache with group commits.
+
+        put() only queues the killmail, put_broadcast() the sequence number it was broadcast under. The writer thread
+        collects killmails until it has batch_size of them or the oldest has waited flush_interval seconds, then
+        inserts the whole batch in one transaction. close() writes everything still queued before returning.
+    '''
+    STOP = object()
+
+    def __init__(self, cache, batch_size=100, flush_interval=0.5, queue_size=1000):
+        self.cache = cache
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+        self.commit_seconds = metrics.histogram('zkb_stage_seconds', 'Seconds spent in each listener stage',
+                                                stage='archive_commit')
+        self.thread = threading.Thread(target=self.run, name='killmail_writer', daemon=True)
+        self.thread.start()
+
+    # Queue a killmail json string for writing, blocks only while the queue is full
+    # Pass the parsed killmail as well when it is at hand, so it does not have to be parsed again for the index
+    def put(self, killmail_id, killmail, killmail_dict=None):
+        self.queue.put((killmail_id, killmail, killmail_dict))
+
+    # Queue the sequence number a killmail was broadcast under, after the killmail itself was put()
+    def put_broadcast(self, epoch, sequence, killmail_id):
+        self.queue.put(BroadcastRow(epoch, sequence, killmail_id))
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    # Write everything that is queued and stop the writer thread
+    def close(self):
+        self.queue.put(self.STOP)
+        self.thread.join()
+
+    def run(self):
+        db = self.cache.connect_to_sql()
+        stopping = False
+        try:
+            while not stopping:
+                item = self.queue.get()
+                if item is self.STOP:
+                    break
+                batch = [item]
+                deadline = time.monotonic() + self.flush_interval
+
+                # Keep collecting until the batch is full or the first killmail has waited long enough
+                while len(batch) < self.batch_size:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = self.queue.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    if item is self.STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+
+                self.flush(db, batch)
+        finally:
+            db.close()
+
+    def flush(self, db, batch):
+        killmails = [x for x in batch if not isinstance(x, BroadcastRow)]
+        broadcasts = [x for x in batch if isinstance(x, BroadcastRow)]
+        start = time.perf_counter()
+        try:
+            if killmails:
+                self.cache.insert_killmails(killmails, db)
+            if broadcasts:
+                self.cache.insert_broadcasts(broadcasts, db)
+            self.written += len(killmails)
+            self.batches += 1
+            self.commit_seconds.observe(time.perf_counter() - start)
+        except RedisqCacheException as e:
+            self.errors += 1
+            print(f'   xxx sqlite error writing {len(killmails)} killmails [{e}]')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,193 @@
+'''
+    Replay test data saved by redisq_listener.py --loaddata, streamed from disk instead of loaded whole.
+
+    Killmails are stored one json document per line, oldest first, in '<region>.jsonl'. A memory-mapped offset index
+    in '<region>.idx' locates every line, so replay reads one killmail at a time in either direction and can start at
+    any killmail id or time without parsing the killmails before it.
+
+    Index layout (native byte order, every array 8 byte values):
+        header      - HEADER_FORMAT: magic, killmail count, size of the jsonl file it indexes
+        offsets     - count + 1 byte offsets of the lines, the last is the end of the file
+        times       - killmail_time of every line as a unix time, ascending
+        ids         - killmail_id of every line
+        sorted_ids  - the killmail ids ascending, with by_id_lines the line of each
+
+    Caches saved as one json list by earlier versions, '<region>.json', are converted the first time they are opened.
+    The json file is left in place, it is not read again once converted.
+
+        with ReplayCache.open_region('cache/esi_regions', 10000015) as cache:
+            for killmail in cache.killmails(start_time=to_timestamp('2019-11-20T00:00:00Z')):
+                ...
+'''
+
+import json
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left
+
+from tools.redisq_cache import to_timestamp
+
+
+class ReplayCacheException(Exception):
+    '''Raise whenever any error or exception occurs'''
+
+
+class ReplayCache(object):
+    MAGIC = b'ZKBRIDX1'
+    HEADER_FORMAT = '=8sQQ'
+    ARRAYS = ('offsets', 'times', 'ids', 'sorted_ids', 'by_id_lines')
+
+    '''
+        path is the jsonl file, its index is the same path ending in .idx
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.index_path = index_path(path)
+        self.mm = None
+        self.index_mm = None
+        try:
+            with open(self.index_path, 'rb') as fp:
+                self.index_mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, self.count, size = struct.unpack_from(self.HEADER_FORMAT, self.index_mm)
+        except (OSError, ValueError, struct.error) as e:
+            self.close()
+            raise ReplayCacheException(f'could not map replay index [{self.index_path}] - [{e}]')
+        if magic != self.MAGIC:
+            self.close()
+            raise ReplayCacheException(f'[{self.index_path}] is not a replay index')
+
+        try:
+            if os.path.getsize(path) != size:
+                raise ReplayCacheException(f'replay index [{self.index_path}] does not match [{path}]')
+            # An empty file can not be mapped, there is nothing to read from it either
+            if size:
+                with open(path, 'rb') as fp:
+                    self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            self.close()
+            raise ReplayCacheException(f'could not map replay cache [{path}] - [{e}]')
+
+        view = memoryview(self.index_mm)
+        position = struct.calcsize(self.HEADER_FORMAT)
+        for name in self.ARRAYS:
+            length = self.count + 1 if name == 'offsets' else self.count
+            if position + 8 * length > len(self.index_mm):
+                self.close()
+                raise ReplayCacheException(f'replay index [{self.index_path}] is truncated at [{name}]')
+            setattr(self, name, view[position:position + 8 * length].cast('q'))
+            position += 8 * length
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for name in self.ARRAYS:
+            view = self.__dict__.pop(name, None)
+            if view is not None:
+                view.release()
+        for mm in (self.mm, self.index_mm):
+            if mm is not None:
+                mm.close()
+        self.mm = self.index_mm = None
+
+
+    # ################################
+    # Writing
+
+    '''
+        Save killmails in replay order, oldest first, to path and its index. Both files are replaced atomically.
+        Returns the number of killmails saved.
+    '''
+    @classmethod
+    def write(cls, path, killmails):
+        killmails = sorted(((to_timestamp(x['killmail_time']), x['killmail_id'], x) for x in killmails),
+                           key=lambda x: x[:2])
+        offsets, times, ids = array('q', [0]), array('q'), array('q')
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'wb') as fp:
+            for timestamp, killmail_id, killmail in killmails:
+                fp.write(json.dumps(killmail).encode('utf-8') + b'\n')
+                offsets.append(fp.tell())
+                times.append(timestamp)
+                ids.append(killmail_id)
+        by_id = sorted(range(len(ids)), key=lambda x: ids[x])
+
+        temp_index_path = f'{index_path(path)}.tmp'
+        with open(temp_index_path, 'wb') as fp:
+            fp.write(struct.pack(cls.HEADER_FORMAT, cls.MAGIC, len(ids), offsets[-1]))
+            for values in (offsets, times, ids, array('q', (ids[x] for x in by_id)), array('q', by_id)):
+                fp.write(values.tobytes())
+        # The jsonl file first, an index left over from before no longer matches its size and is rejected
+        os.replace(temp_path, path)
+        os.replace(temp_index_path, index_path(path))
+        return len(ids)
+
+    '''
+        Open the replay cache of a region saved in directory, converting a json list saved by earlier versions
+    '''
+    @classmethod
+    def open_region(cls, directory, region_id):
+        path = os.path.join(directory, f'{region_id}.jsonl')
+        legacy_path = os.path.join(directory, f'{region_id}.json')
+        if not os.path.exists(path) or not os.path.exists(index_path(path)):
+            if not os.path.exists(legacy_path):
+                raise ReplayCacheException(f'no replay data for region {region_id} in [{directory}]')
+            print(f'--- Converting [{legacy_path}] to a replay cache...')
+            try:
+                with open(legacy_path, 'r') as fp:
+                    count = cls.write(path, json.load(fp))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                raise ReplayCacheException(f'could not convert [{legacy_path}] - [{e}]')
+            print(f'--- ...saved {count} killmails to [{path}]')
+        return cls(path)
+
+
+    # ################################
+    # Reading
+
+    def get_killmail(self, line):
+        return json.loads(self.mm[self.offsets[line]:self.offsets[line + 1]])
+
+    # Line of the first killmail at or after a unix time, len(self) when there is none
+    def find_time(self, timestamp):
+        return bisect_left(self.times, int(timestamp))
+
+    # Line of a killmail, -1 when it is not in the cache
+    def find_killmail(self, killmail_id):
+        i = bisect_left(self.sorted_ids, killmail_id)
+        if i < len(self.sorted_ids) and self.sorted_ids[i] == killmail_id:
+            return self.by_id_lines[i]
+        return -1
+
+    '''
+        Stream killmails oldest first, or newest first with reverse. Replay starts at the killmail start_id, or at the
+        first killmail at start_time (the last one before it when reversed), otherwise at the oldest or newest.
+        Returns an iterator parsing each killmail as it is reached, a start_id not in the cache raises right away.
+    '''
+    def killmails(self, reverse=False, start_id=None, start_time=None):
+        if start_id is not None:
+            line = self.find_killmail(start_id)
+            if line < 0:
+                raise ReplayCacheException(f'killmail {start_id} is not in [{self.path}]')
+        elif start_time is not None:
+            line = self.find_time(start_time)
+            if reverse:
+                # Killmails at start_time itself are the last ones before it in reverse
+                line = bisect_left(self.times, int(start_time) + 1) - 1
+        else:
+            line = self.count - 1 if reverse else 0
+
+        lines = range(line, -1, -1) if reverse else range(line, self.count)
+        return (self.get_killmail(x) for x in lines)
+
+
+def index_path(path):
+    return os.path.splitext(path)[0] + '.idx'
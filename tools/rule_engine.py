@@ -0,0 +1,255 @@
+'''
+    Decide which Discord channels a killmail is posted to.
+
+    Rules are loaded from a json file:
+        {
+            "webhooks": { "caps": "https://discord.com/api/webhooks/<id>/<token>", ... },
+            "rules": [
+                {
+                    "name": "caps near home",
+                    "webhook": "caps",
+                    "regions": [10000015],                      # killmail in one of these regions
+                    "systems": [30001329],                      # killmail in one of these solar systems
+                    "near": {"system": 30001329, "jumps": 5},   # killmail within 5 jumps of a solar system
+                    "ship_types": ["id_caps", 671],             # victim ship, type ids or lists in data/eve_type_ids.py
+                    "alliances": [99004357],                    # victim or any attacker in one of these alliances
+                    "min_attackers": 10,
+                    "max_age_minutes": 45                       # skip killmails older than this
+                }
+            ]
+        }
+    Every key of a rule except name and webhook is optional, a killmail matches a rule when it passes every key the
+    rule has. systems and near together match either.
+
+    RuleEngine compiles the rules into inverted indexes keyed on solar system, ship type, alliance and region. Each
+    rule is indexed under one key it requires, the one covering the smallest share of its possible values, so a
+    killmail is only checked against the rules listed under its own solar system, victim ship, alliances and region,
+    and the few rules with none of those.
+'''
+
+import json
+import time
+
+from data import eve_type_ids
+from tools.redisq_cache import to_timestamp
+from tools.universe_graph import UniverseGraphException
+
+
+class RuleEngineException(Exception):
+    '''Raise whenever any error or exception occurs'''
+
+
+class Rule(object):
+    '''
+        One compiled rule. regions, systems, ship_types and alliances are sets, or None when the rule does not limit
+        that key. max_age is in seconds.
+    '''
+    def __init__(self, name, webhook=None, regions=None, systems=None, ship_types=None, alliances=None,
+                 min_attackers=0, max_age=None):
+        self.name = name
+        self.webhook = webhook
+        self.regions = regions
+        self.systems = systems
+        self.ship_types = ship_types
+        self.alliances = alliances
+        self.min_attackers = min_attackers
+        self.max_age = max_age
+
+    def __repr__(self):
+        return f'Rule({self.name!r})'
+
+    # The rule as a dictionary for RuleEngine.from_config(), with 'near' already expanded into systems
+    def to_config(self):
+        config = {'name': self.name, 'min_attackers': self.min_attackers}
+        for key in ('regions', 'systems', 'ship_types', 'alliances'):
+            values = getattr(self, key)
+            if values is not None:
+                config[key] = sorted(values)
+        if self.max_age is not None:
+            config['max_age_minutes'] = self.max_age / 60
+        return config
+
+    # killmail_alliances is the set of alliances in the killmail, age is in seconds or None when it is not known
+    def matches(self, killmail, region_id, killmail_alliances, age):
+        if self.regions is not None and region_id not in self.regions:
+            return False
+        if self.systems is not None and killmail['solar_system_id'] not in self.systems:
+            return False
+        if self.ship_types is not None and killmail['victim'].get('ship_type_id') not in self.ship_types:
+            return False
+        if self.alliances is not None and self.alliances.isdisjoint(killmail_alliances):
+            return False
+        if len(killmail['attackers']) < self.min_attackers:
+            return False
+        if self.max_age is not None and age is not None and age > self.max_age:
+            return False
+        return True
+
+
+class RuleEngine(object):
+    '''
+        rules is a list of Rule. region_lookup(solar_system_id) returns the region of a solar system, see
+        SolarSystemTable.get_region_id.
+    '''
+    # Rough number of values of each indexed key, to compare how selective the keys of a rule are
+    KEY_SIZES = {'systems': 8000, 'ship_types': 500, 'alliances': 3000, 'regions': 100}
+
+    def __init__(self, rules, region_lookup=None):
+        self.rules = rules
+        self.region_lookup = region_lookup
+        self.by_system = {}
+        self.by_ship_type = {}
+        self.by_alliance = {}
+        self.by_region = {}
+        self.unindexed = []
+        self.order = {id(x): i for i, x in enumerate(rules)}
+        for rule in rules:
+            self._index(rule)
+
+    def __len__(self):
+        return len(self.rules)
+
+    # File the rule under every value of its most selective key
+    def _index(self, rule):
+        keys = [(len(values) / self.KEY_SIZES[key], values, index) for key, values, index in [
+            ('systems', rule.systems, self.by_system), ('ship_types', rule.ship_types, self.by_ship_type),
+            ('alliances', rule.alliances, self.by_alliance), ('regions', rule.regions, self.by_region)
+        ] if values is not None]
+        if not keys:
+            self.unindexed.append(rule)
+            return
+        _, values, index = min(keys, key=lambda x: x[0])
+        for value in values:
+            index.setdefault(value, []).append(rule)
+
+
+    # ################################
+    # Loading
+
+    '''
+        Load rules from a json file, see the top of this file.
+        graph is a UniverseGraph, needed for rules with 'near'.
+    '''
+    @classmethod
+    def from_file(cls, path, region_lookup=None, graph=None):
+        try:
+            with open(path, 'r') as fp:
+                config = json.load(fp)
+        except (OSError, ValueError) as e:
+            raise RuleEngineException(f'could not read rules [{path}] - [{e}]')
+        return cls.from_config(config, region_lookup, graph)
+
+    @classmethod
+    def from_config(cls, config, region_lookup=None, graph=None):
+        webhooks = config.get('webhooks', {})
+        rules = []
+        for number, rule_config in enumerate(config.get('rules', []), 1):
+            name = rule_config.get('name', f'rule {number}')
+            webhook = rule_config.get('webhook')
+            if webhook is not None and webhook not in webhooks:
+                raise RuleEngineException(f'[{name}] uses unknown webhook [{webhook}]')
+            rules.append(compile_rule(name, webhooks.get(webhook), rule_config, graph))
+        return cls(rules, region_lookup)
+
+
+    # ################################
+    # Matching
+
+    '''
+        Rules a killmail matches, in the order they were loaded. now is a unix timestamp, the current time when None.
+        killmail_timestamp is the killmail_time as a unix timestamp when the caller already parsed it. When the time
+        can not be read, max_age is not checked.
+    '''
+    def match(self, killmail, now=None, killmail_timestamp=None):
+        solar_system_id = killmail['solar_system_id']
+        region_id = self.region_lookup(solar_system_id) if self.region_lookup is not None else None
+        entities = [killmail['victim']] + killmail['attackers']
+        killmail_alliances = {x['alliance_id'] for x in entities if x.get('alliance_id')}
+
+        candidates = {}
+        for rule in self.by_system.get(solar_system_id, ()):
+            candidates[id(rule)] = rule
+        for rule in self.by_ship_type.get(killmail['victim'].get('ship_type_id'), ()):
+            candidates[id(rule)] = rule
+        for alliance_id in killmail_alliances:
+            for rule in self.by_alliance.get(alliance_id, ()):
+                candidates[id(rule)] = rule
+        for rule in self.by_region.get(region_id, ()):
+            candidates[id(rule)] = rule
+        for rule in self.unindexed:
+            candidates[id(rule)] = rule
+        if not candidates:
+            return []
+
+        if killmail_timestamp is None:
+            try:
+                killmail_timestamp = to_timestamp(killmail['killmail_time'])
+            except (KeyError, TypeError, ValueError):
+                pass
+        age = None
+        if killmail_timestamp is not None:
+            age = (now if now is not None else time.time()) - killmail_timestamp
+        matched = [x for x in candidates.values() if x.matches(killmail, region_id, killmail_alliances, age)]
+        if len(matched) > 1:
+            matched.sort(key=lambda x: self.order[id(x)])
+        return matched
+
+    '''
+        Regions a killmail must be in to match any rule, to subscribe to only those. None when some rule matches
+        killmails anywhere.
+    '''
+    def get_region_ids(self):
+        region_ids = set()
+        for rule in self.rules:
+            if rule.regions is not None:
+                region_ids.update(rule.regions)
+            elif rule.systems is not None and self.region_lookup is not None:
+                region_ids.update(self.region_lookup(x) for x in rule.systems)
+            else:
+                return None
+        region_ids.discard(None)
+        return sorted(region_ids)
+
+
+# ################################
+# Rule compilation
+
+# Type ids from a list of type ids and names of lists in data/eve_type_ids.py
+def resolve_type_ids(values):
+    type_ids = set()
+    for value in values:
+        if isinstance(value, str):
+            type_list = getattr(eve_type_ids, value, None)
+            if not isinstance(type_list, list):
+                raise RuleEngineException(f'unknown ship type list [{value}]')
+            type_ids.update(type_list)
+        else:
+            type_ids.add(int(value))
+    return type_ids
+
+def compile_rule(name, webhook, config, graph=None):
+    def id_set(key):
+        return {int(x) for x in config[key]} if key in config else None
+
+    systems = id_set('systems')
+    near = config.get('near')
+    if near is not None:
+        if graph is None:
+            raise RuleEngineException(f'[{name}] uses near, which needs the universe graph')
+        try:
+            near_systems = graph.get_systems_within(int(near['system']), int(near.get('jumps', 0)))
+        except (KeyError, ValueError, UniverseGraphException) as e:
+            raise RuleEngineException(f'[{name}] has an invalid near [{e}]')
+        systems = (systems or set()) | set(near_systems)
+
+    max_age_minutes = config.get('max_age_minutes')
+    return Rule(
+        name=name,
+        webhook=webhook,
+        regions=id_set('regions'),
+        systems=systems,
+        ship_types=resolve_type_ids(config['ship_types']) if 'ship_types' in config else None,
+        alliances=id_set('alliances'),
+        min_attackers=int(config.get('min_attackers', 0)),
+        max_age=max_age_minutes * 60 if max_age_minutes is not None else None,
+    )
@@ -0,0 +1,170 @@
+'''
+    Precomputed table of everything hook_bot needs to know about a solar system.
+
+    The static data dump never changes while the process runs, so the name, region, constellation, security and jumps
+    from home of every solar system are resolved once at startup. The table is saved to a compact binary file keyed on
+    the modification time and size of the static data dump (or the one a snapshot was exported from), so restarts
+    load it without touching sql.
+
+    File layout (little endian):
+        header      - magic, sde mtime_ns, sde size, home system id, record count, string table size
+        records     - one RECORD_FORMAT struct per solar system, names are indexes into the string table
+        strings     - utf-8 names separated by NUL bytes
+'''
+
+import os
+import struct
+from collections import namedtuple
+
+from data.definitions import ROOT_DIR
+from data.eve_type_ids import HOME_SYSTEM_ID
+from tools.lookup_eve_static_dump import LookupEveStaticDumpException
+
+
+SolarSystemInfo = namedtuple('SolarSystemInfo', [
+    'solarsystem_id', 'name', 'region_id', 'region_name', 'constellation_id', 'constellation_name', 'security',
+    'jumps_from_home'
+])
+
+
+class SolarSystemTableException(Exception):
+    '''Raise whenever any error or exception occurs'''
+
+class SolarSystemTable(object):
+    DEFAULT_PATH = os.path.join(ROOT_DIR, 'cache/static_tables/solarsystems.bin')
+    MAGIC = b'ZKBSYS01'
+    HEADER_FORMAT = '<8sqqiII'
+    RECORD_FORMAT = '<iiidiIII'
+
+    def __init__(self, systems):
+        self.systems = systems
+
+    def __len__(self):
+        return len(self.systems)
+
+    def __contains__(self, solarsystem_id):
+        return solarsystem_id in self.systems
+
+    # Return the SolarSystemInfo for solarsystem_id, or None if the system does not exist
+    def get(self, solarsystem_id):
+        return self.systems.get(solarsystem_id)
+
+    # Return the region of solarsystem_id, or None if the system does not exist
+    def get_region_id(self, solarsystem_id):
+        info = self.systems.get(solarsystem_id)
+        return info.region_id if info is not None else None
+
+
+    # ################################
+    # Building
+
+    # Resolve every solar system from the static data dump using one query and the in-memory jump graph
+    @classmethod
+    def build(cls, lookup, home_system_id=HOME_SYSTEM_ID):
+        rows = lookup.get_all_solarsystems()
+        graph = lookup.get_universe_graph()
+
+        systems = {}
+        for solarsystem_id, name, region_id, region_name, constellation_id, constellation_name, security in rows:
+            systems[solarsystem_id] = SolarSystemInfo(
+                solarsystem_id=solarsystem_id,
+                name=name or lookup.UNKNOWN_STRING,
+                region_id=region_id or 0,
+                region_name=region_name or lookup.UNKNOWN_STRING,
+                constellation_id=constellation_id or 0,
+                constellation_name=constellation_name or lookup.UNKNOWN_STRING,
+                security=security or 0.0,
+                jumps_from_home=graph.get_jump_count(home_system_id, solarsystem_id)
+            )
+        return cls(systems)
+
+    # Load the table from disk if it was built from the current static data dump, otherwise build and save it
+    @classmethod
+    def load_or_build(cls, lookup, path=DEFAULT_PATH, home_system_id=HOME_SYSTEM_ID):
+        try:
+            key = lookup.get_data_version() + (home_system_id,)
+        except LookupEveStaticDumpException as e:
+            raise SolarSystemTableException(f'could not identify static data - [{e}]')
+
+        try:
+            return cls.load(path, key)
+        except SolarSystemTableException:
+            pass
+
+        try:
+            table = cls.build(lookup, home_system_id)
+        except LookupEveStaticDumpException as e:
+            raise SolarSystemTableException(f'could not build solar system table - [{e}]')
+        try:
+            table.save(path, key)
+        except OSError as e:
+            print(f'   xxx Could not save solar system table [{path}] - [{e}]')
+        return table
+
+
+    # ################################
+    # Binary file
+
+    def save(self, path, key):
+        strings = {}
+
+        def string_index(value):
+            return strings.setdefault(value, len(strings))
+
+        records = []
+        for info in self.systems.values():
+            records.append(struct.pack(
+                self.RECORD_FORMAT, info.solarsystem_id, info.region_id, info.constellation_id, info.security,
+                info.jumps_from_home, string_index(info.name), string_index(info.region_name),
+                string_index(info.constellation_name)
+            ))
+        string_table = b'\0'.join(x.encode('utf-8') for x in strings)
+
+        mtime_ns, size, home_system_id = key
+        header = struct.pack(self.HEADER_FORMAT, self.MAGIC, mtime_ns, size, home_system_id, len(records),
+                             len(string_table))
+
+        # Write to a temporary file and rename so a crash never leaves a truncated table behind
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'wb') as fp:
+            fp.write(header)
+            fp.write(b''.join(records))
+            fp.write(string_table)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path, key):
+        try:
+            with open(path, 'rb') as fp:
+                raw = fp.read()
+        except OSError as e:
+            raise SolarSystemTableException(f'could not read solar system table [{path}] - [{e}]')
+
+        header_size = struct.calcsize(cls.HEADER_FORMAT)
+        record_size = struct.calcsize(cls.RECORD_FORMAT)
+        try:
+            magic, mtime_ns, size, home_system_id, count, string_size = struct.unpack_from(cls.HEADER_FORMAT, raw)
+        except struct.error as e:
+            raise SolarSystemTableException(f'invalid solar system table header [{path}] - [{e}]')
+        if magic != cls.MAGIC or (mtime_ns, size, home_system_id) != key:
+            raise SolarSystemTableException(f'solar system table [{path}] is stale')
+        strings_start = header_size + count * record_size
+        if len(raw) != strings_start + string_size:
+            raise SolarSystemTableException(f'solar system table [{path}] is truncated')
+
+        strings = [x.decode('utf-8') for x in raw[strings_start:].split(b'\0')]
+        systems = {}
+        for (solarsystem_id, region_id, constellation_id, security, jumps_from_home, name_index, region_index,
+             constellation_index) in struct.iter_unpack(cls.RECORD_FORMAT, raw[header_size:strings_start]):
+            systems[solarsystem_id] = SolarSystemInfo(
+                solarsystem_id=solarsystem_id,
+                name=strings[name_index],
+                region_id=region_id,
+                region_name=strings[region_index],
+                constellation_id=constellation_id,
+                constellation_name=strings[constellation_index],
+                security=security,
+                jumps_from_home=jumps_from_home
+            )
+        return cls(systems)
@@ -0,0 +1,315 @@
+'''
+    Compact memory-mapped snapshot of the parts of the Eve Static Data Dump used by this project.
+
+    Only invTypes, invMarketGroups, mapSolarSystems, mapRegions, mapConstellations and mapSolarSystemJumps are
+    exported. Every column is stored as a fixed width array, sorted by id, so lookups are a binary search over a
+    memoryview of the mapped file. Nothing is parsed or copied at startup and every process that opens the snapshot
+    shares the same page cache.
+
+    File layout (native byte order, every array aligned to 8 bytes):
+        header      - HEADER_FORMAT: magic, array count, sde mtime_ns, sde size
+        directory   - one ENTRY_FORMAT per array: name, typecode, byte offset, item count
+        arrays      - raw array data
+
+    Strings are stored as a '.names' blob of utf-8 bytes plus a '.name_offsets' array of count + 1 offsets.
+    Jumps are stored CSR style as 'systems.jump_offsets' and 'systems.jump_neighbors' (dense system indexes).
+
+    Export a snapshot from the repository root with:
+        python -m tools.static_snapshot
+'''
+
+import mmap
+import os
+import sqlite3
+import struct
+import urllib.parse
+from array import array
+from bisect import bisect_left
+
+from data.definitions import ROOT_DIR
+
+
+class StaticSnapshotException(Exception):
+    '''Raise whenever any error or exception occurs'''
+
+class StaticSnapshot(object):
+    DEFAULT_PATH = os.path.join(ROOT_DIR, 'data/static_snapshot.bin')
+    MAGIC = b'ZKBSNAP1'
+    HEADER_FORMAT = '=8sIqq'
+    ENTRY_FORMAT = '=32scxxxxxxxQQ'
+    UNKNOWN_STRING = '!Unknown!'
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        try:
+            with open(path, 'rb') as fp:
+                self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            raise StaticSnapshotException(f'could not map static snapshot [{path}] - [{e}]')
+
+        self.view = memoryview(self.mm)
+        try:
+            magic, array_count, self.sde_mtime_ns, self.sde_size = struct.unpack_from(self.HEADER_FORMAT, self.mm)
+        except struct.error as e:
+            raise StaticSnapshotException(f'invalid static snapshot header [{path}] - [{e}]')
+        if magic != self.MAGIC:
+            raise StaticSnapshotException(f'[{path}] is not a static snapshot')
+
+        self.arrays = {}
+        entry_size = struct.calcsize(self.ENTRY_FORMAT)
+        position = struct.calcsize(self.HEADER_FORMAT)
+        for _ in range(array_count):
+            raw_name, typecode, offset, count = struct.unpack_from(self.ENTRY_FORMAT, self.mm, position)
+            position += entry_size
+            name = raw_name.rstrip(b'\0').decode('ascii')
+            typecode = typecode.decode('ascii')
+            size = array(typecode).itemsize * count
+            if offset + size > len(self.mm):
+                raise StaticSnapshotException(f'static snapshot [{path}] is truncated at [{name}]')
+            self.arrays[name] = self.view[offset:offset + size].cast(typecode)
+
+    def __getitem__(self, name):
+        try:
+            return self.arrays[name]
+        except KeyError:
+            raise StaticSnapshotException(f'static snapshot [{self.path}] has no array [{name}]')
+
+    # The static data dump this snapshot was exported from, as (mtime_ns, size)
+    def get_data_version(self):
+        return self.sde_mtime_ns, self.sde_size
+
+
+    # ################################
+    # Array helpers
+
+    # Dense index of an id in a sorted id array, or -1
+    def _find(self, table, int_value):
+        ids = self.arrays[f'{table}.ids']
+        i = bisect_left(ids, int_value)
+        if i < len(ids) and ids[i] == int_value:
+            return i
+        return -1
+
+    def _string(self, table, i):
+        offsets = self.arrays[f'{table}.name_offsets']
+        return bytes(self.arrays[f'{table}.names'][offsets[i]:offsets[i + 1]]).decode('utf-8')
+
+    def _lookup_string(self, table, int_value):
+        i = self._find(table, int_value)
+        if i < 0:
+            return self.UNKNOWN_STRING
+        return self._string(table, i)
+
+    # missing is returned when the id does not exist, NULL columns in the static data dump are exported as 0
+    def _lookup_column(self, table, column, int_value, missing=0):
+        i = self._find(table, int_value)
+        if i < 0:
+            return missing
+        return self.arrays[f'{table}.{column}'][i]
+
+
+    # ################################
+    # Lookups, these mirror the LookupEveStaticDump methods of the same name
+
+    def get_type_name(self, type_id):
+        return self._lookup_string('types', type_id)
+
+    def get_type_names(self, type_ids):
+        return {x: self.get_type_name(x) for x in set(type_ids) if x is not None}
+
+    def get_group_for_type(self, type_id):
+        return self._lookup_column('types', 'group', type_id, self.UNKNOWN_STRING)
+
+    def get_groups_for_types(self, type_ids):
+        return {x: self._lookup_column('types', 'group', x) for x in set(type_ids) if x is not None}
+
+    def get_typelist_for_group(self, group_id):
+        i = self._find('groups', group_id)
+        if i < 0:
+            return []
+        offsets = self.arrays['groups.type_offsets']
+        return [(x,) for x in self.arrays['groups.type_ids'][offsets[i]:offsets[i + 1]]]
+
+    def get_marketgroup_for_type_id(self, type_id):
+        return self._lookup_column('types', 'market_group', type_id)
+
+    def get_marketgroup_name(self, marketgroup_id):
+        return self._lookup_string('market_groups', marketgroup_id)
+
+    def get_marketgroup_parentgroup_id(self, marketgroup_id):
+        return self._lookup_column('market_groups', 'parent', marketgroup_id)
+
+    def get_solarsystem_name(self, solarsystem_id):
+        return self._lookup_string('systems', solarsystem_id)
+
+    def get_solarsystem_names(self, solarsystem_ids):
+        return {x: self.get_solarsystem_name(x) for x in set(solarsystem_ids) if x is not None}
+
+    def get_constellation_name(self, constellation_id):
+        return self._lookup_string('constellations', constellation_id)
+
+    def get_constellation_names(self, constellation_ids):
+        return {x: self.get_constellation_name(x) for x in set(constellation_ids) if x is not None}
+
+    def get_region_name(self, region_id):
+        return self._lookup_string('regions', region_id)
+
+    def get_region_names(self, region_ids):
+        return {x: self.get_region_name(x) for x in set(region_ids) if x is not None}
+
+    def get_solarsystem_security(self, solarsystem_id):
+        i = self._find('systems', solarsystem_id)
+        if i < 0:
+            return self.UNKNOWN_STRING
+        return self.arrays['systems.security'][i]
+
+    def get_solarsystem_constellation(self, solarsystem_id):
+        return self._lookup_column('systems', 'constellation', solarsystem_id, self.UNKNOWN_STRING)
+
+    def get_solarsystem_region(self, solarsystem_id):
+        return self._lookup_column('systems', 'region', solarsystem_id, self.UNKNOWN_STRING)
+
+    def get_solarsystem_regions(self, solarsystem_ids):
+        return {x: self._lookup_column('systems', 'region', x) for x in set(solarsystem_ids) if x is not None}
+
+    def get_all_solarsystems(self):
+        ids = self.arrays['systems.ids']
+        regions = self.arrays['systems.region']
+        constellations = self.arrays['systems.constellation']
+        security = self.arrays['systems.security']
+        return [
+            (ids[i], self._string('systems', i), regions[i], self.get_region_name(regions[i]), constellations[i],
+             self.get_constellation_name(constellations[i]), security[i])
+            for i in range(len(ids))
+        ]
+
+    def get_all_solarsystem_id_by_security(self, min_security, max_security):
+        ids = self.arrays['systems.ids']
+        security = self.arrays['systems.security']
+        return [ids[i] for i in range(len(ids)) if min_security <= security[i] <= max_security]
+
+    def get_jumps_in_solarsystem(self, solarsystem_id):
+        i = self._find('systems', solarsystem_id)
+        if i < 0:
+            return []
+        ids = self.arrays['systems.ids']
+        offsets = self.arrays['systems.jump_offsets']
+        return [ids[j] for j in self.arrays['systems.jump_neighbors'][offsets[i]:offsets[i + 1]]]
+
+    # (system_ids, offsets, neighbors) for UniverseGraph, all three are views into the mapped file
+    def get_jump_graph_arrays(self):
+        return self.arrays['systems.ids'], self.arrays['systems.jump_offsets'], self.arrays['systems.jump_neighbors']
+
+
+# ######################################################################################################
+# Export
+
+# Turn a list of strings into (name_offsets, names) arrays
+def _string_arrays(strings):
+    offsets = array('I', [0])
+    blob = bytearray()
+    for value in strings:
+        blob += (value or '').encode('utf-8')
+        offsets.append(len(blob))
+    return offsets, array('B', blob)
+
+def _id_arrays(db, table, sql_query, columns):
+    rows = sorted(db.execute(sql_query).fetchall())
+    arrays = {f'{table}.ids': array('i', [row[0] for row in rows])}
+    for i, (column, typecode) in enumerate(columns, start=1):
+        if column == 'name':
+            arrays[f'{table}.name_offsets'], arrays[f'{table}.names'] = _string_arrays([row[i] for row in rows])
+        else:
+            arrays[f'{table}.{column}'] = array(typecode, [row[i] or 0 for row in rows])
+    return arrays
+
+# Export the tables used by LookupEveStaticDump from the static data dump at sde_path into a snapshot at path
+def export_snapshot(sde_path, path=StaticSnapshot.DEFAULT_PATH):
+    try:
+        sde_stat = os.stat(sde_path)
+        # Quoted, a path with '?' or '#' in it would otherwise be cut short
+        db = sqlite3.connect(f'file:{urllib.parse.quote(os.path.abspath(sde_path))}?mode=ro', uri=True)
+    except (OSError, sqlite3.Error) as e:
+        raise StaticSnapshotException(f'could not open static data dump [{sde_path}] - [{e}]')
+
+    try:
+        arrays = {}
+        arrays.update(_id_arrays(db, 'types', 'SELECT typeID, groupID, marketGroupID, typeName FROM invTypes',
+                                 [('group', 'i'), ('market_group', 'i'), ('name', None)]))
+        arrays.update(_id_arrays(db, 'market_groups',
+                                 'SELECT marketGroupID, parentGroupID, marketGroupName FROM invMarketGroups',
+                                 [('parent', 'i'), ('name', None)]))
+        arrays.update(_id_arrays(db, 'systems',
+                                 'SELECT solarSystemID, regionID, constellationID, security, solarSystemName '
+                                 'FROM mapSolarSystems',
+                                 [('region', 'i'), ('constellation', 'i'), ('security', 'd'), ('name', None)]))
+        arrays.update(_id_arrays(db, 'regions', 'SELECT regionID, regionName FROM mapRegions', [('name', None)]))
+        arrays.update(_id_arrays(db, 'constellations', 'SELECT constellationID, constellationName FROM mapConstellations',
+                                 [('name', None)]))
+
+        # Types grouped by groupID for get_typelist_for_group
+        group_types = {}
+        for type_id, group_id in zip(arrays['types.ids'], arrays['types.group']):
+            group_types.setdefault(group_id, []).append(type_id)
+        arrays['groups.ids'] = array('i', sorted(group_types))
+        arrays['groups.type_offsets'] = array('i', [0])
+        arrays['groups.type_ids'] = array('i')
+        for group_id in arrays['groups.ids']:
+            arrays['groups.type_ids'].extend(group_types[group_id])
+            arrays['groups.type_offsets'].append(len(arrays['groups.type_ids']))
+
+        # Jumps in CSR form over the dense system index
+        index = {system_id: i for i, system_id in enumerate(arrays['systems.ids'])}
+        exits = [set() for _ in index]
+        for from_id, to_id in db.execute('SELECT fromSolarSystemID, toSolarSystemID FROM mapSolarSystemJumps'):
+            if from_id in index and to_id in index:
+                exits[index[from_id]].add(index[to_id])
+                exits[index[to_id]].add(index[from_id])
+        arrays['systems.jump_offsets'] = array('i', [0])
+        arrays['systems.jump_neighbors'] = array('i')
+        for neighbors in exits:
+            arrays['systems.jump_neighbors'].extend(sorted(neighbors))
+            arrays['systems.jump_offsets'].append(len(arrays['systems.jump_neighbors']))
+    except sqlite3.Error as e:
+        raise StaticSnapshotException(f'sqlite error exporting static snapshot - [{e}]')
+    finally:
+        db.close()
+
+    _write_snapshot(path, arrays, sde_stat.st_mtime_ns, sde_stat.st_size)
+    return arrays
+
+def _write_snapshot(path, arrays, sde_mtime_ns, sde_size):
+    def align(x):
+        return (x + 7) & ~7
+
+    for name in arrays:
+        if len(name) > 32:
+            raise StaticSnapshotException(f'array name [{name}] is longer than 32 characters')
+
+    header = struct.pack(StaticSnapshot.HEADER_FORMAT, StaticSnapshot.MAGIC, len(arrays), sde_mtime_ns, sde_size)
+    position = align(len(header) + struct.calcsize(StaticSnapshot.ENTRY_FORMAT) * len(arrays))
+    directory = []
+    for name, values in arrays.items():
+        directory.append(struct.pack(StaticSnapshot.ENTRY_FORMAT, name.encode('ascii'), values.typecode.encode('ascii'),
+                                     position, len(values)))
+        position = align(position + values.itemsize * len(values))
+
+    # Write to a temporary file and rename, processes that already mapped the old snapshot keep their copy
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as fp:
+        fp.write(header)
+        fp.write(b''.join(directory))
+        for values in arrays.values():
+            fp.write(b'\0' * (align(fp.tell()) - fp.tell()))
+            values.tofile(fp)
+    os.replace(temp_path, path)
+
+
+if __name__ == '__main__':
+    from tools.lookup_eve_static_dump import LookupEveStaticDump
+
+    print(f'Exporting {LookupEveStaticDump.DEFAULT_PATH} to {StaticSnapshot.DEFAULT_PATH}...')
+    exported = export_snapshot(LookupEveStaticDump.DEFAULT_PATH)
+    print(f'...done, {len(exported["types.ids"])} types, {len(exported["systems.ids"])} solar systems, '
+          f'{os.path.getsize(StaticSnapshot.DEFAULT_PATH)} bytes.')
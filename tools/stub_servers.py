@@ -0,0 +1,287 @@
+'''
+    Local stand-ins for the HTTP services this project talks to, zkillboard's RedisQ and API, ESI and Discord
+    webhooks, for offline testing and benchmarks.
+
+    Each stub runs a threaded http.server on 127.0.0.1 in a background thread. Use port 0 to pick a free port, and
+    point the client at stub.url.
+
+        stub = StubEsiServer(latency=0.05).start()
+        names = EsiBulkNames(base_url=stub.url).bulk_lookup_names([95631841], [98366055], [99004357])
+        stub.stop()
+'''
+
+import json
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubServer(object):
+    '''
+        latency is added to every response, in seconds, to model a remote service
+    '''
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.request_count = 0
+        self.lock = threading.Lock()
+        self.httpd = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are sent separately, Nagle would hold the body of kept alive connections back
+            disable_nagle_algorithm = True
+
+            def _dispatch(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                with stub.lock:
+                    stub.request_count += 1
+                if stub.latency > 0:
+                    time.sleep(stub.latency)
+                status, headers, payload = stub.handle(method, self.path, body)
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self._dispatch('GET')
+
+            def do_POST(self):
+                self._dispatch('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    # Override, returns (status, headers, body bytes)
+    def handle(self, method, path, body):
+        return 404, {}, b''
+
+    def json_response(self, data, status=200):
+        return status, {'Content-Type': 'application/json'}, json.dumps(data).encode('utf-8')
+
+
+# ######################################################################################################
+# RedisQ
+
+class StubRedisqServer(StubServer):
+    '''
+        Answers RedisQ's /listen.php with the killmails queued by feed(), one per request in the order they were fed.
+        A request waits up to wait seconds for a killmail and then answers {'package': null}, the same as RedisQ does
+        after 10 seconds. served[killmail_id] is the time.perf_counter() each killmail was sent.
+    '''
+    ROUTE_LISTEN = re.compile(r'^/listen\.php')
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, wait=1.0):
+        super().__init__(host, port, latency)
+        self.wait = wait
+        self.packages = deque()
+        self.condition = threading.Condition()
+        self.served = {}
+
+    @property
+    def listen_url(self):
+        return f'{self.url}/listen.php'
+
+    # Queue an ESI killmail, zkb is zkillboard's metadata, generated when None
+    def feed(self, killmail, zkb=None):
+        if zkb is None:
+            zkb = {'hash': killmail.get('hash', '%040x' % killmail['killmail_id']), 'totalValue': 0.0, 'points': 1}
+        with self.condition:
+            self.packages.append({'killID': killmail['killmail_id'], 'killmail': killmail, 'zkb': zkb})
+            self.condition.notify()
+
+    # Killmails fed and not fetched yet
+    def backlog(self):
+        with self.condition:
+            return len(self.packages)
+
+    def handle(self, method, path, body):
+        if method != 'GET' or not self.ROUTE_LISTEN.match(path):
+            return self.json_response({'error': 'unknown route'}, 404)
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.packages, timeout=self.wait):
+                return self.json_response({'package': None})
+            package = self.packages.popleft()
+            self.served[package['killID']] = time.perf_counter()
+        return self.json_response({'package': package})
+
+
+class StubZkillboardServer(StubServer):
+    '''
+        Answers zkillboard's /api/kills/regionID/<region_id>/page/<page>/ with the killmails of a region, newest first,
+        page_size per page. killmails are ESI killmails, each needs a 'hash'. Pages past the last are empty.
+    '''
+    ROUTE_REGION_PAGE = re.compile(r'^/(?:api/)?kills/regionID/(\d+)/page/(\d+)/')
+
+    def __init__(self, killmails, region_lookup, host='127.0.0.1', port=0, latency=0.0, page_size=200):
+        super().__init__(host, port, latency)
+        self.page_size = page_size
+        self.regions = {}
+        for killmail in sorted(killmails, key=lambda x: x['killmail_id'], reverse=True):
+            self.regions.setdefault(region_lookup(killmail['solar_system_id']), []).append(killmail)
+
+    def handle(self, method, path, body):
+        match = self.ROUTE_REGION_PAGE.match(path)
+        if method != 'GET' or not match:
+            return self.json_response({'error': 'unknown route'}, 404)
+        killmails = self.regions.get(int(match.group(1)), [])
+        start = (int(match.group(2)) - 1) * self.page_size
+        return self.json_response([{'killmail_id': x['killmail_id'], 'zkb': {'hash': x['hash'], 'points': 1}}
+                                   for x in killmails[start:start + self.page_size]])
+
+
+# ######################################################################################################
+# ESI
+
+class StubEsiServer(StubServer):
+    '''
+        Answers the ESI name endpoints with generated names. The category of an id follows ESI's id ranges.
+        Ids in invalid_ids are unknown, and make POST /universe/names/ fail with a 404 the same way ESI does.
+        killmails are answered on /killmails/<id>/<hash>/, without the 'hash' and 'zkb' keys the listener adds.
+    '''
+    ROUTE_ENTITY = re.compile(r'^/(?:latest/)?(characters|corporations|alliances)/(\d+)/')
+    ROUTE_NAMES = re.compile(r'^/(?:latest/)?universe/names/')
+    ROUTE_KILLMAIL = re.compile(r'^/(?:latest/)?killmails/(\d+)/([0-9a-f]+)/')
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, invalid_ids=(), killmails=()):
+        super().__init__(host, port, latency)
+        self.invalid_ids = set(invalid_ids)
+        self.killmails = {x['killmail_id']: x for x in killmails}
+
+    @staticmethod
+    def category_for_id(id):
+        if 98000000 <= id < 99000000 or 1000000 <= id < 2000000:
+            return 'corporation'
+        if 99000000 <= id < 100000000:
+            return 'alliance'
+        return 'character'
+
+    def name_for_id(self, id):
+        return f'{self.category_for_id(id).title()} {id}'
+
+    def handle(self, method, path, body):
+        match = self.ROUTE_KILLMAIL.match(path)
+        if method == 'GET' and match:
+            killmail = self.killmails.get(int(match.group(1)))
+            if killmail is None or killmail.get('hash') != match.group(2):
+                return self.json_response({'error': 'Invalid killmail_id and/or killmail_hash'}, 422)
+            return self.json_response({x: y for x, y in killmail.items() if x not in ('hash', 'zkb')})
+
+        match = self.ROUTE_ENTITY.match(path)
+        if method == 'GET' and match:
+            id = int(match.group(2))
+            if id in self.invalid_ids:
+                return self.json_response({'error': 'not found'}, 404)
+            return self.json_response({'name': self.name_for_id(id)})
+
+        if method == 'POST' and self.ROUTE_NAMES.match(path):
+            try:
+                ids = json.loads(body)
+            except ValueError:
+                return self.json_response({'error': 'invalid json'}, 400)
+            if not isinstance(ids, list) or len(ids) == 0 or len(ids) > 1000:
+                return self.json_response({'error': 'between 1 and 1000 ids required'}, 400)
+            if any(x in self.invalid_ids for x in ids):
+                return self.json_response({'error': 'Ensure all IDs are valid before resolving.'}, 404)
+            return self.json_response([
+                {'id': x, 'name': self.name_for_id(x), 'category': self.category_for_id(x)} for x in set(ids)
+            ])
+
+        return self.json_response({'error': 'unknown route'}, 404)
+
+
+# ######################################################################################################
+# Discord
+
+class StubDiscordServer(StubServer):
+    '''
+        Accepts webhook posts on /api/webhooks/<id>/<token> and keeps their content in messages[id], and the
+        time.perf_counter() each was received in post_times[id].
+        Each webhook may post rate_limit times per rate_window seconds, with Discord's rate limit headers, further posts
+        get a 429 with retry_after. The first fail_requests posts get a 500.
+    '''
+    ROUTE_WEBHOOK = re.compile(r'^/api/webhooks/(\d+)/([^/?]+)')
+    MAX_CONTENT = 2000
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, rate_limit=5, rate_window=2.0, fail_requests=0):
+        super().__init__(host, port, latency)
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.fail_requests = fail_requests
+        self.messages = {}
+        self.post_times = {}
+        self.rate_limited = 0
+        self.windows = {}
+
+    def webhook_url(self, webhook_id, token='token'):
+        return f'{self.url}/api/webhooks/{webhook_id}/{token}'
+
+    def handle(self, method, path, body):
+        match = self.ROUTE_WEBHOOK.match(path)
+        if method != 'POST' or not match:
+            return self.json_response({'message': 'Unknown Webhook', 'code': 10015}, 404)
+        webhook_id = int(match.group(1))
+
+        with self.lock:
+            if self.fail_requests > 0:
+                self.fail_requests -= 1
+                return self.json_response({'message': 'Internal Server Error'}, 500)
+
+            # Fixed window per webhook
+            now = time.monotonic()
+            window_start, count = self.windows.get(webhook_id, (now, 0))
+            if now - window_start >= self.rate_window:
+                window_start, count = now, 0
+            reset_after = self.rate_window - (now - window_start)
+            if count >= self.rate_limit:
+                self.rate_limited += 1
+                status, headers, payload = self.json_response(
+                    {'message': 'You are being rate limited.', 'retry_after': round(reset_after, 3), 'global': False},
+                    429)
+                headers.update({'Retry-After': str(round(reset_after, 3)), 'X-RateLimit-Remaining': '0'})
+                return status, headers, payload
+            self.windows[webhook_id] = (window_start, count + 1)
+
+        try:
+            content = json.loads(body)['content']
+        except (ValueError, KeyError, TypeError):
+            return self.json_response({'message': 'Cannot send an empty message', 'code': 50006}, 400)
+        if len(content) > self.MAX_CONTENT:
+            return self.json_response({'content': ['Must be 2000 or fewer in length.']}, 400)
+
+        with self.lock:
+            self.messages.setdefault(webhook_id, []).append(content)
+            self.post_times.setdefault(webhook_id, []).append(time.perf_counter())
+        return 204, {
+            'X-RateLimit-Limit': str(self.rate_limit),
+            'X-RateLimit-Remaining': str(self.rate_limit - count - 1),
+            'X-RateLimit-Reset-After': str(round(reset_after, 3)),
+        }, b''
@@ -0,0 +1,177 @@
+'''
+    In-memory graph of the stargate network from the Eve Static Data Dump.
+
+    The graph is stored in CSR (compressed sparse row) form:
+        system_ids[i]                           - solar system id of dense index i, sorted ascending
+        offsets[i] .. offsets[i + 1]            - slice of 'neighbors' holding the exits of system i
+        neighbors[j]                            - dense index of a neighboring system
+
+    Shortest path trees (distance and predecessor per system) are computed with a breadth first search and cached
+    per root system, so route and jump count queries are array walks with no sql involved.
+'''
+
+from array import array
+from collections import OrderedDict
+
+
+class UniverseGraphException(Exception):
+    '''Raise whenever any error or exception occurs'''
+
+class UniverseGraph(object):
+    UNREACHABLE = -1
+    MAX_CACHED_TREES = 32
+
+    def __init__(self, system_ids, offsets, neighbors):
+        if len(offsets) != len(system_ids) + 1:
+            raise UniverseGraphException(f'offsets length {len(offsets)} does not match {len(system_ids)} systems')
+        self.system_ids = system_ids
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.index = {system_id: i for i, system_id in enumerate(system_ids)}
+        self.trees = OrderedDict()
+        self.pinned = {}
+
+    # Build the graph from (from_system_id, to_system_id) rows, as stored in mapSolarSystemJumps
+    @classmethod
+    def from_jumps(cls, jump_rows):
+        exits = {}
+        for from_id, to_id in jump_rows:
+            exits.setdefault(from_id, []).append(to_id)
+            exits.setdefault(to_id, [])
+
+        system_ids = array('l', sorted(exits))
+        index = {system_id: i for i, system_id in enumerate(system_ids)}
+        offsets = array('l', [0])
+        neighbors = array('l')
+        for system_id in system_ids:
+            neighbors.extend(sorted(index[x] for x in set(exits[system_id])))
+            offsets.append(len(neighbors))
+
+        return cls(system_ids, offsets, neighbors)
+
+    def __contains__(self, solarsystem_id):
+        return solarsystem_id in self.index
+
+    def __len__(self):
+        return len(self.system_ids)
+
+    def get_exits(self, solarsystem_id):
+        try:
+            i = self.index[solarsystem_id]
+        except KeyError:
+            return []
+        return [self.system_ids[j] for j in self.neighbors[self.offsets[i]:self.offsets[i + 1]]]
+
+
+    # ################################
+    # Shortest path trees
+
+    # Breadth first search from root, returns (distance, predecessor) arrays indexed by dense index
+    def _build_tree(self, root_index):
+        count = len(self.system_ids)
+        distance = array('l', [self.UNREACHABLE]) * count
+        predecessor = array('l', [-1]) * count
+        offsets = self.offsets
+        neighbors = self.neighbors
+
+        distance[root_index] = 0
+        frontier = [root_index]
+        depth = 0
+        while frontier:
+            depth += 1
+            next_frontier = []
+            for i in frontier:
+                for j in neighbors[offsets[i]:offsets[i + 1]]:
+                    if distance[j] == self.UNREACHABLE:
+                        distance[j] = depth
+                        predecessor[j] = i
+                        next_frontier.append(j)
+            frontier = next_frontier
+
+        return distance, predecessor
+
+    # Return the cached shortest path tree rooted at solarsystem_id, building it if needed
+    def get_tree(self, solarsystem_id):
+        if solarsystem_id in self.pinned:
+            return self.pinned[solarsystem_id]
+        try:
+            tree = self.trees[solarsystem_id]
+            self.trees.move_to_end(solarsystem_id)
+            return tree
+        except KeyError:
+            pass
+
+        try:
+            root_index = self.index[solarsystem_id]
+        except KeyError:
+            raise UniverseGraphException(f'solar system {solarsystem_id} is not in the jump graph')
+
+        tree = self._build_tree(root_index)
+        self.trees[solarsystem_id] = tree
+        while len(self.trees) > self.MAX_CACHED_TREES:
+            self.trees.popitem(last=False)
+        return tree
+
+    # Build and pin the tree for a system that is queried constantly, such as the home system
+    def precompute(self, solarsystem_id):
+        self.pinned[solarsystem_id] = self.get_tree(solarsystem_id)
+        self.trees.pop(solarsystem_id, None)
+
+    def _has_tree(self, solarsystem_id):
+        return solarsystem_id in self.pinned or solarsystem_id in self.trees
+
+    # Return the route as dense indexes walking the predecessors of tree from start_index up to the tree root
+    def _walk_to_root(self, tree, start_index):
+        distance, predecessor = tree
+        route = []
+        current = start_index
+        while distance[current] > 0:
+            route.append(current)
+            current = predecessor[current]
+        return route
+
+
+    # ################################
+    # Queries
+
+    # Number of jumps between two systems, UNREACHABLE if there is no stargate route
+    def get_jump_count(self, start_solarsystem_id, target_solarsystem_id):
+        if start_solarsystem_id not in self.index or target_solarsystem_id not in self.index:
+            return self.UNREACHABLE
+
+        if self._has_tree(target_solarsystem_id) or not self._has_tree(start_solarsystem_id):
+            distance, _ = self.get_tree(target_solarsystem_id)
+            return distance[self.index[start_solarsystem_id]]
+
+        distance, _ = self.get_tree(start_solarsystem_id)
+        return distance[self.index[target_solarsystem_id]]
+
+    # Solar system ids within max_jumps of solarsystem_id, including itself
+    def get_systems_within(self, solarsystem_id, max_jumps):
+        distance, _ = self.get_tree(solarsystem_id)
+        return [self.system_ids[i] for i, jumps in enumerate(distance) if 0 <= jumps <= max_jumps]
+
+    # Same contract as LookupEveStaticDump.find_route(): a list of solar system ids starting with
+    # start_solarsystem_id and ending on the system before target_solarsystem_id. Empty if no route exists.
+    def find_route(self, start_solarsystem_id, target_solarsystem_id):
+        if start_solarsystem_id not in self.index or target_solarsystem_id not in self.index:
+            return []
+
+        start_index = self.index[start_solarsystem_id]
+        target_index = self.index[target_solarsystem_id]
+
+        # A tree rooted on the target can be walked directly from the start
+        if self._has_tree(target_solarsystem_id) or not self._has_tree(start_solarsystem_id):
+            tree = self.get_tree(target_solarsystem_id)
+            if tree[0][start_index] == self.UNREACHABLE:
+                return []
+            return [self.system_ids[i] for i in self._walk_to_root(tree, start_index)]
+
+        # Otherwise walk the tree rooted on the start from the target, and reverse it
+        tree = self.get_tree(start_solarsystem_id)
+        if tree[0][target_index] == self.UNREACHABLE:
+            return []
+        path = self._walk_to_root(tree, target_index)   # target ... first hop after start
+        path.reverse()
+        route = [start_solarsystem_id] + [self.system_ids[i] for i in path]
+        return route[:-1]
@@ -0,0 +1,221 @@
+'''
+    Load historical killmails of whole regions from zKillboard and ESI into the RedisqCache archive.
+
+    zKillboard's API lists the ids and hashes of a region's killmails, newest first, a page at a time. Each killmail is
+    then fetched from ESI with its hash. Pages are fetched on several threads, within a request rate budget per
+    service, and each page is written to the archive in one transaction as soon as it is complete. Only a window of
+    pages is held in memory, however many are loaded.
+
+    Pages written are recorded in a checkpoint file, so an interrupted backfill resumes with the pages it did not
+    finish. Killmails already in the archive are not fetched from ESI again. The checkpoint is
+        { '<region_id>': { 'done': [1, 2, 5], 'end': 31 } }
+    where end is the first page zKillboard returned empty, when one was reached.
+
+        backfill = Backfill(RedisqCache(), 'cache/zkb_regions/backfill.json')
+        backfill.run([10000015], 1, 50)
+'''
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+from tools.http_client import HttpClient
+from tools.redisq_cache import RedisqCacheException
+
+
+class BackfillException(Exception):
+    '''Raise whenever any error or exception occurs'''
+
+
+class RateLimiter(object):
+    '''
+        Spaces calls to acquire() at least 1 / rate seconds apart, across threads. rate 0 does not limit.
+    '''
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_at = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.next_at)
+            self.next_at = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
+class Backfill(object):
+    ZKB_URL = 'https://zkillboard.com/api'
+    ESI_URL = 'https://esi.evetech.net/latest'
+    ATTEMPTS = 3            # Requests of the same url before the page is left for the next run
+    BACKOFF = 2.0           # Seconds before the first retry, doubled for every retry after it
+
+    '''
+        cache is the RedisqCache killmails are archived to, checkpoint_path the json file of pages written.
+        workers is the number of pages fetched at a time, esi_workers the number of killmails fetched at a time.
+        zkb_rate and esi_rate are the requests per second allowed to each service.
+        http is the HttpClient zKillboard pages are fetched with, ESI gets a connection pool of its own.
+    '''
+    def __init__(self, cache, checkpoint_path, workers=4, esi_workers=10, zkb_rate=1.0, esi_rate=20.0,
+                 zkb_url=ZKB_URL, esi_url=ESI_URL, timeout=30.0, http=None):
+        self.cache = cache
+        self.checkpoint_path = checkpoint_path
+        self.workers = max(1, workers)
+        self.esi_workers = max(1, esi_workers)
+        self.zkb_limiter = RateLimiter(zkb_rate)
+        self.esi_limiter = RateLimiter(esi_rate)
+        self.zkb_url = zkb_url.rstrip('/')
+        self.esi_url = esi_url.rstrip('/')
+        self.zkb_http = http if http is not None else HttpClient(pool_size=self.workers, read_timeout=timeout)
+        self.esi_http = HttpClient(pool_size=self.esi_workers, read_timeout=timeout)
+        self.checkpoint = self.load_checkpoint()
+        self.stats = {'pages': 0, 'failed_pages': 0, 'killmails': 0, 'archived': 0, 'esi_requests': 0}
+
+
+    # ################################
+    # Checkpoint
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, 'r') as fp:
+                checkpoint = json.load(fp)
+        except OSError:
+            return {}
+        except ValueError as e:
+            raise BackfillException(f'invalid checkpoint [{self.checkpoint_path}] - [{e}]')
+        return {int(region_id): {'done': set(x.get('done', [])), 'end': x.get('end')}
+                for region_id, x in checkpoint.items()}
+
+    # Replace the file atomically, so an interrupted write never loses the pages recorded before
+    def save_checkpoint(self):
+        checkpoint = {str(region_id): {'done': sorted(x['done']), 'end': x['end']}
+                      for region_id, x in self.checkpoint.items()}
+        temp_path = f'{self.checkpoint_path}.tmp'
+        with open(temp_path, 'w') as fp:
+            json.dump(checkpoint, fp)
+        os.replace(temp_path, self.checkpoint_path)
+
+    def _region_state(self, region_id):
+        return self.checkpoint.setdefault(region_id, {'done': set(), 'end': None})
+
+    # Pages of a region still to load, none past the end of the region
+    def pending_pages(self, region_id, first_page, last_page):
+        state = self._region_state(region_id)
+        end = state['end'] if state['end'] is not None else last_page + 1
+        return [x for x in range(first_page, min(last_page, end - 1) + 1) if x not in state['done']]
+
+
+    # ################################
+    # Fetching
+
+    def _get_json(self, url, limiter, http):
+        backoff = self.BACKOFF
+        for attempt in range(1, self.ATTEMPTS + 1):
+            limiter.acquire()
+            try:
+                resp = http.get(url)
+                if resp.status_code == 200:
+                    return resp.json()
+                error = f'status code {resp.status_code}'
+                # A 4xx other than rate limiting will not change on a retry
+                if resp.status_code < 500 and resp.status_code not in (420, 429):
+                    break
+            except (requests.exceptions.RequestException, ValueError) as e:
+                error = str(e)
+            if attempt < self.ATTEMPTS:
+                time.sleep(backoff)
+                backoff *= 2
+        raise BackfillException(f'could not fetch {url} [{error}]')
+
+    def fetch_killmail(self, killmail_id, killmail_hash):
+        self.stats['esi_requests'] += 1
+        return self._get_json(f'{self.esi_url}/killmails/{killmail_id}/{killmail_hash}/?datasource=tranquility',
+                              self.esi_limiter, self.esi_http)
+
+    '''
+        Fetch one page of a region and its killmails. Returns (killmails, zkillboard entries), killmails is a list of
+        (killmail_id, json string, killmail) rows for RedisqCache.insert_killmails(). Killmails already archived are
+        left out. Raises BackfillException when the page or one of its killmails could not be fetched.
+    '''
+    def fetch_page(self, region_id, page, esi_pool):
+        entries = self._get_json(f'{self.zkb_url}/kills/regionID/{region_id}/page/{page}/', self.zkb_limiter,
+                                 self.zkb_http)
+        if not isinstance(entries, list):
+            raise BackfillException(f'unexpected zKillboard answer for region {region_id} page {page}')
+        try:
+            archived = self.cache.archived_killmail_ids([x['killmail_id'] for x in entries])
+        except RedisqCacheException as e:
+            raise BackfillException(str(e))
+
+        wanted = [x for x in entries if x['killmail_id'] not in archived]
+        futures = [esi_pool.submit(self.fetch_killmail, x['killmail_id'], x['zkb']['hash']) for x in wanted]
+        rows = []
+        for entry, future in zip(wanted, futures):
+            killmail = future.result()
+            # The same additions get_next_redisq() makes to live killmails
+            killmail['hash'] = entry['zkb']['hash']
+            killmail['zkb'] = entry['zkb']
+            rows.append((killmail['killmail_id'], json.dumps(killmail), killmail))
+        return rows, entries
+
+
+    # ################################
+    # Loading
+
+    '''
+        Load pages first_page to last_page of every region, skipping pages written by an earlier run.
+        progress(region_id, page, killmails) is called after each page is written.
+        Returns the stats of this run, with the connection stats of both services under 'http'.
+    '''
+    def run(self, region_ids, first_page, last_page, progress=None):
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='backfill_page') as page_pool, \
+                ThreadPoolExecutor(self.esi_workers, thread_name_prefix='backfill_esi') as esi_pool:
+            for region_id in region_ids:
+                self._run_region(region_id, first_page, last_page, page_pool, esi_pool, progress)
+        return {**self.stats, 'http': {**self.zkb_http.get_stats(), **self.esi_http.get_stats()}}
+
+    def _run_region(self, region_id, first_page, last_page, page_pool, esi_pool, progress):
+        state = self._region_state(region_id)
+        pages = iter(self.pending_pages(region_id, first_page, last_page))
+        running = {}
+
+        # Keep a window of pages in flight, memory holds at most that many pages
+        while True:
+            while len(running) < self.workers:
+                page = next(pages, None)
+                if page is None or (state['end'] is not None and page >= state['end']):
+                    break
+                running[page_pool.submit(self.fetch_page, region_id, page, esi_pool)] = page
+            if not running:
+                return
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                page = running.pop(future)
+                try:
+                    rows, entries = future.result()
+                    if rows:
+                        self.cache.insert_killmails(rows)
+                except (BackfillException, RedisqCacheException) as e:
+                    self.stats['failed_pages'] += 1
+                    print(f'   xxx Region {region_id} page {page} not loaded, it is retried on the next run [{e}]')
+                    continue
+
+                if not entries:
+                    # Past the last page of the region, the pages after it are empty as well
+                    state['end'] = page if state['end'] is None else min(state['end'], page)
+                else:
+                    state['done'].add(page)
+                self.stats['pages'] += 1
+                self.stats['killmails'] += len(entries)
+                self.stats['archived'] += len(rows)
+                self.save_checkpoint()
+                if progress is not None:
+                    progress(region_id, page, len(entries))
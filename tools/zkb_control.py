@@ -0,0 +1,105 @@
+'''
+    Request / reply control channel of the redisq listener, next to the killmail broadcast.
+
+    The listener binds a ROUTER socket, by default on port 7273, and clients connect with a DEALER socket.
+        request     - [command, arguments]
+        reply       - [status, result], status is b'ok' or b'error' with a message as the result
+    Arguments and results are packed with zkb_wire.pack_value(), msgpack when it is installed and json otherwise.
+
+    Commands:
+        names       - {'ids': {'character_ids': [...], ...}} or {} for everything
+                      Returns {'epoch', 'sequence', 'names'}, the names the listener has published. sequence is the
+                      number of the last names message published before the reply.
+        since       - {'epoch', 'sequence', 'region_ids'}
+                      Killmails broadcast after a position that are still in memory, see tools/zkb_recent.py.
+        replay      - {'epoch', 'after', 'until', 'region_ids', 'limit'}, until and region_ids may be None
+                      Returns {'epoch', 'listener_epoch', 'more', 'messages'}, the killmails of epoch with a sequence
+                      after `after` and up to until, as [[sequence, topic, data], ...]. Answered from memory when it
+                      still holds them, otherwise from the archive, which also covers earlier epochs. Ask again from
+                      the last sequence returned while more is True.
+        interest    - {'id', 'rules', 'ttl'}
+                      Registers the killmails a subscriber uses as rule dictionaries, see tools/zkb_interest.py, for
+                      ttl seconds. Register again to renew, rules None removes the registration. Returns {'epoch',
+                      'ttl', 'policy', 'subscribers'}, policy is the listener's --enrich-policy.
+        stats       - {}
+                      Returns the epoch and last sequence broadcast, the send high-water mark, replay counts, and the
+                      pipeline queue depths and stage counts.
+'''
+
+import zmq
+
+from tools import zkb_wire
+from tools.zkb_wire import ZKBWireException
+
+
+DEFAULT_CONTROL_ADDRESS = 'tcp://127.0.0.1:7273'
+DEFAULT_CONTROL_BIND = 'tcp://*:7273'
+
+
+class ControlServer(object):
+    '''
+        handlers is { 'command': function(arguments) -> result }. Raise ZKBWireException in a handler to reply with
+        an error. run() serves requests until the context is terminated, call it from its own thread.
+    '''
+    def __init__(self, handlers, bind=DEFAULT_CONTROL_BIND, context=None):
+        self.handlers = handlers
+        self.context = context or zmq.Context.instance()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.bind(bind)
+        self.request_count = 0
+
+    def handle(self, command, arguments):
+        handler = self.handlers.get(command)
+        if handler is None:
+            raise ZKBWireException(f'unknown command [{command}]')
+        return handler(arguments)
+
+    def run(self):
+        while True:
+            try:
+                frames = self.socket.recv_multipart()
+            except zmq.ContextTerminated:
+                return
+            if len(frames) != 3:
+                continue
+            identity, command, body = frames
+            self.request_count += 1
+            try:
+                result = self.handle(command.decode('utf-8', 'replace'), zkb_wire.unpack_value(body) or {})
+                reply = [b'ok', zkb_wire.pack_value(result)]
+            except Exception as e:
+                reply = [b'error', zkb_wire.pack_value(str(e))]
+            try:
+                self.socket.send_multipart([identity] + reply)
+            except zmq.ZMQError as e:
+                print(f'   xxx Could not reply to control request [{e}]')
+
+
+class ControlClient(object):
+    '''
+        timeout is the number of seconds to wait for a reply. A new socket is used for every request, so a reply
+        that arrives after a timeout can never be taken as the reply to the next request.
+    '''
+    def __init__(self, address=DEFAULT_CONTROL_ADDRESS, timeout=5.0, context=None):
+        self.address = address
+        self.timeout = timeout
+        self.context = context or zmq.Context.instance()
+
+    # Returns the result of the command, raises ZKBWireException on errors and timeouts
+    def request(self, command, arguments=None):
+        socket = self.context.socket(zmq.DEALER)
+        try:
+            socket.connect(self.address)
+            socket.send_multipart([command.encode('utf-8'), zkb_wire.pack_value(arguments or {})])
+            if not socket.poll(int(self.timeout * 1000)):
+                raise ZKBWireException(f'no reply to [{command}] from {self.address} in {self.timeout} seconds')
+            frames = socket.recv_multipart()
+        finally:
+            socket.close(linger=0)
+
+        if len(frames) != 2:
+            raise ZKBWireException(f'invalid reply to [{command}]')
+        result = zkb_wire.unpack_value(frames[1])
+        if frames[0] != b'ok':
+            raise ZKBWireException(f'[{command}] failed - [{result}]')
+        return result
@@ -0,0 +1,91 @@
+'''
+    Killmail ids already admitted by the listener, so a killmail received from several RedisQ queues is enriched and
+    broadcast once.
+
+    Every RedisQ queue id receives every killmail, so listeners fetching with several queue ids see each killmail
+    several times. The ids of the last size killmails are kept in memory. Killmail ids mostly grow with time, so an
+    id above every id that ever left memory, or was broadcast before the listener started, has not been seen. Only an
+    id at or below that watermark, a killmail that reached zkillboard late, is looked up in the archive's broadcasts
+    table.
+
+    Killmails are checked against what was broadcast, not against the killmails table. A killmail is archived before
+    it is enriched and broadcast, so a listener that stopped in between broadcasts it when a copy arrives after the
+    restart.
+
+    size must cover the killmails in the pipeline and waiting for KillmailWriter to record their broadcast, a few
+    seconds worth, or a late duplicate could leave memory before the archive has it.
+'''
+
+import threading
+from collections import deque
+
+from tools.redisq_cache import RedisqCacheException
+
+
+class SeenKillmails(object):
+    DEFAULT_SIZE = 100000
+
+    '''
+        archive is the RedisqCache broadcasts are recorded in, None to only remember the last size killmails
+    '''
+    def __init__(self, size=DEFAULT_SIZE, archive=None):
+        self.size = max(1, size)
+        self.archive = archive
+        self.ids = set()
+        self.order = deque()
+        self.watermark = 0
+        if archive is not None:
+            try:
+                self.watermark = archive.max_broadcast_killmail_id()
+            except RedisqCacheException as e:
+                print(f'   xxx Could not read the newest broadcast killmail, late duplicates may be broadcast [{e}]')
+        self.stats = {'admitted': 0, 'duplicates': 0, 'archive_lookups': 0}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    '''
+        True the first time a killmail id is added, False for every copy after it. The archive is looked up without
+        the lock held, so get_stats() and other copies never wait on sqlite.
+    '''
+    def add(self, killmail_id):
+        with self.lock:
+            if killmail_id in self.ids:
+                self.stats['duplicates'] += 1
+                return False
+            lookup = killmail_id <= self.watermark
+        broadcast = lookup and self._broadcast(killmail_id)
+        with self.lock:
+            # A copy added by another thread during the lookup was admitted, this one is a duplicate
+            if killmail_id in self.ids:
+                self.stats['duplicates'] += 1
+                return False
+            # Broadcast ids are remembered as well, so their next copies are not looked up again
+            self.ids.add(killmail_id)
+            self.order.append(killmail_id)
+            if len(self.order) > self.size:
+                evicted = self.order.popleft()
+                self.ids.discard(evicted)
+                self.watermark = max(self.watermark, evicted)
+            if broadcast:
+                self.stats['duplicates'] += 1
+                return False
+            self.stats['admitted'] += 1
+            return True
+
+    # A failed lookup admits the killmail, a duplicate broadcast is better than a gap
+    def _broadcast(self, killmail_id):
+        if self.archive is None:
+            return False
+        with self.lock:
+            self.stats['archive_lookups'] += 1
+        try:
+            return bool(self.archive.broadcast_killmail_ids([killmail_id]))
+        except RedisqCacheException as e:
+            print(f'   xxx Could not check the archive for killmail {killmail_id} [{e}]')
+            return False
+
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, 'remembered': len(self.ids), 'watermark': self.watermark}
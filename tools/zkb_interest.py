@@ -0,0 +1,80 @@
+'''
+    Interests subscribers register with the redisq listener, so it only resolves names for killmails someone will use.
+
+    A subscriber sends the killmails it wants as rules in the format of tools/rule_engine.py (regions, systems, ship
+    types, alliances, minimum attackers, maximum age) with the control command 'interest'. Registrations are leases:
+    one that is not renewed within its ttl expires, so a subscriber that went away stops costing ESI requests.
+    ZKBSubscriber.register_interest() renews its lease from recv().
+
+    With --enrich-policy interest, the listener still archives and broadcasts every killmail, but only resolves names
+    for killmails that match a registered interest. Names of the others are resolved when a subscriber asks for them.
+'''
+
+import threading
+import time
+
+from tools.rule_engine import RuleEngine, RuleEngineException
+from tools.zkb_wire import ZKBWireException
+
+
+class InterestTable(object):
+    DEFAULT_TTL = 300       # Seconds a registration lasts without being renewed
+    MAX_TTL = 3600
+
+    '''
+        region_lookup(solar_system_id) returns the region of a solar system, see SolarSystemTable.get_region_id.
+    '''
+    def __init__(self, region_lookup=None):
+        self.region_lookup = region_lookup
+        # { subscriber id: (expires, [Rule, ...]) }
+        self.leases = {}
+        self.engine = RuleEngine([], region_lookup)
+        self.next_expiry = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.leases)
+
+    '''
+        Register or renew the interest of a subscriber. rules is a list of rule dictionaries, an empty list or None
+        removes the registration. Returns the ttl granted.
+    '''
+    def register(self, subscriber_id, rules, ttl=DEFAULT_TTL):
+        ttl = max(1, min(int(ttl), self.MAX_TTL))
+        compiled = None
+        if rules:
+            try:
+                compiled = RuleEngine.from_config({'rules': rules}, self.region_lookup).rules
+            except (RuleEngineException, TypeError, ValueError) as e:
+                raise ZKBWireException(f'invalid interest [{e}]')
+
+        with self.lock:
+            if compiled is None:
+                self.leases.pop(subscriber_id, None)
+            else:
+                self.leases[subscriber_id] = (time.monotonic() + ttl, compiled)
+            self._rebuild()
+        return ttl
+
+    # Recompile the combined engine, called with the lock held
+    def _rebuild(self):
+        self.engine = RuleEngine([x for _, rules in self.leases.values() for x in rules], self.region_lookup)
+        self.next_expiry = min((expires for expires, _ in self.leases.values()), default=None)
+
+    def _expire(self):
+        now = time.monotonic()
+        if self.next_expiry is None or now < self.next_expiry:
+            return
+        with self.lock:
+            expired = [id for id, (expires, _) in self.leases.items() if expires <= now]
+            for id in expired:
+                del self.leases[id]
+            self._rebuild()
+        for id in expired:
+            print(f'--- Interest of subscriber {id} expired')
+
+    # True when a registered interest matches the killmail
+    def wants(self, killmail):
+        self._expire()
+        return bool(self.engine.match(killmail))
@@ -0,0 +1,89 @@
+'''
+    Name tables shared between the redisq listener and its subscribers.
+
+    Most character, corporation, and alliance ids in a killmail have been seen in earlier killmails. Instead of
+    sending every name with every killmail, the listener remembers which names it has published, and sends only new
+    or changed names:
+        - on the names topic (zkb_topics.NAMES_TOPIC), so every subscriber can keep its table complete
+        - with the killmail itself, flagged with zkb_wire.FLAG_NAMES_DELTA
+    A subscriber keeps its own NameTable, and fills it from a snapshot of the listener's table when it starts.
+'''
+
+import threading
+from collections import OrderedDict
+
+from tools.zkb_wire import NAME_KEYS
+
+
+class NameTable(object):
+    '''
+        Names by entity type, { 'character_ids': { id: 'name' }, ... }, keeping the most recently used max_size ids
+        of each type. Safe to share between threads.
+    '''
+    DEFAULT_MAX_SIZE = 100000
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.names = {key: OrderedDict() for key in NAME_KEYS}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(x) for x in self.names.values())
+
+    '''
+        Add names, the invalid id 0 is skipped.
+        Returns the names that were not in the table or had a different name, in the same layout.
+    '''
+    def update(self, names):
+        changed = {key: {} for key in NAME_KEYS}
+        with self.lock:
+            for key in NAME_KEYS:
+                table = self.names[key]
+                for id, name in names.get(key, {}).items():
+                    if not id:
+                        continue
+                    if table.get(id) != name:
+                        table[id] = name
+                        changed[key][id] = name
+                    table.move_to_end(id)
+                while len(table) > self.max_size:
+                    table.popitem(last=False)
+        return changed
+
+    # Names for lists of ids, ids that are not in the table are left out. 0 maps to an empty string.
+    def lookup(self, character_ids, corporation_ids, alliance_ids):
+        requested = {'character_ids': character_ids, 'corporation_ids': corporation_ids,
+                     'alliance_ids': alliance_ids}
+        names = {key: {0: ''} for key in NAME_KEYS}
+        with self.lock:
+            for key, ids in requested.items():
+                table = self.names[key]
+                for id in ids:
+                    if id in table:
+                        names[key][id] = table[id]
+        return names
+
+    # The same dictionary as NameResolver.get_names_for_killmail(), from the table only
+    def names_for_killmail(self, killmail):
+        entities = [killmail['victim']] + killmail['attackers']
+        return self.lookup(
+            [x.get('character_id', 0) for x in entities],
+            [x.get('corporation_id', 0) for x in entities],
+            [x.get('alliance_id', 0) for x in entities]
+        )
+
+    # Ids of a killmail with no name in the table, in the same layout as lookup() arguments
+    def missing_for_killmail(self, killmail):
+        entities = [killmail['victim']] + killmail['attackers']
+        with self.lock:
+            return {key: sorted({x.get(key[:-1], 0) for x in entities} - {0} - self.names[key].keys())
+                    for key in NAME_KEYS}
+
+    def snapshot(self):
+        with self.lock:
+            return {key: dict(table) for key, table in self.names.items()}
+
+    def clear(self):
+        with self.lock:
+            for table in self.names.values():
+                table.clear()
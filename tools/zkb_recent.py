@@ -0,0 +1,79 @@
+'''
+    In-memory ring buffer of the killmails the listener broadcast most recently, so a subscriber that was restarted
+    can catch up from memory instead of re-reading sqlite or ESI.
+
+    Killmails are kept with their full names dictionary and numbered by the broadcast sequence of the current epoch.
+    The control channel commands 'since' and 'replay' (see tools/zkb_control.py) answer from RecentKillmails.since().
+'''
+
+import threading
+from collections import deque
+
+from tools.zkb_topics import parse_topic
+
+
+class RecentKillmails(object):
+    DEFAULT_SIZE = 1000
+    PAGE_SIZE = 200     # Killmails returned by one 'since' request, the subscriber asks again while more is True
+
+    def __init__(self, epoch, max_size=DEFAULT_SIZE):
+        self.epoch = epoch
+        self.messages = deque(maxlen=max_size)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.messages)
+
+    # Remember a broadcast killmail, sequence numbers must increase
+    def add(self, sequence, topic, data):
+        with self.lock:
+            self.messages.append((sequence, topic, data))
+
+    '''
+        Killmails broadcast after sequence, and up to until when it is not None, oldest first, limited to region_ids
+        when it is not None.
+        Returns {
+            'epoch': epoch of the listener,
+            'reset': True when epoch is not the listener's epoch, the listener was restarted and every buffered
+                     killmail is returned
+            'missed': True when killmails after sequence are no longer in the buffer,
+            'last_sequence': sequence of the last killmail broadcast,
+            'more': True when the page is full, ask again with the sequence of the last killmail returned
+            'messages': [[sequence, topic, {'killmail': {...}, 'names': {...}}], ...]
+        }
+    '''
+    def since(self, epoch, sequence, region_ids=None, limit=PAGE_SIZE, until=None):
+        reset = epoch != self.epoch
+        if reset:
+            sequence = 0
+        region_ids = set(region_ids) if region_ids is not None else None
+
+        with self.lock:
+            buffered = list(self.messages)
+        first_sequence = buffered[0][0] if buffered else None
+        last_sequence = buffered[-1][0] if buffered else sequence
+
+        messages = []
+        more = False
+        for message_sequence, topic, data in buffered:
+            if message_sequence <= sequence:
+                continue
+            if until is not None and message_sequence > until:
+                break
+            if region_ids is not None:
+                parsed = parse_topic(topic)
+                if parsed is None or parsed[0] not in region_ids:
+                    continue
+            if len(messages) == limit:
+                more = True
+                break
+            messages.append([message_sequence, topic, data])
+
+        return {
+            'epoch': self.epoch,
+            'reset': reset,
+            'missed': first_sequence is not None and first_sequence > sequence + 1,
+            'last_sequence': last_sequence,
+            'more': more,
+            'messages': messages,
+        }
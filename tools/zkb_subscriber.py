@@ -0,0 +1,336 @@
+'''
+    Subscribe to killmails broadcast by redisq_listener.py.
+
+        subscriber = ZKBSubscriber(region_ids=[10000015])
+        while True:
+            message = subscriber.recv()
+            print(message.data['killmail']['killmail_id'], message.data['names']['character_ids'])
+
+    Both wire formats are decoded to the same dictionary, with integer keys in the names dictionaries. Multipart
+    messages are received without copying and decoded straight from the frame buffers.
+
+    Multipart killmails only carry names the listener had not sent before. The subscriber keeps every name it
+    receives in a NameTable, fills it from the listener's control channel when it starts, and rebuilds the full names
+    dictionary of each killmail from it.
+
+    A multipart subscriber that saves its position after each killmail can resume where it stopped. Killmails the
+    listener broadcast in the meantime are fetched from its in-memory buffer before the live feed:
+        subscriber = ZKBSubscriber(region_ids=[10000015], resume=ZKBSubscriber.load_position(path))
+        while True:
+            message = subscriber.recv()
+            ...
+            subscriber.save_position(path)
+
+    Every multipart killmail carries its sequence number, and the sequence of the previous killmail in its region. When
+    messages were dropped, for example because the ZMQ high-water mark overflowed during a big fight, recv() notices
+    the gap and fetches the missing killmails from the listener, out of memory or its archive, before returning the
+    next live one. subscriber.stats counts them:
+        received    - live killmails received
+        gaps        - gaps found
+        dropped     - killmails missing in those gaps, at least one per gap when the listener could not be asked
+        recovered   - killmails fetched again, dropped - recovered were lost
+
+    A subscriber that only uses some killmails can register them as rules, see tools/zkb_interest.py. A listener
+    started with --enrich-policy interest then skips the ESI name lookups of killmails no subscriber registered. recv()
+    renews the registration while it waits, and does not ask for the names of skipped killmails, as they match no
+    rule. get_names_for_killmail() asks for them when they are needed after all.
+        subscriber.register_interest([{'regions': [10000015]}, {'alliances': [99004357], 'min_attackers': 10}])
+'''
+
+import json
+import os
+import time
+import uuid
+from collections import deque, namedtuple
+
+import zmq
+
+from tools.zkb_topics import TOPIC_ROOT, WIRE_TOPIC_ROOT, NAMES_TOPIC, region_prefix, parse_topic
+from tools import zkb_wire
+from tools.zkb_wire import ZKBWireException
+from tools.zkb_control import ControlClient, DEFAULT_CONTROL_ADDRESS
+from tools.zkb_names import NameTable
+
+
+# header is a zkb_wire.WireHeader, or None for legacy messages
+KillmailMessage = namedtuple('KillmailMessage', ['topic', 'header', 'data'])
+
+
+class ZKBSubscriber(object):
+    DEFAULT_ADDRESS = 'tcp://127.0.0.1:7272'
+    ROOTS = {'legacy': TOPIC_ROOT, 'multipart': WIRE_TOPIC_ROOT}
+    CONTROL_RETRY = 60.0    # Seconds to wait before using the control channel again after it failed
+
+    '''
+        region_ids limits the subscription to killmails in those regions, None subscribes to every killmail.
+        wire_format is 'multipart', or 'legacy' for listeners that do not publish multipart messages yet.
+        control_address is the listener's control channel, used to fill the name table. None to only learn names
+        from the broadcast.
+        resume is the (epoch, sequence) position of the last killmail handled before a restart, multipart only.
+        receive_hwm is the number of messages ZMQ queues before dropping messages, None for the ZMQ default.
+    '''
+    def __init__(self, address=DEFAULT_ADDRESS, region_ids=None, wire_format='multipart', context=None,
+                 control_address=DEFAULT_CONTROL_ADDRESS, resume=None, receive_hwm=None):
+        if wire_format not in self.ROOTS:
+            raise ZKBWireException(f'unknown wire format [{wire_format}]')
+        self.wire_format = wire_format
+        self.root = self.ROOTS[wire_format]
+        self.region_ids = list(region_ids) if region_ids is not None else None
+        # (epoch, sequence) of the last multipart killmail returned by recv()
+        self.position = None
+        # Sequence of the last killmail returned by region, and the sequence they are counted from, in position's epoch
+        self.region_sequences = {}
+        self.base_sequence = 0
+        self.listener_epoch = None
+        self.stats = {'received': 0, 'gaps': 0, 'dropped': 0, 'recovered': 0}
+        # Interest registered with the listener, see register_interest()
+        self.subscriber_id = uuid.uuid4().hex
+        self.interest = None
+        self.interest_epoch = None
+        self.renew_at = None
+        self.pending = deque()
+        self.context = context or zmq.Context.instance()
+        self.socket = self.context.socket(zmq.SUB)
+        if receive_hwm is not None:
+            self.socket.setsockopt(zmq.RCVHWM, receive_hwm)
+        self.socket.connect(address)
+        self.names = NameTable()
+        self.control = ControlClient(control_address, context=self.context) if control_address else None
+        self.control_failed_at = None
+        if region_ids is None:
+            self.subscribe(self.root)
+        else:
+            for region_id in region_ids:
+                self.subscribe(region_prefix(region_id, self.root))
+        if wire_format == 'multipart':
+            # Subscribe before taking the snapshot, so no names are lost in between
+            if region_ids is not None:
+                self.subscribe(NAMES_TOPIC)
+            self.load_names()
+            if resume is not None:
+                self.catch_up(*resume)
+
+    # Add a topic prefix, see tools/zkb_topics.py. The prefix must use the root of the wire format.
+    def subscribe(self, prefix):
+        self.socket.setsockopt_string(zmq.SUBSCRIBE, prefix)
+
+    # Send a control request, returns None when the control channel is not available
+    def _control_request(self, command, arguments=None):
+        if self.control is None:
+            return None
+        if self.control_failed_at is not None and time.monotonic() - self.control_failed_at < self.CONTROL_RETRY:
+            return None
+        try:
+            result = self.control.request(command, arguments)
+            self.control_failed_at = None
+            return result
+        except ZKBWireException as e:
+            self.control_failed_at = time.monotonic()
+            print(f'   xxx Control request [{command}] failed [{e}]')
+            return None
+
+    # Fill the name table from a snapshot of the names the listener has published
+    def load_names(self):
+        result = self._control_request('names')
+        if result is not None:
+            self.names.update(zkb_wire.names_keys_to_int(result['names']))
+
+    '''
+        Register the killmails this subscriber uses with the listener, as a list of rule dictionaries in the format of
+        tools/rule_engine.py. The registration lasts ttl seconds and recv() renews it, None or [] removes it.
+        Returns the listener's reply, or None when it could not be asked.
+    '''
+    def register_interest(self, rules, ttl=300):
+        self.interest = (list(rules), ttl) if rules else None
+        result = self._control_request('interest', {'id': self.subscriber_id, 'rules': rules or None, 'ttl': ttl})
+        self.interest_epoch = result['epoch'] if result is not None else None
+        if self.interest is None:
+            self.renew_at = None
+        else:
+            # Renewed well before the lease runs out, or retried later when the listener could not be asked
+            self.renew_at = time.monotonic() + (ttl / 3 if result is not None else self.CONTROL_RETRY)
+        return result
+
+    def _renew_interest(self):
+        if self.renew_at is not None and time.monotonic() >= self.renew_at:
+            self.register_interest(*self.interest)
+
+    '''
+        Fetch the killmails of epoch broadcast after sequence `after`, and up to until when it is not None, from the
+        listener's memory or archive. Returns a list of KillmailMessage, or None when the listener could not be asked.
+    '''
+    def replay(self, epoch, after, until=None, region_ids=None):
+        messages = []
+        while True:
+            result = self._control_request('replay', {'epoch': epoch, 'after': after, 'until': until,
+                                                      'region_ids': region_ids})
+            if result is None:
+                return None
+            self.listener_epoch = result['listener_epoch']
+            for message_sequence, topic, data in result['messages']:
+                data['names'] = zkb_wire.names_keys_to_int(data['names'])
+                self.names.update(data['names'])
+                header = zkb_wire.WireHeader(zkb_wire.WIRE_VERSION, 0, 0, epoch, message_sequence,
+                                             data['killmail'].get('killmail_id', 0))
+                messages.append(KillmailMessage(topic, header, data))
+                after = message_sequence
+            if not result['more'] or not result['messages']:
+                return messages
+
+    '''
+        Queue the killmails broadcast after (epoch, sequence), recv() returns them before any live killmail. The live
+        socket is already subscribed, so nothing is lost in between. When the listener was restarted since, the rest
+        of the old epoch comes from its archive, followed by the new epoch.
+        Returns the number of killmails queued.
+    '''
+    def catch_up(self, epoch, sequence):
+        self.position = (epoch, sequence)
+        self.region_sequences = {}
+        self.base_sequence = sequence
+        messages = self.replay(epoch, sequence, region_ids=self.region_ids)
+        if messages is None:
+            return 0
+        if self.listener_epoch != epoch:
+            print(f'   xxx Listener restarted since epoch {epoch}')
+            messages += self.replay(self.listener_epoch, 0, region_ids=self.region_ids) or []
+        self.pending.extend(messages)
+        return len(messages)
+
+    # Killmails that were queued by catch_up(), or broadcast live and not already returned
+    def _is_new(self, header):
+        if self.position is None or header.epoch != self.position[0]:
+            return True
+        return header.sequence > self.position[1]
+
+    '''
+        Gaps between the killmails returned so far and a live killmail, as (epoch, after, until, region_ids, expected)
+        arguments for replay(). expected is the number of killmails missing, or the least number when it is not known
+        exactly.
+    '''
+    def _find_gaps(self, topic, header):
+        if self.position is None:
+            # Nothing was received before, killmails sent before connecting were never missed
+            self.base_sequence = header.sequence - 1
+            return []
+
+        gaps = []
+        last_sequence = self.position[1]
+        if header.epoch != self.position[0]:
+            # The listener was restarted, the end of the old epoch and the start of the new one may be missing
+            gaps.append((self.position[0], self.position[1], None, self.region_ids, 0))
+            self.region_sequences = {}
+            self.base_sequence = 0
+            last_sequence = 0
+
+        if self.region_ids is None:
+            if header.sequence > last_sequence + 1:
+                gaps.append((header.epoch, last_sequence, header.sequence - 1, None,
+                             header.sequence - 1 - last_sequence))
+        else:
+            parsed = parse_topic(topic)
+            region_id = parsed[0] if parsed is not None else 0
+            last_sequence = self.region_sequences.get(region_id, self.base_sequence)
+            if header.region_previous > last_sequence:
+                gaps.append((header.epoch, last_sequence, header.region_previous, [region_id], 1))
+        return gaps
+
+    # Queue the killmails missing in gaps, in order, and count them
+    def _recover(self, gaps):
+        for epoch, after, until, region_ids, expected in gaps:
+            messages = self.replay(epoch, after, until, region_ids)
+            dropped = max(expected, len(messages or []))
+            if not dropped:
+                continue
+            self.stats['gaps'] += 1
+            self.stats['dropped'] += dropped
+            if messages is None:
+                print(f'   xxx Missed killmails after {epoch}.{after}, the listener could not send them again')
+                continue
+            self.stats['recovered'] += len(messages)
+            self.pending.extend(messages)
+
+    # Update the position after returning a killmail
+    def _returned(self, message):
+        header = message.header
+        if self.position is not None and header.epoch != self.position[0]:
+            self.region_sequences = {}
+            self.base_sequence = 0
+        self.position = (header.epoch, header.sequence)
+        parsed = parse_topic(message.topic)
+        self.region_sequences[parsed[0] if parsed is not None else 0] = header.sequence
+        return message
+
+    '''
+        Wait for the next killmail, up to timeout seconds or forever when timeout is None.
+        Returns a KillmailMessage, or None on timeout. Raises ZKBWireException for messages that cannot be decoded.
+    '''
+    def recv(self, timeout=None):
+        if self.pending:
+            return self._returned(self.pending.popleft())
+
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            # Wake up to renew the interest registration while no killmails arrive
+            self._renew_interest()
+            wake_at = min((x for x in (deadline, self.renew_at) if x is not None), default=None)
+            if wake_at is not None and not self.socket.poll(max(0, int((wake_at - time.monotonic()) * 1000))):
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+                continue
+            if self.wire_format == 'legacy':
+                topic, data = zkb_wire.decode_legacy(self.socket.recv_string())
+                return KillmailMessage(topic, None, data)
+
+            topic, header, data = zkb_wire.decode_multipart(self.socket.recv_multipart(copy=False))
+            self.names.update(data['names'])
+            if topic == NAMES_TOPIC or not self._is_new(header):
+                continue
+            if self.interest is not None and header.epoch != self.interest_epoch:
+                # The listener was restarted and lost the registration
+                self.register_interest(*self.interest)
+            if header.flags & zkb_wire.FLAG_NAMES_SKIPPED and self.interest_epoch == header.epoch:
+                # The killmail matches none of the registered rules, so its names are not asked for
+                data['names'] = self.names.names_for_killmail(data['killmail'])
+            elif header.flags & zkb_wire.FLAG_NAMES_DELTA:
+                data['names'] = self.get_names_for_killmail(data['killmail'])
+            self.stats['received'] += 1
+
+            # Killmails dropped before this one are returned first
+            self._recover(self._find_gaps(topic, header))
+            self.pending.append(KillmailMessage(topic, header, data))
+            return self._returned(self.pending.popleft())
+
+    # Full names dictionary of a killmail from the name table, names missing from it are asked from the listener
+    def get_names_for_killmail(self, killmail):
+        missing = self.names.missing_for_killmail(killmail)
+        if any(missing.values()):
+            result = self._control_request('names', {'ids': missing})
+            if result is not None:
+                self.names.update(zkb_wire.names_keys_to_int(result['names']))
+        return self.names.names_for_killmail(killmail)
+
+    # Write position to a json file, replacing it atomically so a crash never leaves half a file
+    def save_position(self, path):
+        if self.position is None:
+            return
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w') as fp:
+            json.dump({'epoch': self.position[0], 'sequence': self.position[1]}, fp)
+        os.replace(temp_path, path)
+
+    # Returns the (epoch, sequence) saved by save_position(), or None
+    @staticmethod
+    def load_position(path):
+        try:
+            with open(path, 'r') as fp:
+                position = json.load(fp)
+            return position['epoch'], position['sequence']
+        except (OSError, ValueError, KeyError) as e:
+            if os.path.exists(path):
+                print(f'   xxx Could not read subscriber position [{path}] - [{e}]')
+            return None
+
+    def close(self):
+        if self.interest is not None:
+            self.register_interest(None)
+        self.socket.close(linger=0)
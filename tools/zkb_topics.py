@@ -0,0 +1,85 @@
+'''
+    Topics the redisq listener publishes killmails under, so ZMQ subscribers can filter at the socket.
+
+    Every killmail is published as
+        zkb.r<region_id>.s<solar_system_id>.t<ship_group_id>. <json>
+    where ship_group_id is the inventory group of the victim's ship (Frigate, Titan, Capsule, ...). Unknown values
+    are 0. Each level ends in a dot, so the prefix for region 10000001 does not also match region 100000011.
+    Multipart messages (see tools/zkb_wire.py) use the same levels under WIRE_TOPIC_ROOT, which does not start with
+    'zkb' so subscribers of the old single frame format never receive them. Names new to the listener are published
+    under NAMES_TOPIC, see tools/zkb_names.py.
+
+    ZMQ subscriptions are prefix matches, so killmails outside the subscribed regions or systems are dropped before
+    they reach Python:
+        socket.setsockopt_string(zmq.SUBSCRIBE, region_prefix(10000015))
+    Subscribing to 'zkb' still receives every killmail. Ship groups are the last level of the topic, a subscriber
+    that only wants some ship groups in every region reads them from the topic with parse_topic() and can skip a
+    killmail without decoding its json.
+'''
+
+from tools.lookup_eve_static_dump import LookupEveStaticDumpException
+
+
+TOPIC_ROOT = 'zkb'
+WIRE_TOPIC_ROOT = 'zkm'
+NAMES_TOPIC = f'{WIRE_TOPIC_ROOT}.names.'
+
+
+def region_prefix(region_id, root=TOPIC_ROOT):
+    return f'{root}.r{region_id}.'
+
+def system_prefix(region_id, solar_system_id, root=TOPIC_ROOT):
+    return f'{region_prefix(region_id, root)}s{solar_system_id}.'
+
+def killmail_topic(region_id, solar_system_id, ship_group_id, root=TOPIC_ROOT):
+    return f'{system_prefix(region_id or 0, solar_system_id or 0, root)}t{ship_group_id or 0}.'
+
+# Returns (region_id, solar_system_id, ship_group_id) from a killmail topic of either root, or None for any other topic
+def parse_topic(topic):
+    parts = topic.split('.')
+    if len(parts) != 5 or parts[0] not in (TOPIC_ROOT, WIRE_TOPIC_ROOT) or parts[4] != '':
+        return None
+    try:
+        if parts[1][0] != 'r' or parts[2][0] != 's' or parts[3][0] != 't':
+            return None
+        return int(parts[1][1:]), int(parts[2][1:]), int(parts[3][1:])
+    except (IndexError, ValueError):
+        return None
+
+
+class KillmailTopics(object):
+    '''
+        Build the topic for a killmail.
+        region_lookup(solar_system_id) returns the region of a solar system, see SolarSystemTable.get_region_id.
+        groups_lookup(type_ids) returns { type_id: group_id }, see LookupEveStaticDump.get_groups_for_types.
+        Ship groups are remembered, there are only a few hundred ship types. A failed lookup is not remembered, it is
+        tried again for the next killmail of that type.
+    '''
+    def __init__(self, region_lookup=None, groups_lookup=None):
+        self.region_lookup = region_lookup
+        self.groups_lookup = groups_lookup
+        self.ship_groups = {}
+        # Types whose lookup failed and was reported, so a missing static data dump is not reported for every killmail
+        self.failed_types = set()
+
+    def get_ship_group(self, ship_type_id):
+        if not ship_type_id or self.groups_lookup is None:
+            return 0
+        group_id = self.ship_groups.get(ship_type_id)
+        if group_id is None:
+            try:
+                group_id = self.groups_lookup([ship_type_id]).get(ship_type_id, 0)
+            except LookupEveStaticDumpException as e:
+                if ship_type_id not in self.failed_types:
+                    self.failed_types.add(ship_type_id)
+                    print(f'   xxx Could not look up the group of type {ship_type_id} [{e}]')
+                return 0
+            # The static data does not change while running, a type's group is looked up once
+            self.ship_groups[ship_type_id] = group_id
+        return group_id
+
+    def topic_for_killmail(self, killmail, root=TOPIC_ROOT):
+        solar_system_id = killmail.get('solar_system_id', 0)
+        region_id = self.region_lookup(solar_system_id) if self.region_lookup is not None else 0
+        ship_group_id = self.get_ship_group(killmail.get('victim', {}).get('ship_type_id', 0))
+        return killmail_topic(region_id, solar_system_id, ship_group_id, root)
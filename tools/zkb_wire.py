@@ -0,0 +1,220 @@
+'''
+    Wire formats for killmail broadcasts.
+
+    legacy      - one frame, '<topic> <json>'. JSON turns the integer keys of the names dictionaries into strings.
+    multipart   - three frames, [topic, header, body]
+        topic   - the killmail topic under WIRE_TOPIC_ROOT, see tools/zkb_topics.py
+        header  - HEADER_FORMAT: wire version, body encoding, flags, epoch, sequence, killmail id, region previous
+        body    - {'killmail': {...}, 'names': {...}} as msgpack, which keeps integer keys. JSON is used when msgpack is
+                  not installed, the header says which.
+    With FLAG_NAMES_DELTA set, names only holds the names the listener had not published before. The rest were sent
+    on NAMES_TOPIC earlier, where the body is {'names': {...}}. See tools/zkb_names.py.
+    With FLAG_NAMES_SKIPPED set, the listener did not resolve the names of the killmail because no subscriber registered
+    an interest in it, see tools/zkb_interest.py. The subscriber asks for them with the control command 'names'.
+
+    Subscribers can read the header without decoding the body, and decode the body straight from the received frame
+    buffer. The epoch changes every time the listener starts, sequence numbers count up from 1 within an epoch.
+    region previous is the sequence of the last killmail broadcast before this one in the same region, 0 for the
+    first. A subscriber that sees every killmail finds gaps in the sequence numbers, one that subscribed to some regions
+    finds them by following region previous from killmail to killmail.
+
+    The listener publishes on an XPUB socket and sees which prefixes are subscribed. SubscriptionFormats turns those
+    into the formats that have subscribers, so each format is only built while someone is listening for it.
+'''
+
+import json
+import struct
+from collections import namedtuple
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from tools.zkb_topics import TOPIC_ROOT, WIRE_TOPIC_ROOT, NAMES_TOPIC
+
+
+WIRE_VERSION = 2
+ENCODING_MSGPACK = 1
+ENCODING_JSON = 2
+HEADER_FORMAT = '<BBHIQQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+HEADER_FORMAT_V1 = '<BBHIQQ'     # Version 1 headers have no region previous
+FLAG_NAMES_DELTA = 0x01
+FLAG_NAMES_SKIPPED = 0x02
+WIRE_FORMATS = ('legacy', 'multipart')
+NAME_KEYS = ('character_ids', 'corporation_ids', 'alliance_ids')
+
+WireHeader = namedtuple('WireHeader', ['version', 'encoding', 'flags', 'epoch', 'sequence', 'killmail_id',
+                                       'region_previous'], defaults=(0,))
+
+
+class ZKBWireException(Exception):
+    '''Raise whenever any error or exception occurs'''
+
+
+'''
+    The json module loads integer dictionary keys as strings.
+    { 10000: 'foo' } becomes { '10000': 'foo' }
+    Convert the string keys of the names dictionaries back to integer keys.
+'''
+def names_keys_to_int(names):
+    return {key: {int(k): v for k, v in names.get(key, {}).items()} for key in NAME_KEYS}
+
+
+# ################################
+# Legacy single frame
+
+'''
+    Build '<topic> <json>'. killmail_json is the killmail already serialized for the archive, it is reused instead
+    of serializing the killmail a second time.
+'''
+def encode_legacy(topic, data, killmail_json=None):
+    if killmail_json is None:
+        return f'{topic} {json.dumps(data)}'
+    # Same text json.dumps(data) produces
+    return f'{topic} {{"killmail": {killmail_json}, "names": {json.dumps(data["names"])}}}'
+
+# Returns (topic, data) for a legacy message string
+def decode_legacy(message):
+    try:
+        topic, body = message.split(' ', 1)
+        data = json.loads(body)
+    except ValueError as e:
+        raise ZKBWireException(f'invalid legacy message [{e}]')
+    data['names'] = names_keys_to_int(data.get('names', {}))
+    return topic, data
+
+
+# ################################
+# Multipart
+
+def default_encoding():
+    return ENCODING_MSGPACK if msgpack is not None else ENCODING_JSON
+
+# Pack the killmail once, the result can be passed to encode_multipart() for every format and copy of the message
+def pack_killmail(killmail, encoding=None):
+    encoding = encoding or default_encoding()
+    if encoding == ENCODING_MSGPACK:
+        return msgpack.packb(killmail, use_bin_type=True)
+    return json.dumps(killmail).encode('utf-8')
+
+# Pack any value, prefixed with its encoding, for the control channel
+def pack_value(value, encoding=None):
+    encoding = encoding or default_encoding()
+    if encoding == ENCODING_MSGPACK:
+        return bytes([encoding]) + msgpack.packb(value, use_bin_type=True)
+    return bytes([encoding]) + json.dumps(value).encode('utf-8')
+
+def unpack_value(frame):
+    buffer = _buffer(frame)
+    if len(buffer) == 0:
+        raise ZKBWireException('empty value')
+    try:
+        if buffer[0] == ENCODING_MSGPACK:
+            if msgpack is None:
+                raise ZKBWireException('value is msgpack encoded but the msgpack package is not installed')
+            return msgpack.unpackb(buffer[1:], raw=False, strict_map_key=False)
+        if buffer[0] == ENCODING_JSON:
+            return json.loads(bytes(buffer[1:]))
+    except (ValueError, TypeError) as e:
+        raise ZKBWireException(f'invalid value [{e}]')
+    raise ZKBWireException(f'unknown value encoding {buffer[0]}')
+
+def _encode_body(data, encoding, packed_killmail):
+    if packed_killmail is None:
+        packed_killmail = pack_killmail(data['killmail'], encoding)
+    if encoding == ENCODING_MSGPACK:
+        # A two entry map, written around the already packed killmail
+        return (b'\x82' + msgpack.packb('killmail') + packed_killmail + msgpack.packb('names') +
+                msgpack.packb(data['names'], use_bin_type=True))
+    return (b'{"killmail": ' + packed_killmail + b', "names": ' + json.dumps(data['names']).encode('utf-8') + b'}')
+
+'''
+    Build the [topic, header, body] frames for one killmail.
+    packed_killmail is the result of pack_killmail() with the same encoding, when it is at hand.
+    region_previous is the sequence of the previous killmail in the same region.
+'''
+def encode_multipart(topic, data, epoch=0, sequence=0, encoding=None, packed_killmail=None, flags=0,
+                     region_previous=0):
+    encoding = encoding or default_encoding()
+    if encoding == ENCODING_MSGPACK and msgpack is None:
+        raise ZKBWireException('msgpack encoding requested but the msgpack package is not installed')
+    header = struct.pack(HEADER_FORMAT, WIRE_VERSION, encoding, flags, epoch, sequence,
+                         data['killmail'].get('killmail_id', 0), region_previous)
+    return [topic.encode('utf-8'), header, _encode_body(data, encoding, packed_killmail)]
+
+# Build the frames of a message on NAMES_TOPIC, sequence numbers the names messages of an epoch
+def encode_names(names, epoch=0, sequence=0, encoding=None):
+    encoding = encoding or default_encoding()
+    header = struct.pack(HEADER_FORMAT, WIRE_VERSION, encoding, 0, epoch, sequence, 0, 0)
+    if encoding == ENCODING_MSGPACK:
+        body = msgpack.packb({'names': names}, use_bin_type=True)
+    else:
+        body = json.dumps({'names': names}).encode('utf-8')
+    return [NAMES_TOPIC.encode('utf-8'), header, body]
+
+def decode_header(frame):
+    buffer = _buffer(frame)
+    if len(buffer) == 0:
+        raise ZKBWireException('empty message header')
+    if buffer[0] > WIRE_VERSION:
+        raise ZKBWireException(f'unsupported wire version {buffer[0]}, upgrade this subscriber')
+    try:
+        return WireHeader(*struct.unpack_from(HEADER_FORMAT if buffer[0] > 1 else HEADER_FORMAT_V1, buffer))
+    except struct.error as e:
+        raise ZKBWireException(f'invalid message header [{e}]')
+
+# Decode a body frame, frame can be bytes, a memoryview, or a zmq.Frame received with copy=False
+def decode_body(frame, encoding):
+    buffer = _buffer(frame)
+    try:
+        if encoding == ENCODING_MSGPACK:
+            if msgpack is None:
+                raise ZKBWireException('message is msgpack encoded but the msgpack package is not installed')
+            return msgpack.unpackb(buffer, raw=False, strict_map_key=False)
+        if encoding == ENCODING_JSON:
+            data = json.loads(bytes(buffer))
+            data['names'] = names_keys_to_int(data.get('names', {}))
+            return data
+    except (ValueError, TypeError) as e:
+        raise ZKBWireException(f'invalid message body [{e}]')
+    raise ZKBWireException(f'unknown body encoding {encoding}')
+
+# Returns (topic, header, data) for the frames of a multipart message
+def decode_multipart(frames):
+    if len(frames) != 3:
+        raise ZKBWireException(f'expected 3 frames, got {len(frames)}')
+    topic = bytes(_buffer(frames[0])).decode('utf-8')
+    header = decode_header(frames[1])
+    return topic, header, decode_body(frames[2], header.encoding)
+
+def _buffer(frame):
+    # zmq.Frame exposes its memory through .buffer without copying it
+    return getattr(frame, 'buffer', frame)
+
+
+class SubscriptionFormats(object):
+    '''
+        Track the subscriptions an XPUB socket reports, and which wire formats they ask for.
+        Without XPUB_VERBOSE, ZMQ reports a prefix when its first subscriber arrives and when its last one leaves.
+    '''
+    ROOTS = {'legacy': TOPIC_ROOT, 'multipart': WIRE_TOPIC_ROOT}
+
+    def __init__(self):
+        self.prefixes = set()
+
+    # message is a subscription message received from the XPUB socket, b'\x01<prefix>' or b'\x00<prefix>'
+    def update(self, message):
+        if not message:
+            return
+        prefix = bytes(message[1:]).decode('utf-8', 'replace')
+        if message[0] == 1:
+            self.prefixes.add(prefix)
+        elif message[0] == 0:
+            self.prefixes.discard(prefix)
+
+    # Formats with at least one subscription that can match their topics
+    def formats(self):
+        return tuple(name for name, root in self.ROOTS.items()
+                     if any(x.startswith(root) or root.startswith(x) for x in self.prefixes))